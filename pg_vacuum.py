@@ -44,6 +44,69 @@
 # Jan.  12, 2021   V3.2: Fix nohup missing double quotes!
 # Jan.  26, 2021   V3.3: Add another parameter to do vacuums longer than x days, just like we do now for analyzes.
 #                        Also prevent multiple instances of this program to run against the same PG database.
+# Oct.  18, 2026   V3.4: Add modification-driven analyze selector (--analyzemods) based on n_mod_since_analyze vs reltuples.
+#                        Add hot column analyzes (--hotcolumns) using a cached map of per-table column statistics targets.
+#                        Renamed internal async flag since async is a reserved word in python 3.7+.
+# Oct.  18, 2026   V3.5: Add bloat estimation engine (--bloatorder) to order vacuums by estimated reclaimable space.
+#                        Uses pg_stats based estimates, refined by pgstattuple_approx when installed. Expensive parts cached in --workdir.
+# Oct.  18, 2026   V3.6: Add wraparound emergency mode (--emergency): freeze every relation (including TOAST) by remaining xid/mxid headroom
+#                        with INDEX_CLEANUP off and no cost delay until datfrozenxid/datminmxid are safe again.
+#                        Fixed active query count which missed parenthesized VACUUM commands.
+# Oct.  18, 2026   V3.7: Lock-aware scheduling: check pg_locks in bulk before dispatching, use lock_timeout for sync jobs and SKIP_LOCKED (PG12+)
+#                        for async jobs, and requeue locked tables with backoff instead of blocking the whole run (--locktimeout).
+# Oct.  18, 2026   V3.8: Replica-aware throttling (--maxlag): sample pg_stat_replication during the run and reduce concurrency and raise
+#                        vacuum_cost_delay while replicas lag beyond the ceiling.  Show per-job WAL bytes in the summary.
+# Oct.  18, 2026   V3.9: Cache catalog query results on disk for dry runs (--cachettl), keyed by database and system identifier and
+#                        invalidated when pg_stat_database shows stats were reset or enough tuples were modified.
+# Oct.  18, 2026   V4.0: Buffered logging written by a background thread instead of a flush per line.  Optional JSON lines output
+#                        (--logformat json) with table, action, phase, size, reason and duration fields, and log level filtering (--loglevel).
+# Oct.  18, 2026   V4.1: Inquiry report engine working from an in-memory catalog snapshot: sorting and top-N by size, dead tuples
+#                        or xid age (--inquirysort, --inquirytop) and csv, json or markdown output (--inquiryformat, --inquiryout).
+#                        Processed tables are now tracked in a set instead of a list.
+# Oct.  18, 2026   V4.2: Keep per-run samples of dead tuples, updates/deletes, xid age and size in a sqlite history in --workdir.
+#                        Fit per-table growth rates and vacuum (or freeze) tables forecast to cross their autovacuum or wraparound
+#                        threshold before the next run (--forecasthours).
+# Oct.  18, 2026   V4.3: Autovacuum-aware coordination (--avaware): skip tables autovacuum workers are already vacuuming and defer tables
+#                        over their autovacuum threshold to the end of the run, only vacuuming the ones autovacuum has not reached by then.
+# Oct.  18, 2026   V4.4: Autovacuum tuning mode (--avtune print|apply): derive per-table autovacuum reloptions from the growth rates in the
+#                        history so autovacuum keeps up on its own, and print or apply them as batched ALTER TABLE ... SET statements.
+# Oct.  18, 2026   V4.5: Distributed mode (--distributed): several pg_vacuum workers on different hosts split one database's candidates by
+#                        taking per-table leases in a small lease table.  The single instance check is now an advisory lock instead of a
+#                        racy count of pg_vacuum connections (which also counted our own async jobs).
+# Oct.  18, 2026   V4.6: Append-only journal of dispatched and completed jobs in --workdir.  An interrupted or crashed run can be picked up
+#                        with --resume: finished tables are skipped and only the unfinished jobs are dispatched again.
+# Oct.  18, 2026   V4.7: Graceful shutdown on SIGINT/SIGTERM: stop dispatching, drain this run's jobs for --shutdowngrace seconds, then
+#                        pg_cancel_backend the rest.  Async jobs are labelled pg_vacuum_job_<run id>, and jobs left behind by a run that is
+#                        gone are adopted on startup instead of being started again.
+# Oct.  18, 2026   V4.8: Index maintenance phase (--reindex): REINDEX CONCURRENTLY (PG12+) invalid indexes and indexes whose estimated bloat
+#                        is over --reindexpct, under the same size thresholds and process limits as vacuums.  Duplicate indexes and leftovers
+#                        of failed concurrent builds are reported to be dropped manually.
+# Oct.  18, 2026   V4.9: Policy file (--policy, JSON, TOML or YAML) with glob/regex rules per schema and table: exclusions, size thresholds,
+#                        priority, extra VACUUM options and time windows.  Rules are compiled into one regex and results cached per table.
+# Oct.  18, 2026   V5.0: Per-job time budgets (--jobbudget, policy budget) enforced with statement_timeout and tightened by the durations in the
+#                        history.  A vacuum cut off by its budget is retried per partition, then with INDEX_CLEANUP off, then TRUNCATE off.
+#                        Every sync job, its duration, outcome and strategy are recorded in the history.
+# Oct.  18, 2026   V5.1: Connect with a full libpq DSN/URI (--dsn) or a service (--service), so TLS settings, passfiles and multiple hosts
+#                        work as libpq handles them.  A dropped connection is re-established with backoff and its session state (SETs,
+#                        advisory locks) restored.  Async psql jobs get the same DSN, shell-quoted.
+# Oct.  18, 2026   V5.2: Export each run's catalog snapshot and job outcomes (--export, --exportformat) as Parquet or Arrow IPC files
+#                        (pyarrow) or CSV, one file per run under date=YYYY-MM-DD/db=<dbname> partitions, for fleet-wide analytics.
+# Oct.  18, 2026   V5.3: Phase rows are bucketed (freeze headroom, sync/async/defer by size and rows) in one pass per phase, vectorized
+#                        with numpy when installed and the phase has enough rows.  --benchclassify compares it with the scalar path.
+# Oct.  18, 2026   V5.4: The freeze planner weighs heap xid, TOAST xid and multixact headroom together and runs the cheapest command
+#                        that clears the nearest limit: TOAST only, an aggressive vacuum for multixacts, or a freeze skipping a young TOAST.
+# Oct.  18, 2026   V5.5: Report what holds back the xmin horizon (prepared transactions, replication slots, old snapshots) before
+#                        any work, and suspend freezes that cannot get relfrozenxid past it.  The horizon is checked again as freezes go.
+# Oct.  18, 2026   V5.6: Parse VACUUM VERBOSE output (notices of sync jobs, stderr logs of async jobs in --workdir) into pages scanned,
+#                        tuples removed, dead but not removable, index scans, buffers, WAL and elapsed time.  Kept in the history and
+#                        used for a report of the vacuums that removed the least for the pages they scanned.
+# Oct.  18, 2026   V5.7: Cost model (--costmodel): vacuum seconds per GB of heap and of indexes fitted from the history, refitted as jobs
+#                        are recorded, places tables in sync, async or deferred by predicted duration (--costsync, --costasync).
+#                        --costreport shows the fit and predicted against actual durations.
+# Oct.  18, 2026   V5.8: Faster startup: the driver, sqlite3, csv and other modules are imported when first needed, the load check
+#                        reads os.getloadavg() instead of running shell pipelines and is skipped for report-only modes, the server version
+#                        comes from libpq and the pgstattuple probe is cached.  --inquiryonly reports and exits without taking the locks,
+#                        --benchstartup prints the time to each startup step.
 #
 # Notes:
 #   1. Do not run this program multiple times since it may try to vacuum or analyze the same table again
@@ -61,14 +124,33 @@
 # 00 03 * * * /home/postgres/mjv/pg_vacuumb.py -H localhost -d <dbname> -u postgres -p 5432 -y 5 -t 5000 --dryrun >/home/postgres/mjv/optimize_db_`/bin/date +'\%Y-\%m-\%d-\%H.\%M.\%S'`.log 2>&1
 #
 ##################################################################################################
-import sys, os, threading, argparse, time, datetime, signal
-from optparse import OptionParser
-import psycopg2
-import subprocess
+import time
+startup_at = time.time()
+import sys, os, re, threading, argparse, datetime, signal, json, math, heapq, socket, fnmatch
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+from collections import namedtuple
+# psycopg2 is imported by load_driver() once the arguments say a connection is needed
+psycopg2 = None
+import atexit
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-version = '3.3  Jan. 26, 2021'
+version = '5.8  Oct. 18, 2026'
 OK = 0
 BAD = -1
+LOCKED = 1
+LEASED = 2
+
+# table buckets against the size thresholds: freeze not due yet, too big (do manually), async job, sync job
+HOLD  = 0
+DEFER = 1
+ASYNC = 2
+SYNC  = 3
 
 fmtrows  = '%11d'
 fmtbytes = '%13d'
@@ -98,17 +180,288 @@ threshold_max_processes = 12
 # load threshold, wait for a time if very high
 load_threshold = 250
 
-def signal_handler(signal, frame):
-     printit('User-interrupted!')
+# percent of reltuples modified since last analyze before an analyze is considered, -1 means not used
+threshold_analyze_mods = -1
+
+# hot columns to analyze per table and cache of their column statistics targets
+hot_columns   = {}
+stats_targets = None
+analyze_mods  = {}
+
+# directory for cached estimates and other run artifacts
+workdir = os.path.join(os.path.expanduser('~'), '.pg_vacuum')
+
+# hours before cached bloat estimates (tuple widths, pgstattuple_approx results) are refreshed
+bloat_cache_hours = 24
+
+# server capabilities probed once and cached in workdir for this many hours (or until the server version changes)
+capability_cache_hours = 24
+capabilities = None
+
+# time to each startup step: [(step, secs since the script started)], printed by --benchstartup
+startup_marks = []
+
+# max tables refined with pgstattuple_approx per run, largest estimates first
+bloat_approx_max = 100
+
+# estimated wasted bytes per table: table --> [heap bloat, index bloat]
+bloat = {}
+
+# estimated wasted bytes per index: index --> wasted bytes
+index_bloat = {}
+
+# policy rules: the first rule whose glob (match) or regex matches schema.table applies to the table
+policy_keys    = ['match', 'regex', 'exclude', 'max_size', 'max_sync', 'async_rows', 'priority', 'options', 'window', 'budget']
+policy_rules   = []
+policy_matcher = None
+policy_cache   = {}
+
+# seconds a job may run (0 means no limit).  With history, a job gets budget_factor times its longest successful run (at least
+# budget_min seconds) when that is less.  A policy budget replaces job_budget for its tables.
+job_budget    = 0
+budget_factor = 3
+budget_min    = 60
+job_history   = None
+
+# cost model: vacuum seconds fitted from the sizes and durations of the vacuums in the history, refitted once new ones are recorded.
+# When on, vacuums predicted to take up to cost_sync_secs run sync, up to cost_async_secs async, longer ones are deferred.
+cost_model_on   = False
+cost_model      = None
+cost_sync_secs  = 600
+cost_async_secs = 21600
+cost_min_jobs   = 10
+cost_max_jobs   = 1000
+cost_new_jobs   = 0
+relation_sizes  = {}
+
+# phases with at least this many rows are bucketed with numpy (when installed), smaller ones with a plain loop.  Building the
+# numpy columns from the row tuples costs about what the loop does, so numpy only pays off on very large catalogs.
+vector_min_rows = 100000
+
+# index phase: reindex indexes with at least this pct of estimated bloat (and threshold_min_size bytes of it), -1 means no index phase
+reindex_pct = -1
+
+# xmin horizon: age of the oldest xmin still needed by user tables, when it was checked and how often it is checked during freezes.
+# Freezes gaining fewer than horizon_min_gain xids over the horizon are suspended, blockers older than horizon_warn_age are reported.
+horizon_age        = 0
+horizon_checked    = 0
+horizon_check_secs = 60
+horizon_min_gain   = 10000000
+horizon_warn_age   = 10000000
+freezes_suspended  = 0
+
+# seconds between checks while waiting on emergency freezes, and max rounds before giving up
+emergency_poll = 10
+emergency_max_rounds = 8640
+
+# seconds to wait for a table lock before giving up on a sync job, 0 means wait forever
+lock_timeout = 5
+
+# seconds between bulk pg_locks checks, and retry policy for locked tables: wait lock_backoff * 2^attempt between attempts
+lock_refresh_secs = 30
+lock_backoff      = 30
+lock_max_retries  = 4
+
+locked_tables   = set()
+locks_checked   = 0
+lock_requeue    = []
+lock_requeue_set = set()
+
+# replication lag ceiling in seconds (-1 means replicas are ignored), and the byte ceiling used when lag times are not available (pre PG10)
+replica_max_lag       = -1
+replica_max_lag_bytes = 16000000000
+
+# seconds between pg_stat_replication samples, max seconds to pause for a lagging replica, and cost delay (ms) used while throttled
+replica_check_secs = 15
+replica_max_wait   = 1800
+replica_cost_delay = 20
+
+replica_checked   = 0
+replica_throttled = False
+base_max_processes = 0
+
+# WAL generated per sync job: (table, command, bytes), plus the WAL position when the run started
+wal_jobs  = []
+wal_start = None
+
+# VACUUM VERBOSE metrics of this run's vacuums: (table, metrics), and stderr logs of async vacuums (and of async jobs with a budget)
+# not parsed yet: [logfile, table, sql, size, dispatched at]
+metric_names   = ['pages_total', 'pages_scanned', 'tuples_removed', 'dead_not_removable', 'index_scans', 'buffer_hits', 'buffer_misses', 'buffer_dirtied', 'wal_bytes', 'elapsed']
+vacuum_metrics = []
+verbose_logs   = []
+
+# hours before VERBOSE logs left in workdir by earlier runs (killed, or jobs still running at their end) are removed
+verbose_log_hours = 24
+
+# seconds dry run catalog query results are reused for, 0 means never cached
+catalog_cache_ttl = 600
+catalog_cache     = None
+
+# log output: 'text' is the classic timestamped columns, 'json' writes one JSON object per line.  Lines below log_level are dropped.
+log_format = 'text'
+log_level  = 'INFO'
+log_levels = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+# max seconds log lines wait in the buffer before being written
+log_flush_secs = 1
+
+log_queue  = None
+log_thread = None
+log_stop   = threading.Event()
+log_stamp  = [0, '']
+
+# phase currently running, attached to job events
+action_name = ''
+
+# in-memory catalog snapshot of user tables, loaded once and shared by the inquiry report
+CatalogRow = namedtuple('CatalogRow', ['table', 'sizep', 'size', 'xid_age', 'n_tup', 'n_live_tup', 'dead_tup', 'last_vacuum', 'last_autovacuum', 'last_analyze', 'last_autoanalyze'])
+catalog = None
+
+# inquiry report options
+inquiry_sort   = 'name'
+inquiry_top    = 0
+inquiry_format = 'text'
+inquiry_out    = ''
+
+# export directory for the catalog snapshot and job outcomes of each run, '' means no export.  parquet and arrow need pyarrow.
+export_dir    = ''
+export_format = 'parquet'
+run_actions   = []
+
+# hours until the next scheduled run: tables forecast to cross a threshold before then are done now, -1 means no forecasting
+forecast_hours = -1
+
+# days of samples kept in the history, and samples needed before a growth rate is trusted
+history_keep_days   = 30
+history_min_samples = 3
+
+# tables forecast to cross a threshold: (table, action, eta secs, tups, sizep, size, partitioned, xid age)
+forecast = []
+
+# catalog rows of this run's history sample, taken once and shared by forecasting and autovacuum tuning
+sampled_rows = None
+
+# coordinate with autovacuum: tables being autovacuumed and tables over their autovacuum threshold, refreshed every lock_refresh_secs
+avaware      = False
+av_active    = set()
+av_expected  = set()
+av_checked   = 0
+av_deferred  = []
+av_skipped   = 0
+run_started  = time.time()
+
+# autovacuum tuning mode: '' (off), 'print' or 'apply'.  Tables autovacuum would visit less than every avtune_target_hours * 2 are tuned
+# so it visits them about every avtune_target_hours.  Statements are applied avtune_batch at a time, one transaction per batch.
+avtune             = ''
+avtune_target_hours = 6
+avtune_batch       = 20
+
+# tables over this size get a higher autovacuum cost limit, and over threshold_max_sync an earlier anti-wraparound vacuum
+avtune_big_table   = 10000000000
+
+# distributed mode: a table is only processed by the worker holding its lease.  Leases are kept until they expire, so a table
+# done by one worker is not redone by another that built its candidate list earlier.
+distributed  = False
+lease_table  = 'public.pg_vacuum_lease'
+lease_secs   = 7200
+worker_id    = '%s:%d' % (socket.gethostname(), os.getpid())
+leases_held  = 0
+leases_lost  = 0
+
+# journal of this run's jobs, one JSON object per line.  A run that did not write its 'end' event can be resumed.
+resume  = False
+journal = None
+run_id  = '%d_%d' % (int(time.time()), os.getpid())
+
+# async jobs are labelled with the run that owns them.  Each run holds an advisory lock on its id, so a job whose run lock is free is an orphan.
+job_app_name  = 'pg_vacuum_job_%s' % run_id
+main_pid      = None
+owned_pids    = set()
+connstr       = ''
+
+# seconds to let this run's jobs finish after SIGINT/SIGTERM before cancelling them
+shutdown_grace = 60
+shutting_down  = False
+
+# connection retries with exponential backoff, used at startup and when the session is lost mid-run
+reconnect_retries = 5
+reconnect_backoff = 2
+connect_timeout   = 10
+
+def signal_handler(signum, frame):
+     # a second signal, or one before we are connected, exits right away
+     global shutting_down
+     if shutting_down or main_pid is None:
+         printit('User-interrupted!')
+         sys.exit(1)
+     shutting_down = True
+     shutdown(signum)
      sys.exit(1)
      
-def printit(text):
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    txt = now + ' ' + text
-    print (txt)
-    # don't use v3 way to flush output since we want this to work for v2 and 3
-    #print (txt, flush=True)
-    sys.stdout.flush()
+def log_writer():
+    # drains the log queue in batches: one write and one flush per batch instead of per line
+    while True:
+        batch = [log_queue.get()]
+        while True:
+            try:
+                batch.append(log_queue.get_nowait())
+            except queue.Empty:
+                break
+        sys.stdout.write(''.join([line for line in batch if line is not None]))
+        sys.stdout.flush()
+        if None in batch:
+            return
+        log_stop.wait(log_flush_secs)
+
+def log_close():
+    # called at exit: write whatever is still buffered
+    if log_thread is None:
+        return
+    log_stop.set()
+    log_queue.put(None)
+    log_thread.join(10)
+
+def log_put(txt):
+    global log_queue, log_thread
+    if log_thread is None:
+        log_queue = queue.Queue()
+        log_thread = threading.Thread(target=log_writer)
+        log_thread.daemon = True
+        log_thread.start()
+        atexit.register(log_close)
+    log_queue.put(txt + '\n')
+
+def printraw(text, kind='report'):
+    # unformatted output (reports) goes through the same buffered writer so it never interleaves with log lines.
+    # With json logging each line becomes an event of its own, so stdout stays one json object per line.
+    if log_format != 'json':
+        log_put(text)
+        return
+    stamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for line in text.split('\n'):
+        log_put(json.dumps({'ts': stamp, 'level': 'INFO', 'kind': kind, 'line': line}))
+
+def job_event_level():
+    # per-job events are the point of json output, but would clutter the classic text columns
+    if log_format == 'json':
+        return 'INFO'
+    return 'DEBUG'
+
+def printit(text, level='INFO', **fields):
+    if log_levels.get(level, 20) < log_levels[log_level]:
+        return
+    # the timestamp only needs formatting once per second
+    now = time.time()
+    if int(now) != log_stamp[0]:
+        log_stamp[0] = int(now)
+        log_stamp[1] = datetime.datetime.fromtimestamp(int(now)).strftime("%Y-%m-%d %H:%M:%S")
+    if log_format == 'json':
+        event = {'ts': log_stamp[1], 'level': level, 'msg': text.strip()}
+        event.update(fields)
+        txt = json.dumps(event, default=str)
+    else:
+        txt = log_stamp[1] + ' ' + text
+    log_put(txt)
     return
 
 def execute_cmd(text):
@@ -116,27 +469,37 @@ def execute_cmd(text):
     return rc
 
 def get_process_cnt():
+    import subprocess
     cmd = "ps -ef | grep 'VACUUM VERBOSE\|ANALYZE VERBOSE' | grep -v grep | wc -l"
     result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
     result = int(result.decode('ascii'))
     return result
 
 def highload():
-    cmd = "uptime | sed 's/.*load average: //' | awk -F\, '{print $1}'"
-    result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-    min1  = str(result.decode())
-    loadn = int(float(min1))
-    cmd = "cat /proc/cpuinfo | grep processor | wc -l"
-    result = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE).stdout.read()
-    cpus  = str(result.decode())
-    cpusn = int(float(cpus))
-    load = (loadn / cpusn) * 100
+    # v5.8: 1 minute load average and cpu count from the os module instead of uptime and /proc/cpuinfo pipelines
+    loadn = int(os.getloadavg()[0])
+    try:
+        cpusn = os.cpu_count()
+    except AttributeError:
+        import multiprocessing
+        cpusn = multiprocessing.cpu_count()
+    load = (loadn / float(cpusn)) * 100
     if load < load_threshold:
         return False
     else:
         printit ("High Load: loadn=%d cpusn=%d load=%d" % (loadn, cpusn, load))
         return True
 
+def startup_mark(step):
+    startup_marks.append((step, time.time() - startup_at))
+
+def startup_report():
+    printit ("Startup timings:")
+    last = 0.0
+    for step, secs in startup_marks:
+        printit ("%-28s %8.1f ms  (+%.1f ms)" % (step, secs * 1000, (secs - last) * 1000))
+        last = secs
+
 '''
 func requires psutil package
 def getload():
@@ -160,7 +523,7 @@ def getload():
 '''
 
 def get_query_cnt(conn, cur):
-    sql = "select count(*) from pg_stat_activity where state = 'active' and application_name = 'pg_vacuum' and query like 'VACUUM FREEZE VERBOSE%' OR query like 'VACUUM ANALYZE VERBOSE%' OR query like 'VACUUM VERBOSE%' OR query like 'ANALYZE VERBOSE%'"
+    sql = "select count(*) from pg_stat_activity where state = 'active' and application_name like 'pg_vacuum%' and (query like 'VACUUM%' OR query like 'ANALYZE%' OR query like 'REINDEX%')"
     cur.execute(sql)
     rows = cur.fetchone()
     return int(rows[0])
@@ -178,7 +541,108 @@ def skip_table (atable, tablist):
         return True
     else:
         #print ("table is not in the list")
-        return False
+        # v4.9: or the policy says not to touch it now
+        return policy_excludes(atable)
+
+def load_policy(path):
+    # JSON is always available, TOML needs python 3.11+ or the toml package, YAML needs PyYAML
+    ext = os.path.splitext(path)[1].lower()
+    with open(path, 'rb') as f:
+        text = f.read().decode('utf-8')
+    if ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("YAML policy files need PyYAML (pip install pyyaml).  Use a JSON or TOML policy file instead.")
+        policy = yaml.safe_load(text)
+    elif ext == '.toml':
+        try:
+            import tomllib
+            policy = tomllib.loads(text)
+        except ImportError:
+            try:
+                import toml
+            except ImportError:
+                raise ValueError("TOML policy files need python 3.11+ or the toml package.  Use a JSON or YAML policy file instead.")
+            policy = toml.loads(text)
+    else:
+        policy = json.loads(text)
+
+    rules = (policy or {}).get('rules', [])
+    for i, rule in enumerate(rules):
+        unknown = [key for key in rule if key not in policy_keys]
+        if len(unknown) > 0:
+            raise ValueError("rule %d: unknown keys %s" % (i + 1, ', '.join(unknown)))
+        if ('match' in rule) == ('regex' in rule):
+            raise ValueError("rule %d: needs either match (glob) or regex" % (i + 1))
+        for key in ['max_size', 'max_sync', 'async_rows', 'priority', 'budget']:
+            if key in rule:
+                rule[key] = int(rule[key])
+        if isinstance(rule.get('options', []), str):
+            rule['options'] = [rule['options']]
+        if 'window' in rule and re.match(r'^\d\d:\d\d-\d\d:\d\d$', rule['window']) is None:
+            raise ValueError("rule %d: window must look like 22:00-06:00" % (i + 1))
+    return rules
+
+def compile_policy(rules):
+    # One alternation for all rules, tried in order, so the first alternative that matches is the first matching rule.
+    # Globs and regexes both have to match the whole unquoted schema.table name.
+    parts = []
+    for i, rule in enumerate(rules):
+        if 'match' in rule:
+            pattern = fnmatch.translate(rule['match'])
+        else:
+            pattern = '(?:%s)\\Z' % rule['regex']
+        parts.append('(?P<rule%d>%s)' % (i, pattern))
+    return re.compile('|'.join(parts))
+
+def policy_rule(table):
+    if policy_matcher is None:
+        return {}
+    if table not in policy_cache:
+        m = policy_matcher.match(table.replace('"', ''))
+        policy_cache[table] = policy_rules[int(m.lastgroup[4:])] if m is not None else {}
+    return policy_cache[table]
+
+def in_window(window):
+    # windows may wrap past midnight
+    start, end = window.split('-')
+    now = datetime.datetime.now().strftime('%H:%M')
+    if start <= end:
+        return start <= now < end
+    return now >= start or now < end
+
+def policy_excludes(table):
+    rule = policy_rule(table)
+    if rule.get('exclude', False):
+        printit ("Policy excludes %s" % table, level='DEBUG')
+        return True
+    if 'window' in rule and not in_window(rule['window']):
+        printit ("Policy window %s for %s is closed.  Skipped." % (rule['window'], table), level='DEBUG')
+        return True
+    return False
+
+def table_limits(table):
+    # (max size, async size, async rows) for a table, the policy overriding the global thresholds
+    rule = policy_rule(table)
+    return (rule.get('max_size', threshold_max_size), rule.get('max_sync', threshold_max_sync), rule.get('async_rows', threshold_async_rows))
+
+def order_by_policy(rows):
+    # higher priority first, catalog order kept within a priority
+    if policy_matcher is None:
+        return rows
+    return sorted(rows, key=lambda row: -policy_rule(row[0]).get('priority', 0))
+
+def policy_options(sql, table):
+    # extra VACUUM options for the table, e.g. INDEX_CLEANUP OFF or PARALLEL 4.  Options already present are not repeated.
+    if not sql.startswith('VACUUM'):
+        return sql
+    for option in policy_rule(table).get('options', []):
+        m = re.match(r'^VACUUM \(([^)]*)\)', sql)
+        if m is not None and option.split()[0].upper() in [o.strip().split()[0].upper() for o in m.group(1).split(',')]:
+            continue
+        sql = add_vacuum_option(sql, option)
+    return sql
 
 def wait_for_processes(conn,cur):
     cnt = 0
@@ -186,17 +650,1905 @@ def wait_for_processes(conn,cur):
         rc = get_query_cnt(conn, cur)
         cnt = cnt + 1
         if cnt > 20:
-            printit ("NOTE: Program ending, but vacuums/analyzes(%d) still in progress." % (rc))
+            printit ("NOTE: Program ending, but vacuums/analyzes/reindexes(%d) still in progress." % (rc))
             break
         if rc > 0:
             tables = get_vacuums_in_progress(conn, cur)
-            printit ("NOTE: vacuums still running: %d (%s) Waiting another 5 minutes before exiting..." % (rc, tables))
+            printit ("NOTE: vacuums/analyzes/reindexes still running: %d (%s) Waiting another 5 minutes before exiting..." % (rc, tables))
             time.sleep(300)
         else:
             break
     return
 
 
+def quote_table(name):
+    # normalize schema.table or schema."table" to the schema."table" form returned by the catalog queries
+    name = name.strip()
+    if '.' in name:
+        nsp, rel = name.split('.', 1)
+    else:
+        nsp, rel = 'public', name
+    return '%s."%s"' % (nsp.strip('"'), rel.strip('"'))
+
+def classify(rows, sizecol, tupcol=None, freezecols=None, vector=None):
+    # Bucket of each row: DEFER over the max size, ASYNC over the async size or rows, SYNC otherwise.  With freezecols (xid age,
+    # freeze max age), rows under pctfreeze pct of their max age are HOLD and large tables are not deferred, as in the freeze phase.
+    if len(rows) == 0:
+        return []
+    limits = None
+    if policy_matcher is not None:
+        limits = [table_limits(row[0]) for row in rows]
+    # v5.7: vacuum phases go by predicted duration with the cost model, except for tables with policy thresholds
+    model = None
+    if cost_model_on and action_name.startswith('VAC'):
+        model = current_cost_model()
+    if model is not None:
+        vector = False
+    if vector is None:
+        vector = len(rows) >= vector_min_rows
+    if vector:
+        try:
+            import numpy
+        except ImportError:
+            vector = False
+
+    if not vector:
+        buckets = []
+        maxsize, maxsync, asyncrows = threshold_max_size, threshold_max_sync, threshold_async_rows
+        for i, row in enumerate(rows):
+            if limits is not None:
+                maxsize, maxsync, asyncrows = limits[i]
+            size = row[sizecol]
+            if freezecols is not None and (100 * float(row[freezecols[0]]) / float(row[freezecols[1]])) < float(pctfreeze):
+                buckets.append(HOLD)
+            elif model is not None and len(set(['max_size', 'max_sync', 'async_rows']) & set(policy_rule(row[0]))) == 0:
+                # tables missing from the size map (created since) count as all heap
+                heap, index = relation_sizes.get(row[0], (size, 0))
+                secs = predict_secs(model, heap, index)
+                if freezecols is None and secs > cost_async_secs:
+                    buckets.append(DEFER)
+                elif secs > cost_sync_secs:
+                    buckets.append(ASYNC)
+                else:
+                    buckets.append(SYNC)
+            elif freezecols is None and size > maxsize:
+                buckets.append(DEFER)
+            elif (tupcol is not None and row[tupcol] > asyncrows) or size > maxsync:
+                buckets.append(ASYNC)
+            else:
+                buckets.append(SYNC)
+        return buckets
+
+    # column store of the phase rows: only the columns the buckets need are copied out of the row tuples
+    def column(values):
+        return numpy.fromiter(values, dtype=numpy.float64, count=len(rows))
+    if limits is not None:
+        maxsize, maxsync, asyncrows = [column(limit[i] for limit in limits) for i in range(3)]
+    else:
+        maxsize, maxsync, asyncrows = threshold_max_size, threshold_max_sync, threshold_async_rows
+    size = column(row[sizecol] for row in rows)
+    big = size > maxsync
+    if tupcol is not None:
+        big |= column(row[tupcol] for row in rows) > asyncrows
+    buckets = numpy.where(big, ASYNC, SYNC)
+    if freezecols is None:
+        buckets[size > maxsize] = DEFER
+    else:
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            pctmax = 100 * column(row[freezecols[0]] for row in rows) / column(row[freezecols[1]] for row in rows)
+        buckets[pctmax < float(pctfreeze)] = HOLD
+    return buckets.tolist()
+
+def bench_classify(nrows):
+    # synthetic phase rows (table, sizep, size, tups, xid age, freeze max age) with log-normal sizes like a real catalog
+    import random
+    rows = []
+    for i in range(nrows):
+        size = int(random.lognormvariate(16, 3))
+        rows.append(('public."t%d"' % i, '', size, size // 100, random.randint(0, 200000000), 200000000))
+    for label, kwargs in [('size buckets', {'sizecol': 2, 'tupcol': 3}), ('freeze headroom', {'sizecol': 2, 'tupcol': 3, 'freezecols': (4, 5)})]:
+        started = time.time()
+        scalar = classify(rows, vector=False, **kwargs)
+        scalar_secs = time.time() - started
+        started = time.time()
+        vector = classify(rows, vector=True, **kwargs)
+        vector_secs = time.time() - started
+        printit ("Classify %-16s rows: %d  scalar: %.4f secs  numpy: %.4f secs  speedup: %.1fx  same buckets: %r" \
+                 % (label, nrows, scalar_secs, vector_secs, scalar_secs / max(vector_secs, 0.000001), scalar == vector))
+
+def parse_hot_columns(specs):
+    # each spec looks like this: schema.table:col1,col2
+    hotcols = {}
+    for spec in specs:
+        if ':' not in spec:
+            printit("Hot columns parameter invalid.  Must be schema.table:col1,col2 --> %s" % spec)
+            sys.exit(1)
+        atable, cols = spec.rsplit(':', 1)
+        collist = [c.strip() for c in cols.split(',') if c.strip() != '']
+        hotcols.setdefault(quote_table(atable), []).extend(collist)
+    return hotcols
+
+def get_stats_targets(conn, cur):
+    # only fetched once per run: maps table --> {column: attstattarget}
+    global stats_targets
+    if stats_targets is not None:
+        return stats_targets
+    stats_targets = {}
+    if len(hot_columns) == 0:
+        return stats_targets
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"' as table, a.attname, coalesce(a.attstattarget, -1) FROM pg_attribute a, pg_class c, pg_namespace n " \
+          "WHERE a.attrelid = c.oid and c.relnamespace = n.oid and a.attnum > 0 and not a.attisdropped and n.nspname || '.\"' || c.relname || '\"' = ANY(%s)"
+    try:
+        cur.execute(sql, (list(hot_columns.keys()),))
+    except Exception as error:
+        printit("Unable to get column statistics targets: %s *** %s" % (type(error), error))
+        return stats_targets
+    for row in cur.fetchall():
+        stats_targets.setdefault(row[0], {})[row[1]] = int(row[2])
+    return stats_targets
+
+def quote_column(col):
+    if re.match(r'^[a-z_][a-z0-9_$]*$', col):
+        return col
+    return '"%s"' % col
+
+def analyze_cmd(conn, cur, table):
+    # restrict the analyze to the hot columns of this table, ignoring columns that are gone or have statistics turned off (attstattarget = 0)
+    cols = hot_columns.get(table)
+    if not cols:
+        return "ANALYZE VERBOSE %s" % table
+    targets = get_stats_targets(conn, cur).get(table, {})
+    usable = [c for c in cols if targets.get(c, 0) != 0]
+    if len(usable) == 0:
+        return "ANALYZE VERBOSE %s" % table
+    return "ANALYZE VERBOSE %s (%s)" % (table, ', '.join([quote_column(c) for c in usable]))
+
+def pretty_bytes(nbytes):
+    for unit in ['bytes', 'kB', 'MB', 'GB', 'TB']:
+        if abs(nbytes) < 1024 or unit == 'TB':
+            break
+        nbytes = nbytes / 1024.0
+    if unit == 'bytes':
+        return '%d %s' % (nbytes, unit)
+    return '%.1f %s' % (nbytes, unit)
+
+def file_host():
+    # The host as used in workdir file names.  A Unix socket directory (from -H or a DSN) or abstract socket is 'local',
+    # anything else has the characters that cannot be in a file name replaced.
+    if hostname == '' or hostname.startswith('/') or hostname.startswith('@'):
+        return 'local'
+    return re.sub(r'[^\w.-]', '_', hostname)
+
+def cache_file(prefix):
+    return os.path.join(workdir, '%s_%s_%d_%s.json' % (prefix, file_host(), dbport, dbname))
+
+def load_cache(prefix):
+    try:
+        with open(cache_file(prefix), 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def save_cache(prefix, data):
+    try:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        tmpfile = cache_file(prefix) + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmpfile, cache_file(prefix))
+    except Exception as error:
+        printit("Unable to save %s cache: %s *** %s" % (prefix, type(error), error))
+
+def server_capability(conn, cur, name, sql):
+    # one-value probes (installed extensions etc.) that rarely change, cached like the bloat estimates.
+    # The whole cache is dropped after capability_cache_hours or when the server version changes.
+    global capabilities
+    if capabilities is None:
+        capabilities = load_cache('capabilities')
+        if capabilities.get('version') != version or capabilities.get('checked_at', 0) < time.time() - (capability_cache_hours * 3600):
+            capabilities = {'version': version, 'checked_at': time.time()}
+    if name not in capabilities:
+        cur.execute(sql)
+        capabilities[name] = int(cur.fetchone()[0])
+        save_cache('capabilities', capabilities)
+    return capabilities[name]
+
+def get_tuple_widths(conn, cur, cache):
+    # The expensive part of the estimate: average heap and index tuple widths from pg_stats/pg_attribute.
+    # Reused from the cache until it is older than bloat_cache_hours.
+    now = time.time()
+    if cache.get('widths_at', 0) > now - (bloat_cache_hours * 3600):
+        return cache['widths']
+
+    # heap: tuple header (23 bytes + null bitmap, maxaligned) + non-null data width, per table
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"' as table, 'heap', " \
+          "coalesce(substring(array_to_string(c.reloptions, ' ') FROM 'fillfactor=([0-9]+)')::int, 100) as fillfactor, " \
+          "23 + CASE WHEN max(coalesce(s.null_frac, 0)) > 0 THEN (7 + count(*)) / 8 ELSE 0 END as hdr, " \
+          "sum((1 - coalesce(s.null_frac, 0)) * coalesce(s.avg_width, 32)) as datawidth " \
+          "FROM pg_attribute a JOIN pg_class c ON a.attrelid = c.oid JOIN pg_namespace n ON n.oid = c.relnamespace " \
+          "LEFT JOIN pg_stats s ON s.schemaname = n.nspname AND s.tablename = c.relname AND s.attname = a.attname " \
+          "WHERE a.attnum > 0 AND NOT a.attisdropped AND c.relkind in ('r','m') AND n.nspname not in ('pg_catalog', 'pg_toast', 'information_schema') " \
+          "GROUP BY 1, 2, 3 " \
+          "UNION ALL " \
+          "SELECT n.nspname || '.\"' || ic.relname || '\"', 'index:' || tn.nspname || '.\"' || tc.relname || '\"', " \
+          "coalesce(substring(array_to_string(ic.reloptions, ' ') FROM 'fillfactor=([0-9]+)')::int, 90), " \
+          "8 + CASE WHEN max(coalesce(s.null_frac, 0)) > 0 THEN 4 ELSE 0 END, " \
+          "sum((1 - coalesce(s.null_frac, 0)) * coalesce(s.avg_width, 8)) " \
+          "FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid JOIN pg_namespace n ON n.oid = ic.relnamespace JOIN pg_am am ON am.oid = ic.relam " \
+          "JOIN pg_class tc ON tc.oid = i.indrelid JOIN pg_namespace tn ON tn.oid = tc.relnamespace " \
+          "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) " \
+          "LEFT JOIN pg_stats s ON s.schemaname = tn.nspname AND s.tablename = tc.relname AND s.attname = a.attname " \
+          "WHERE am.amname = 'btree' AND tn.nspname not in ('pg_catalog', 'pg_toast', 'information_schema') " \
+          "GROUP BY 1, 2, 3"
+    cur.execute(sql)
+    widths = {}
+    for row in cur.fetchall():
+        # maxalign the header and the whole tuple, then add the 4 byte line pointer
+        hdr = int(math.ceil(float(row[3]) / 8) * 8)
+        width = int(math.ceil((hdr + float(row[4])) / 8) * 8) + 4
+        widths[row[0]] = [row[1], int(row[2]), width]
+    cache['widths'] = widths
+    cache['widths_at'] = now
+    return widths
+
+def estimate_bloat(conn, cur):
+    # Estimated wasted bytes per table and per index.  Statistical estimate from reltuples/relpages and the
+    # cached tuple widths, with heap estimates refined by pgstattuple_approx when the extension is installed.
+    estimates = {}
+    cache = load_cache('bloat')
+    try:
+        widths = get_tuple_widths(conn, cur, cache)
+        sql = "SELECT n.nspname || '.\"' || c.relname || '\"', c.relpages, c.reltuples, current_setting('block_size')::int, c.oid " \
+              "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind in ('r','m','i') AND n.nspname not in ('pg_catalog', 'pg_toast', 'information_schema')"
+        cur.execute(sql)
+        relations = cur.fetchall()
+    except Exception as error:
+        printit("Unable to estimate bloat: %s *** %s" % (type(error), error))
+        return estimates
+
+    heapoids = {}
+    for row in relations:
+        rel, relpages, reltuples, bs, oid = row[0], row[1], max(float(row[2]), 0), row[3], row[4]
+        if rel not in widths or relpages == 0:
+            continue
+        kind, fillfactor, width = widths[rel]
+        tuples_per_page = max(int(((bs - 24) * fillfactor / 100.0) / width), 1)
+        expected = int(math.ceil(reltuples / tuples_per_page))
+        wasted = max(relpages - expected, 0) * bs
+        if kind == 'heap':
+            estimates.setdefault(rel, [0, 0])[0] = wasted
+            heapoids[rel] = (oid, relpages)
+        else:
+            estimates.setdefault(kind[6:], [0, 0])[1] += wasted
+            index_bloat[rel] = wasted
+
+    # refine the largest heap estimates with pgstattuple_approx, reusing cached results while relpages is unchanged
+    if server_capability(conn, cur, 'pgstattuple', "SELECT count(*) FROM pg_extension WHERE extname = 'pgstattuple'") > 0:
+        approx = cache.get('approx', {})
+        now = time.time()
+        candidates = sorted(heapoids.keys(), key=lambda t: estimates[t][0], reverse=True)[:bloat_approx_max]
+        for rel in candidates:
+            oid, relpages = heapoids[rel]
+            cached = approx.get(rel)
+            if cached is None or cached[1] != relpages or cached[2] < now - (bloat_cache_hours * 3600):
+                try:
+                    cur.execute("SELECT (approx_free_space + dead_tuple_len)::bigint FROM pgstattuple_approx(%d)" % oid)
+                    cached = [int(cur.fetchone()[0]), relpages, now]
+                except Exception as error:
+                    printit("pgstattuple_approx failed for %s: %s *** %s" % (rel, type(error), error))
+                    continue
+                approx[rel] = cached
+            estimates[rel][0] = cached[0]
+        cache['approx'] = approx
+
+    save_cache('bloat', cache)
+    return estimates
+
+def order_by_bloat(rows):
+    # order candidates by estimated reclaimable space (heap + index), biggest first
+    if len(bloat) == 0:
+        return rows
+    return sorted(rows, key=lambda row: (policy_rule(row[0]).get('priority', 0), sum(bloat.get(row[0], [0, 0]))), reverse=True)
+
+def get_db_headroom(conn, cur):
+    # returns (xid age, xid limit, mxid age, mxid limit) for the current database.  Limits are where forced autovacuums start.
+    if version >= 90500:
+        sql = "SELECT age(datfrozenxid), current_setting('autovacuum_freeze_max_age')::bigint, mxid_age(datminmxid), current_setting('autovacuum_multixact_freeze_max_age')::bigint " \
+              "FROM pg_database WHERE datname = current_database()"
+    else:
+        sql = "SELECT age(datfrozenxid), current_setting('autovacuum_freeze_max_age')::bigint, 0, 1 FROM pg_database WHERE datname = current_database()"
+    cur.execute(sql)
+    row = cur.fetchone()
+    return (int(row[0]), int(row[1]), int(row[2]), int(row[3]))
+
+def get_emergency_candidates(conn, cur):
+    # every relation, TOAST included, whose xid or mxid age is past the aggressive vacuum threshold, least headroom first
+    if version >= 90500:
+        mxidexpr = "current_setting('autovacuum_multixact_freeze_max_age')::bigint - mxid_age(c.relminmxid)"
+        mxidfilter = "OR mxid_age(c.relminmxid) > current_setting('vacuum_multixact_freeze_table_age')::bigint"
+    else:
+        mxidexpr = "2147483647"
+        mxidfilter = ""
+    if schema == "":
+        schemafilter = "n.nspname not in ('information_schema')"
+    else:
+        # the schema's tables and their TOAST tables
+        schemafilter = "(n.nspname = '%s' OR c.oid in (SELECT t.reltoastrelid FROM pg_class t JOIN pg_namespace tn ON tn.oid = t.relnamespace WHERE tn.nspname = '%s'))" % (schema, schema)
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"' as table, c.relkind, pg_total_relation_size(c.oid) as size, pg_size_pretty(pg_total_relation_size(c.oid)), " \
+          "current_setting('autovacuum_freeze_max_age')::bigint - age(c.relfrozenxid) as xid_headroom, %s as mxid_headroom " \
+          "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind in ('r','m','t') AND %s " \
+          "AND (age(c.relfrozenxid) > current_setting('vacuum_freeze_table_age')::bigint %s) " \
+          "ORDER BY least(current_setting('autovacuum_freeze_max_age')::bigint - age(c.relfrozenxid), %s), 1" % (mxidexpr, schemafilter, mxidfilter, mxidexpr)
+    cur.execute(sql)
+    return cur.fetchall()
+
+def freeze_candidates_sql():
+    # Tables within threshold_freeze of their nearest wraparound limit: heap xid age and TOAST xid age against the (per-table)
+    # freeze max age, mxid age against autovacuum_multixact_freeze_max_age.  age, max_age and howclose are those of the nearest limit.
+    if version > 100000:
+        partexpr = "c.relispartition"
+    else:
+        partexpr = "CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False'::boolean ELSE 'True'::boolean END"
+    if version >= 90500:
+        mxidage = "mxid_age(c.relminmxid)::bigint"
+    else:
+        mxidage = "0::bigint"
+    if schema == "":
+        schemafilter = "n.nspname not in ('pg_catalog', 'pg_toast', 'information_schema')"
+    else:
+        schemafilter = "n.nspname = '%s'" % schema
+    tables = "SELECT n.nspname || '.\"' || c.relname || '\"' as tablename, c.reltuples::bigint as reltuples, pg_size_pretty(pg_total_relation_size(c.oid)) as sizep, " \
+             "pg_total_relation_size(c.oid) as size, %s as partitioned, age(c.relfrozenxid)::bigint as xid_age, age(t.relfrozenxid)::bigint as toast_age, " \
+             "%s as mxid_age, %s as freeze_max, current_setting('autovacuum_multixact_freeze_max_age')::bigint as mxid_max, " \
+             "CASE WHEN t.oid IS NULL THEN NULL ELSE 'pg_toast.\"' || t.relname || '\"' END as toast " \
+             "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace LEFT JOIN pg_class t ON t.oid = c.reltoastrelid " \
+             "WHERE %s AND c.relkind not in ('i','v','S','c')" % (partexpr, mxidage, freeze_max_age_expr(), schemafilter)
+    nearest = "SELECT *, CASE WHEN mxid_age::float8 / mxid_max > greatest(xid_age, coalesce(toast_age, 0))::float8 / freeze_max THEN 'mxid' " \
+              "WHEN coalesce(toast_age, 0) > xid_age THEN 'toast' ELSE 'xid' END as nearest FROM (%s) s" % tables
+    limits = "SELECT tablename, reltuples, CASE nearest WHEN 'mxid' THEN mxid_age WHEN 'toast' THEN toast_age ELSE xid_age END as age, " \
+             "CASE nearest WHEN 'mxid' THEN mxid_max ELSE freeze_max END as max_age, sizep, size, partitioned, nearest, toast, freeze_max - toast_age as toast_headroom, freeze_max - xid_age as xid_headroom " \
+             "FROM (%s) m" % nearest
+    return "SELECT tablename, reltuples, age, max_age, max_age - age as howclose, sizep, size, partitioned, nearest, toast, toast_headroom, xid_headroom FROM (%s) l " \
+           "WHERE max_age - age > 1 AND max_age - age < %d ORDER BY age::float8 / max_age DESC LIMIT 60" % (limits, threshold_freeze)
+
+def freeze_cmd(table, nearest, toast, toast_headroom, xid_headroom):
+    # cheapest command that clears the nearest limit, and the setting it needs ('' if none).  Heap and TOAST are frozen together
+    # when both are close.
+    if nearest == 'mxid':
+        # an aggressive vacuum advances relminmxid (and relfrozenxid) without freezing every tuple like FREEZE does
+        return ("VACUUM VERBOSE %s" % table, 'vacuum_multixact_freeze_table_age=0')
+    if nearest == 'toast' and xid_headroom >= threshold_freeze:
+        if version >= 160000:
+            return ("VACUUM (FREEZE, VERBOSE, PROCESS_MAIN FALSE) %s" % table, '')
+        return ("VACUUM (FREEZE, VERBOSE) %s" % toast, '')
+    if version >= 140000 and toast is not None and toast_headroom >= threshold_freeze:
+        return ("VACUUM (FREEZE, VERBOSE, PROCESS_TOAST FALSE) %s" % table, '')
+    return ("VACUUM (FREEZE, VERBOSE) %s" % table, '')
+
+def get_horizon_blockers(conn, cur):
+    # What holds back the oldest xmin of this database, oldest first: (kind, name, xid age, detail, holds back user tables).
+    # Logical slots only hold back the catalogs (catalog_xmin), vacuums are ignored by the horizon.
+    sql = "SELECT 'prepared xact', gid, age(transaction)::bigint, 'prepared ' || prepared::text || ' by ' || owner::text, true " \
+          "FROM pg_prepared_xacts WHERE database = current_database()"
+    if version >= 90400:
+        sql = sql + " UNION ALL SELECT 'replication slot', slot_name::text, age(xmin)::bigint, slot_type || CASE WHEN active THEN ' active' ELSE ' inactive' END, true " \
+                    "FROM pg_replication_slots WHERE xmin IS NOT NULL" \
+                    " UNION ALL SELECT 'replication slot', slot_name::text, age(catalog_xmin)::bigint, slot_type || CASE WHEN active THEN ' active' ELSE ' inactive' END, false " \
+                    "FROM pg_replication_slots WHERE catalog_xmin IS NOT NULL" \
+                    " UNION ALL SELECT 'backend', pid::text, age(backend_xmin)::bigint, coalesce(usename::text, '') || ' ' || coalesce(application_name, '') || ' ' || " \
+                    "coalesce(state, '') || ' xact since ' || coalesce(xact_start::text, '-'), true FROM pg_stat_activity WHERE backend_xmin IS NOT NULL " \
+                    "AND pid <> pg_backend_pid() AND (datname = current_database() OR datname IS NULL) AND coalesce(query, '') !~* '^(autovacuum: )?vacuum'"
+    cur.execute(sql + " ORDER BY 3 DESC")
+    return cur.fetchall()
+
+def check_horizon(conn, cur, report=False):
+    global horizon_age, horizon_checked
+    horizon_checked = time.time()
+    try:
+        blockers = get_horizon_blockers(conn, cur)
+    except Exception as error:
+        printit("Unable to check the xmin horizon: %s *** %s" % (type(error), error))
+        horizon_age = 0
+        return
+    horizon_age = max([b[2] for b in blockers if b[4]] + [0])
+    if not report:
+        return
+    cur.execute("SELECT age(datfrozenxid) FROM pg_database WHERE datname = current_database()")
+    printit ("Database xid age: %d  Oldest xmin needed by user tables: %d xids old" % (cur.fetchone()[0], horizon_age))
+    for kind, name, age, detail, holds in blockers:
+        if age >= horizon_warn_age:
+            printit ("Horizon blocker: %-16s %-30s xid age: %11d  %s%s" % (kind, name, age, detail, '' if holds else '  (catalogs only)'), level='WARNING')
+
+def freeze_blocked(conn, cur, table, xidage):
+    # a freeze can move relfrozenxid up to the horizon at most, so it is suspended when that gains less than horizon_min_gain xids
+    global freezes_suspended
+    if time.time() - horizon_checked > horizon_check_secs:
+        check_horizon(conn, cur)
+    if xidage - horizon_age >= horizon_min_gain:
+        return False
+    printit ("Freeze of %s suspended: xid age %d but the horizon is held back %d xids.  See the horizon blockers." % (table, xidage, horizon_age), level='WARNING')
+    freezes_suspended = freezes_suspended + 1
+    return True
+
+def emergency_freeze(conn, cur):
+    # Fastest path to wraparound safety: no cost delay, no index cleanup (PG12+), as many tables at once as threshold_max_processes allows.
+    # Headroom is recomputed after every round until the database is out of forced autovacuum territory.
+    global total_freezes, asyncjobs
+    if version >= 120000:
+        sql_template = "VACUUM (FREEZE, VERBOSE, INDEX_CLEANUP FALSE) %s"
+    else:
+        sql_template = "VACUUM (FREEZE, VERBOSE) %s"
+    if not dryrun:
+        cur.execute("SET vacuum_cost_delay = 0")
+    dispatched = set()
+    rounds = 0
+    while True:
+        rounds = rounds + 1
+        xidage, xidmax, mxidage, mxidmax = get_db_headroom(conn, cur)
+        printit ("Emergency round %d: xid age: %d/%d (headroom %d)  mxid age: %d/%d (headroom %d)" % (rounds, xidage, xidmax, xidmax - xidage, mxidage, mxidmax, mxidmax - mxidage))
+        if xidage < xidmax and mxidage < mxidmax:
+            printit ("Database is below the forced autovacuum thresholds again.  Emergency mode complete.")
+            break
+        if rounds > emergency_max_rounds:
+            printit ("Emergency mode giving up after %d rounds.  Database is still not safe!" % emergency_max_rounds)
+            break
+
+        candidates = get_emergency_candidates(conn, cur)
+        # A dispatched relation still past the threshold whose job is no longer running was skipped as locked (SKIP_LOCKED)
+        # or failed, so it is dispatched again.
+        try:
+            active = [row[1] for row in owned_jobs(cur)]
+        except Exception as error:
+            printit("Unable to check running emergency jobs: %s *** %s" % (type(error), error))
+            active = None
+        if active is not None and not dryrun:
+            for row in candidates:
+                if row[0] in dispatched and len([q for q in active if row[0] in q]) == 0:
+                    printit ("%s is still past the freeze threshold and its job ended.  Dispatching it again." % row[0], level='WARNING')
+                    dispatched.discard(row[0])
+        rows = [row for row in candidates if row[0] not in dispatched]
+        running = get_query_cnt(conn, cur)
+        if len(rows) == 0:
+            if running == 0 or dryrun:
+                printit ("No more relations can be frozen, but the database is still not safe.  Check for xmin horizon blockers.")
+                break
+            time.sleep(emergency_poll)
+            continue
+
+        blocked = False
+        for row in rows:
+            table, relkind, size, sizep, xidroom, mxidroom = row
+            if running >= threshold_max_processes:
+                break
+            # v5.5: past the horizon no freeze gains anything, so emergency mode stops and says what holds it back.
+            # Relations nearest their multixact limit are not held back by it.
+            if xidroom <= mxidroom and freeze_blocked(conn, cur, table, xidmax - xidroom):
+                printit ("Emergency mode stopped: the xmin horizon keeps freezes from advancing.  Resolve these blockers first:", level='ERROR')
+                check_horizon(conn, cur, report=True)
+                blocked = True
+                break
+            sql = sql_template % table
+            dispatched.add(table)
+            total_freezes = total_freezes + 1
+            if size < threshold_min_size:
+                printit ("Sync  %13s: %-57s kind: %s size: %10s :%13d xid headroom: %11d  mxid headroom: %11d" % ('EMERGENCY', table, relkind, sizep, size, xidroom, mxidroom))
+                if dryrun:
+                    continue
+                if run_sync(conn, cur, sql, table, requeue=False, size=size) == LOCKED:
+                    dispatched.discard(table)
+            else:
+                printit ("Async %13s: %-57s kind: %s size: %10s :%13d xid headroom: %11d  mxid headroom: %11d" % ('EMERGENCY', table, relkind, sizep, size, xidroom, mxidroom))
+                running = running + 1
+                if dryrun:
+                    continue
+                if run_async(conn, cur, sql, table, pgoptions='-c vacuum_cost_delay=0', requeue=False, size=size) == LOCKED:
+                    dispatched.discard(table)
+                    continue
+                asyncjobs = asyncjobs + 1
+
+        if blocked:
+            break
+        if dryrun:
+            printit ("Dry run: %d relations would be frozen in emergency mode." % len(dispatched))
+            break
+        time.sleep(emergency_poll)
+
+def get_locked_tables(conn, cur):
+    # tables other sessions hold (or wait on) locks for that conflict with the SHARE UPDATE EXCLUSIVE lock VACUUM and ANALYZE need
+    sql = "SELECT DISTINCT n.nspname || '.\"' || c.relname || '\"' FROM pg_locks l JOIN pg_class c ON c.oid = l.relation JOIN pg_namespace n ON n.oid = c.relnamespace " \
+          "WHERE l.locktype = 'relation' AND l.pid != pg_backend_pid() " \
+          "AND l.mode in ('ShareUpdateExclusiveLock', 'ShareLock', 'ShareRowExclusiveLock', 'ExclusiveLock', 'AccessExclusiveLock')"
+    try:
+        cur.execute(sql)
+    except Exception as error:
+        printit("Unable to check for locked tables: %s *** %s" % (type(error), error))
+        return set()
+    return set([row[0] for row in cur.fetchall()])
+
+def table_is_locked(conn, cur, table, force=False):
+    # pg_locks is only queried every lock_refresh_secs, not for every table
+    global locked_tables, locks_checked
+    if force or time.time() - locks_checked > lock_refresh_secs:
+        locked_tables = get_locked_tables(conn, cur)
+        locks_checked = time.time()
+    return table in locked_tables
+
+def job_key(sql, table):
+    # the relation a job is done for: the index of a reindex, the table otherwise.  Indexes and tables share a namespace.
+    m = re.match(r'^REINDEX INDEX (CONCURRENTLY )?(.*)$', sql)
+    if m is not None:
+        return m.group(2)
+    return table
+
+def requeue_locked(sql, table, mode, pgoptions, size):
+    key = job_key(sql, table)
+    if key in lock_requeue_set:
+        return
+    printit ("NOTICE: %s is locked by another session.  Requeued for later: %s" % (table, sql), level='WARNING',
+             table=table, action=sql.split(' ')[0], phase=action_name, size=size, reason='locked')
+    lock_requeue.append((sql, table, mode, pgoptions, size))
+    lock_requeue_set.add(key)
+
+def add_vacuum_option(sql, option):
+    # VACUUM VERBOSE t --> VACUUM (OPTION, VERBOSE) t,  VACUUM (FREEZE, VERBOSE) t --> VACUUM (OPTION, FREEZE, VERBOSE) t
+    m = re.match(r'^(VACUUM|ANALYZE) (\(([^)]*)\)|VERBOSE) (.*)$', sql)
+    if m is None:
+        return sql
+    if m.group(3) is not None:
+        opts = m.group(3)
+    else:
+        opts = 'VERBOSE'
+    return '%s (%s, %s) %s' % (m.group(1), option, opts, m.group(4))
+
+def get_wal_lsn(conn, cur):
+    if version >= 100000:
+        cur.execute("SELECT pg_current_wal_lsn()")
+    else:
+        cur.execute("SELECT pg_current_xlog_location()")
+    return cur.fetchone()[0]
+
+def get_wal_bytes(conn, cur, since):
+    # WAL written since the given position.  Includes WAL from other sessions, so per-job numbers are approximate on busy servers.
+    if version >= 100000:
+        cur.execute("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), %s)::bigint", (since,))
+    else:
+        cur.execute("SELECT pg_xlog_location_diff(pg_current_xlog_location(), %s)::bigint", (since,))
+    return int(cur.fetchone()[0])
+
+def get_replication_lag(conn, cur):
+    # returns (max lag seconds, max bytes not yet replayed, max bytes not yet sent, replica count)
+    if version >= 100000:
+        sql = "SELECT coalesce(max(extract(epoch from greatest(write_lag, flush_lag, replay_lag))), 0), coalesce(max(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)), 0), " \
+              "coalesce(max(pg_wal_lsn_diff(pg_current_wal_lsn(), sent_lsn)), 0), count(*) FROM pg_stat_replication"
+    else:
+        sql = "SELECT 0, coalesce(max(pg_xlog_location_diff(pg_current_xlog_location(), replay_location)), 0), " \
+              "coalesce(max(pg_xlog_location_diff(pg_current_xlog_location(), sent_location)), 0), count(*) FROM pg_stat_replication"
+    cur.execute(sql)
+    row = cur.fetchone()
+    return (float(row[0]), int(row[1]), int(row[2]), int(row[3]))
+
+def replicas_lagging(lag):
+    return lag[0] > replica_max_lag or lag[1] > replica_max_lag_bytes
+
+def throttle_for_replicas(conn, cur):
+    # Sampled every replica_check_secs.  While replicas are beyond the ceiling: halve concurrency, raise the cost delay and pause
+    # new work until they catch up.  Once they are under half the ceiling, concurrency and cost settings are restored.
+    global replica_checked, replica_throttled, threshold_max_processes
+    if replica_max_lag == -1 or time.time() - replica_checked < replica_check_secs:
+        return
+    replica_checked = time.time()
+    try:
+        lag = get_replication_lag(conn, cur)
+    except Exception as error:
+        printit("Unable to sample replication lag: %s *** %s" % (type(error), error))
+        return
+    if lag[3] == 0:
+        return
+    if replicas_lagging(lag):
+        # halved once from the configured limit, not again on every lagging sample
+        threshold_max_processes = max(int(base_max_processes / 2), 1)
+        if not replica_throttled:
+            cur.execute("SET vacuum_cost_delay = %d" % replica_cost_delay)
+            replica_throttled = True
+        printit ("Replica lag: %.1f secs  replay bytes: %d  unsent bytes: %d.  Throttling to %d processes and pausing new work..." % (lag[0], lag[1], lag[2], threshold_max_processes))
+        waited = 0
+        while replicas_lagging(lag) and waited < replica_max_wait:
+            time.sleep(replica_check_secs)
+            waited = waited + replica_check_secs
+            try:
+                lag = get_replication_lag(conn, cur)
+            except Exception as error:
+                printit("Unable to sample replication lag: %s *** %s" % (type(error), error))
+                break
+        printit ("Replica lag now: %.1f secs  replay bytes: %d  after waiting %d secs." % (lag[0], lag[1], waited))
+    elif replica_throttled and lag[0] < replica_max_lag / 2.0 and lag[1] < replica_max_lag_bytes / 2:
+        threshold_max_processes = base_max_processes
+        cur.execute("RESET vacuum_cost_delay")
+        replica_throttled = False
+        printit ("Replica lag: %.1f secs  replay bytes: %d.  Throttling lifted, max processes back to %d." % (lag[0], lag[1], threshold_max_processes))
+
+def get_autovacuum_state(conn, cur):
+    # returns (tables autovacuum workers are vacuuming now, tables over their autovacuum threshold that a worker will pick up next)
+    if version >= 90600:
+        sql = "SELECT n.nspname || '.\"' || c.relname || '\"' FROM pg_stat_progress_vacuum p JOIN pg_stat_activity a ON a.pid = p.pid " \
+              "JOIN pg_class c ON c.oid = p.relid JOIN pg_namespace n ON n.oid = c.relnamespace WHERE a.query LIKE 'autovacuum:%'"
+        cur.execute(sql)
+        active = set([row[0] for row in cur.fetchall()])
+    else:
+        cur.execute("SELECT query FROM pg_stat_activity WHERE query LIKE 'autovacuum: VACUUM%'")
+        active = set()
+        for row in cur.fetchall():
+            m = re.match(r'^autovacuum: VACUUM (ANALYZE )?(\S+)', row[0])
+            if m is not None:
+                active.add(quote_table(m.group(2)))
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"' FROM pg_stat_user_tables u JOIN pg_class c ON c.oid = u.relid JOIN pg_namespace n ON n.oid = c.relnamespace " \
+          "WHERE current_setting('autovacuum') = 'on' AND coalesce(array_to_string(c.reloptions, ' ') NOT LIKE '%%autovacuum_enabled=f%%', true) AND u.n_dead_tup > %s" % av_threshold_expr()
+    cur.execute(sql)
+    expected = set([row[0] for row in cur.fetchall()])
+    return active, expected
+
+def is_plain_vacuum(sql, table):
+    # only plain vacuums overlap autovacuum's work, freezes and analyzes are never deferred
+    command = sql.rsplit(table, 1)[0]
+    return command.startswith('VACUUM') and 'FREEZE' not in command
+
+def autovacuum_conflict(conn, cur, sql, table, mode, pgoptions, size, defer=True):
+    # True if the vacuum should not run now: autovacuum is already on the table (skipped), or is about to take it (deferred)
+    global av_active, av_expected, av_checked, av_skipped
+    if not avaware or not is_plain_vacuum(sql, table):
+        return False
+    if time.time() - av_checked > lock_refresh_secs:
+        try:
+            av_active, av_expected = get_autovacuum_state(conn, cur)
+        except Exception as error:
+            printit("Unable to check autovacuum activity: %s *** %s" % (type(error), error))
+            av_active, av_expected = set(), set()
+        av_checked = time.time()
+    if table in av_active:
+        printit ("NOTICE: %s is being vacuumed by autovacuum.  Skipped: %s" % (table, sql), table=table, action='VACUUM', phase=action_name, size=size, reason='autovacuum')
+        av_skipped = av_skipped + 1
+        return True
+    if defer and table in av_expected:
+        printit ("NOTICE: %s is over its autovacuum threshold.  Deferred to the end of the run: %s" % (table, sql), table=table, action='VACUUM', phase=action_name, size=size, reason='autovacuum')
+        av_deferred.append((sql, table, mode, pgoptions, size))
+        return True
+    return False
+
+def run_av_deferred(conn, cur):
+    # vacuum the deferred tables autovacuum did not get to while the rest of the run was processed
+    global av_checked, av_skipped
+    if len(av_deferred) == 0:
+        return
+    pending = [job[1] for job in av_deferred]
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"' FROM pg_stat_user_tables u JOIN pg_class c ON c.oid = u.relid JOIN pg_namespace n ON n.oid = c.relnamespace " \
+          "WHERE u.last_autovacuum > to_timestamp(%d)" % int(run_started)
+    try:
+        cur.execute(sql)
+        done = set([row[0] for row in cur.fetchall()])
+    except Exception as error:
+        printit("Unable to check autovacuum activity: %s *** %s" % (type(error), error))
+        done = set()
+    av_checked = 0
+    handled = 0
+    for sql, table, mode, pgoptions, size in av_deferred:
+        if table in done:
+            handled = handled + 1
+            continue
+        if mode == 'async':
+            rc = run_async(conn, cur, sql, table, pgoptions, size=size, avdefer=False)
+        else:
+            rc = run_sync(conn, cur, sql, table, size=size, avdefer=False, pgoptions=pgoptions)
+    av_skipped = av_skipped + handled
+    printit ("Deferred vacuums: %d  handled by autovacuum: %d" % (len(pending), handled))
+
+def setup_leases(conn, cur):
+    # unlogged since leases are worthless after a crash, and expired leases are purged by whoever starts next
+    cur.execute("CREATE UNLOGGED TABLE IF NOT EXISTS %s (tablename text PRIMARY KEY, owner text NOT NULL, expires timestamptz NOT NULL)" % lease_table)
+    cur.execute("DELETE FROM %s WHERE expires < now()" % lease_table)
+
+def acquire_lease(conn, cur, table, size=-1):
+    # True if this worker holds the lease on the table.  Leases of other workers are honored until they expire.
+    global leases_held, leases_lost
+    if not distributed or dryrun:
+        return True
+    sql = "INSERT INTO %s AS l (tablename, owner, expires) VALUES (%%s, %%s, now() + interval '%d seconds') " \
+          "ON CONFLICT (tablename) DO UPDATE SET owner = EXCLUDED.owner, expires = EXCLUDED.expires WHERE l.expires < now() OR l.owner = EXCLUDED.owner " \
+          "RETURNING owner" % (lease_table, lease_secs)
+    try:
+        cur.execute(sql, (table, worker_id))
+        row = cur.fetchone()
+    except Exception as error:
+        printit("Unable to take lease on %s, processing it anyway: %s *** %s" % (table, type(error), error), level='WARNING')
+        return True
+    if row is None:
+        printit ("NOTICE: %s is leased by another pg_vacuum worker.  Skipped." % table, table=table, phase=action_name, size=size, reason='leased')
+        leases_lost = leases_lost + 1
+        return False
+    leases_held = leases_held + 1
+    return True
+
+def journal_file():
+    return os.path.join(workdir, 'journal_%s_%d_%s.jsonl' % (file_host(), dbport, dbname))
+
+def journal_write(event, **fields):
+    # flushed per line so the journal survives a kill
+    if journal is None:
+        return
+    fields.update(ts=round(time.time(), 3), run=run_id, event=event)
+    try:
+        journal.write(json.dumps(fields) + '\n')
+        journal.flush()
+    except Exception as error:
+        printit("Unable to write the journal: %s *** %s" % (type(error), error))
+
+def open_journal(done):
+    # a new run starts a new journal, carrying over the tables a resumed run had already finished
+    global journal
+    try:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        journal = open(journal_file(), 'w')
+    except Exception as error:
+        printit("Unable to open the journal, this run will not be resumable: %s *** %s" % (type(error), error))
+        return
+    journal_write('start', pid=os.getpid())
+    for table in sorted(done):
+        journal_write('done', table=table, carried=True)
+
+def close_journal():
+    global journal
+    if journal is None:
+        return
+    journal_write('end')
+    journal.close()
+    journal = None
+
+def journal_relation(table, key):
+    # a reindex also records its index, the key it is journaled by
+    if key == table:
+        return {'table': table}
+    return {'table': table, 'index': key}
+
+def journal_key(event):
+    # reindexes are journaled per index, every other job per table
+    return event.get('index') or event['table']
+
+def read_journal():
+    # returns (finished tables, unfinished dispatch events in dispatch order) of the last run, or None if it ended normally
+    try:
+        with open(journal_file(), 'r') as f:
+            lines = f.read().splitlines()
+    except Exception:
+        return None
+    events = []
+    for line in lines:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            # a kill can leave a partial last line
+            continue
+    if len(events) == 0 or events[-1]['event'] == 'end':
+        return None
+    done = set([journal_key(e) for e in events if e['event'] == 'done'])
+    pending = []
+    seen = set()
+    for e in reversed(events):
+        if e['event'] == 'dispatch' and journal_key(e) not in done and journal_key(e) not in seen:
+            seen.add(journal_key(e))
+            pending.insert(0, e)
+    return done, pending
+
+def resume_run(conn, cur):
+    # Sync jobs journal their completion.  Async jobs cannot, so they count as finished if the table was vacuumed or analyzed
+    # after they were dispatched, or a pg_vacuum session is still working on it.  Returns the number of async jobs dispatched again.
+    previous = read_journal()
+    if previous is None:
+        printit ("Nothing to resume: the last run ended normally or left no journal.")
+        if not dryrun:
+            open_journal(set())
+        return 0
+    done, pending = previous
+    try:
+        cur.execute("SELECT schemaname || '.\"' || relname || '\"', extract(epoch from greatest(last_vacuum, last_autovacuum, last_analyze, last_autoanalyze)) FROM pg_stat_user_tables")
+        lastdone = dict([(row[0], float(row[1] or 0)) for row in cur.fetchall()])
+        cur.execute("SELECT query FROM pg_stat_activity WHERE application_name like 'pg_vacuum%' AND pid != pg_backend_pid()")
+        running = [row[0] for row in cur.fetchall()]
+    except Exception as error:
+        printit("Unable to check unfinished jobs, redoing all of them: %s *** %s" % (type(error), error))
+        lastdone, running = {}, []
+    redo = []
+    for job in pending:
+        key = journal_key(job)
+        # vacuum and analyze times say nothing about a reindex
+        if ('index' not in job and lastdone.get(job['table'], 0) > job['ts']) or (job['mode'] == 'async' and len([q for q in running if key in q]) > 0):
+            done.add(key)
+        else:
+            redo.append(job)
+    printit ("Resuming run %s: %d tables finished, %d unfinished jobs to dispatch again." % (pending[0]['run'] if pending else '', len(done), len(redo)))
+    for table in done:
+        tablist.add(table)
+    if not dryrun:
+        open_journal(done)
+    resumed = 0
+    for job in redo:
+        tablist.add(journal_key(job))
+        if dryrun:
+            printit ("Resume: would dispatch %s again: %s" % (job['mode'], job['sql']))
+        elif job['mode'] == 'async':
+            if run_async(conn, cur, job['sql'], job['table'], job.get('pgoptions', ''), size=job.get('size', -1)) == OK:
+                resumed = resumed + 1
+        else:
+            run_sync(conn, cur, job['sql'], job['table'], size=job.get('size', -1), pgoptions=job.get('pgoptions', ''))
+    return resumed
+
+def load_driver():
+    # v5.8: the driver is the slowest import here, so it is loaded only when a connection is about to be made
+    global psycopg2
+    if psycopg2 is not None:
+        return
+    import psycopg2.extensions, psycopg2.extras
+    # queries wait in select() so the signal handlers run even during a long sync job
+    psycopg2.extensions.set_wait_callback(psycopg2.extras.wait_select)
+
+def job_dsn(appname):
+    # connstr plus an application_name.  URIs and service names need make_dsn (psycopg2 2.7+), older drivers only take key=value strings.
+    try:
+        return psycopg2.extensions.make_dsn(connstr, application_name=appname, connect_timeout=connect_timeout)
+    except AttributeError:
+        return "%s application_name=%s connect_timeout=%d" % (connstr, appname, connect_timeout)
+
+def db_connect(appname):
+    # one connection in autocommit mode, retried with exponential backoff
+    load_driver()
+    delay = reconnect_backoff
+    for attempt in range(reconnect_retries + 1):
+        try:
+            conn = psycopg2.connect(job_dsn(appname))
+            conn.set_isolation_level(0)
+            return conn
+        except psycopg2.OperationalError as error:
+            if attempt == reconnect_retries:
+                raise
+            printit ("Connection failed: %s  Retrying in %d secs..." % (str(error).strip(), delay), level='WARNING')
+            time.sleep(delay)
+            delay = delay * 2
+
+class Session(object):
+    # Stands in for both the connection and its cursor.  When the connection is lost, it reconnects, restores the session state
+    # (SET parameters and advisory locks) and runs the statement again, so a failover or network blip does not end the run.
+    def __init__(self, appname):
+        self.appname = appname
+        self.state   = []
+        self.conn    = db_connect(appname)
+        self.cur     = self.conn.cursor()
+
+    def remember(self, sql, params=None, required=False):
+        # replayed after a reconnect.  A required statement must return true, like pg_try_advisory_lock.
+        self.state.append((None, sql, params, required))
+
+    def reconnect(self):
+        global main_pid
+        printit ("Connection lost.  Reconnecting...", level='WARNING')
+        try:
+            self.conn.close()
+        except Exception:
+            pass
+        self.conn = db_connect(self.appname)
+        self.cur  = self.conn.cursor()
+        for key, sql, params, required in self.state:
+            self.cur.execute(sql, params)
+            if required and not self.cur.fetchone()[0]:
+                raise psycopg2.OperationalError("session state not restored after reconnect: %s" % sql)
+        self.cur.execute("SELECT pg_backend_pid()")
+        main_pid = self.cur.fetchone()[0]
+        printit ("Reconnected.  %d session settings restored." % len(self.state), level='WARNING')
+
+    def execute(self, sql, params=None):
+        try:
+            self.cur.execute(sql, params)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if not self.conn.closed:
+                raise
+            self.reconnect()
+            self.cur.execute(sql, params)
+        # keep the latest SET of each parameter, a RESET forgets it
+        match = re.match(r'(SET|RESET) (\w+)', sql, re.IGNORECASE)
+        if match is not None:
+            name = match.group(2).lower()
+            self.state = [s for s in self.state if s[0] != name]
+            if match.group(1).upper() == 'SET':
+                self.state.append((name, sql, params, False))
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def cursor(self):
+        return self
+
+    def close(self):
+        self.conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+def owned_jobs(cur):
+    # backends working for this run: its async jobs, jobs it adopted, and a sync job on its own session
+    sql = "SELECT pid, query FROM pg_stat_activity WHERE state = 'active' AND (query like 'VACUUM%%' OR query like 'ANALYZE%%' OR query like 'REINDEX%%') " \
+          "AND (application_name = %s OR pid = ANY(%s))"
+    cur.execute(sql, (job_app_name, list(owned_pids | set([main_pid]))))
+    return cur.fetchall()
+
+def shutdown(signum):
+    # Runs from the signal handler, possibly while our own session is busy with a sync job, so it works on a connection of its own.
+    # Jobs get shutdown_grace seconds to finish, then they are cancelled.  The journal is not closed, so the run can be resumed.
+    printit ("Signal %d received.  No new jobs will be dispatched, draining this run's jobs for up to %d secs..." % (signum, shutdown_grace), level='WARNING')
+    journal_write('interrupted', signal=signum)
+    try:
+        sconn = db_connect('pg_vacuum')
+        scur = sconn.cursor()
+        jobs = owned_jobs(scur)
+        waited = 0
+        while len(jobs) > 0 and waited < shutdown_grace:
+            time.sleep(min(5, shutdown_grace - waited))
+            waited = waited + 5
+            jobs = owned_jobs(scur)
+        for pid, query in jobs:
+            scur.execute("SELECT pg_cancel_backend(%s)", (pid,))
+            printit ("Cancelled backend %d: %s" % (pid, query), level='WARNING')
+        sconn.close()
+        printit ("Shutdown complete: %d jobs cancelled after %d secs." % (len(jobs), min(waited, shutdown_grace)), level='WARNING')
+    except Exception as error:
+        printit("Unable to drain jobs on shutdown: %s *** %s" % (type(error), error), level='ERROR')
+
+def adopt_orphans(conn, cur):
+    # Jobs of a run that is gone keep running.  They are counted against max processes and their tables are not done again.
+    sql = "SELECT pid, application_name, query FROM pg_stat_activity WHERE state = 'active' AND application_name like 'pg_vacuum_job_%%' " \
+          "AND application_name != '%s' AND (query like 'VACUUM%%' OR query like 'ANALYZE%%' OR query like 'REINDEX%%')" % job_app_name
+    cur.execute(sql)
+    adopted = 0
+    for pid, appname, query in cur.fetchall():
+        owner = appname[len('pg_vacuum_job_'):]
+        cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (owner,))
+        if not cur.fetchone()[0]:
+            # the run that started it is still alive
+            continue
+        cur.execute("SELECT pg_advisory_unlock(hashtext(%s))", (owner,))
+        # "My"."t" in the query is My."t" in tablist
+        m = re.search(r'(\S+\."[^"]*")', query)
+        table = quote_table(m.group(1)) if m is not None else ''
+        owned_pids.add(pid)
+        if table != '':
+            tablist.add(table)
+            journal_write('dispatch', table=table, sql=query, mode='async', pgoptions='', size=-1, phase='ADOPTED')
+        printit ("Adopted job %d of run %s: %s" % (pid, owner, query))
+        adopted = adopted + 1
+    return adopted
+
+def get_partitions(conn, cur, table):
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"' FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_namespace n ON n.oid = c.relnamespace " \
+          "WHERE i.inhparent = %s::regclass ORDER BY 1"
+    cur.execute(sql, (table,))
+    return [row[0] for row in cur.fetchall()]
+
+def run_fallback(conn, cur, sql, table, size, pgoptions=''):
+    # A vacuum that ran out of time is retried the cheaper way: a partitioned table one partition at a time, any other table
+    # without index cleanup, then also without truncating the tail.  Each retry gets a budget of its own.
+    if not sql.startswith('VACUUM'):
+        return BAD
+    try:
+        partitions = get_partitions(conn, cur, table)
+    except Exception:
+        partitions = []
+    if len(partitions) > 0:
+        printit ("Fallback: vacuuming the %d partitions of %s one at a time." % (len(partitions), table), table=table, action='VACUUM', phase=action_name, reason='partitions')
+        record_job(table, sql, 0, 'fallback', 'partitions')
+        rc = OK
+        for partition in partitions:
+            if run_sync(conn, cur, sql.rsplit(table, 1)[0] + partition, partition, avdefer=False, pgoptions=pgoptions) != OK:
+                rc = BAD
+        return rc
+    if version >= 120000:
+        m = re.match(r'^VACUUM \(([^)]*)\)', sql)
+        present = [o.strip().split()[0].upper() for o in m.group(1).split(',')] if m is not None else []
+        for option in ['INDEX_CLEANUP OFF', 'TRUNCATE OFF']:
+            if option.split()[0] in present:
+                continue
+            newsql = add_vacuum_option(sql, option)
+            if newsql == sql:
+                # not a form the option can be added to
+                break
+            printit ("Fallback: retrying with %s: %s" % (option, newsql), table=table, action='VACUUM', phase=action_name, reason=option)
+            record_job(table, sql, 0, 'fallback', option)
+            return run_sync(conn, cur, newsql, table, size=size, avdefer=False, pgoptions=pgoptions)
+    printit ("NOTICE: no cheaper strategy left for %s.  Do it manually." % table, level='WARNING', table=table, action='VACUUM', phase=action_name)
+    return BAD
+
+def reset_timeouts(cur):
+    # back to the run's lock_timeout and no statement_timeout after a job that changed them
+    cur.execute("RESET statement_timeout")
+    if lock_timeout > 0 and version >= 90300:
+        cur.execute("SET lock_timeout = '%ds'" % lock_timeout)
+    else:
+        cur.execute("RESET lock_timeout")
+
+def pgoptions_settings(pgoptions):
+    # the (name, value) pairs of a PGOPTIONS string like '-c name=value -c name=value'
+    words = pgoptions.split()
+    return [tuple(words[i + 1].split('=', 1)) for i, word in enumerate(words) if word == '-c' and i + 1 < len(words) and '=' in words[i + 1]]
+
+def reset_settings(cur, settings):
+    for name, value in settings:
+        cur.execute("RESET %s" % name)
+
+def run_sync(conn, cur, sql, table, requeue=True, size=-1, avdefer=True, pgoptions=''):
+    # returns OK, BAD, LOCKED if the table was locked by someone else (and requeued) or left to autovacuum, or LEASED if another worker has it.
+    # pgoptions are the job's own settings, in PGOPTIONS form like async jobs, set for the job and reset after it.
+    if shutting_down:
+        return BAD
+    sql = policy_options(sql, table)
+    if autovacuum_conflict(conn, cur, sql, table, 'sync', pgoptions, size, avdefer):
+        return LOCKED
+    if table_is_locked(conn, cur, table):
+        if requeue:
+            requeue_locked(sql, table, 'sync', pgoptions, size)
+        return LOCKED
+    key = job_key(sql, table)
+    if not acquire_lease(conn, cur, key, size):
+        return LEASED
+    throttle_for_replicas(conn, cur)
+    walpos = None
+    try:
+        walpos = get_wal_lsn(conn, cur)
+    except Exception:
+        pass
+    settings = pgoptions_settings(pgoptions)
+    for name, value in settings:
+        cur.execute("SET %s = '%s'" % (name, value.replace("'", "''")))
+    budget = job_budget_for(table, sql)
+    # A REINDEX CONCURRENTLY waits for other transactions several times, and one cut off part-way leaves an invalid _ccnew
+    # index behind, so it runs without lock or statement timeouts.
+    reindex = sql.startswith('REINDEX')
+    if reindex:
+        cur.execute("SET lock_timeout = 0")
+        cur.execute("SET statement_timeout = 0")
+    elif budget > 0:
+        cur.execute("SET statement_timeout = %d" % (budget * 1000))
+    started = time.time()
+    journal_write('dispatch', sql=sql, mode='sync', pgoptions=pgoptions, size=size, phase=action_name, **journal_relation(table, key))
+    notices = getattr(conn, 'notices', None)
+    if notices is not None:
+        del notices[:]
+    try:
+        cur.execute(sql)
+    except Exception as error:
+        if budget > 0 or reindex:
+            reset_timeouts(cur)
+        reset_settings(cur, settings)
+        # 55P03 = lock_not_available, raised when lock_timeout expires
+        if getattr(error, 'pgcode', None) == '55P03':
+            if requeue:
+                requeue_locked(sql, table, 'sync', pgoptions, size)
+            return LOCKED
+        # 57014 = query_canceled, raised when statement_timeout expires (or on shutdown)
+        if getattr(error, 'pgcode', None) == '57014' and budget > 0 and not shutting_down:
+            printit ("NOTICE: %s ran out of its %d sec budget." % (sql, budget), level='WARNING',
+                     table=table, action=sql.split(' ')[0], phase=action_name, size=size, reason='budget', duration=round(time.time() - started, 3))
+            record_job(table, sql, time.time() - started, 'timeout')
+            return run_fallback(conn, cur, sql, table, size, pgoptions)
+        printit("Exception: %s *** %s" % (type(error), error), level='ERROR',
+                table=table, action=sql.split(' ')[0], phase=action_name, size=size, reason='error', duration=round(time.time() - started, 3))
+        record_job(table, sql, time.time() - started, 'error')
+        return BAD
+    duration = time.time() - started
+    if budget > 0 or reindex:
+        reset_timeouts(cur)
+    reset_settings(cur, settings)
+    heap_bytes, index_bytes = (None, None)
+    if sql.startswith('VACUUM'):
+        heap_bytes, index_bytes = table_sizes(conn, cur, table)
+    record_job(table, sql, duration, 'ok', heap_bytes=heap_bytes, index_bytes=index_bytes)
+    journal_write('done', **journal_relation(table, key))
+    if notices is not None and sql.startswith('VACUUM'):
+        metrics = parse_vacuum_verbose(''.join(conn.notices))
+        if metrics is not None:
+            if metrics['elapsed'] is None:
+                metrics['elapsed'] = round(duration, 3)
+            record_vacuum_metrics(table, metrics)
+    walbytes = -1
+    if walpos is not None:
+        try:
+            walbytes = get_wal_bytes(conn, cur, walpos)
+            wal_jobs.append((table, sql.split(' ')[0], walbytes))
+        except Exception:
+            pass
+    printit ("      Done  %s in %.2f secs" % (sql, duration), level=job_event_level(),
+             table=table, action=sql.split(' ')[0], phase=action_name, size=size, reason='sync', duration=round(duration, 3), wal_bytes=walbytes)
+    return OK
+
+def run_async(conn, cur, sql, table, pgoptions='', requeue=True, size=-1, avdefer=True):
+    # dispatch a detached psql job.  Jobs cannot report lock waits back, so PG12+ skips locked tables and older versions time out on them.
+    if shutting_down:
+        return BAD
+    sql = policy_options(sql, table)
+    if autovacuum_conflict(conn, cur, sql, table, 'async', pgoptions, size, avdefer):
+        return LOCKED
+    if table_is_locked(conn, cur, table):
+        if requeue:
+            requeue_locked(sql, table, 'async', pgoptions, size)
+        return LOCKED
+    key = job_key(sql, table)
+    if not acquire_lease(conn, cur, key, size):
+        return LEASED
+    journal_write('dispatch', sql=sql, mode='async', pgoptions=pgoptions, size=size, phase=action_name, **journal_relation(table, key))
+    budget = job_budget_for(table, sql)
+    if budget > 0:
+        pgoptions = (pgoptions + ' -c statement_timeout=%ds' % budget).strip()
+    throttle_for_replicas(conn, cur)
+    if replica_throttled:
+        pgoptions = (pgoptions + ' -c vacuum_cost_delay=%d' % replica_cost_delay).strip()
+    if version >= 120000:
+        sql = add_vacuum_option(sql, 'SKIP_LOCKED')
+    elif lock_timeout > 0:
+        pgoptions = (pgoptions + ' -c lock_timeout=%ds' % lock_timeout).strip()
+    if sql.startswith('REINDEX'):
+        # no timeouts for a REINDEX CONCURRENTLY, whatever the role or database defaults, see run_sync
+        pgoptions = (pgoptions + ' -c lock_timeout=0 -c statement_timeout=0').strip()
+    stderr = '/dev/null'
+    if sql.startswith('VACUUM') or budget > 0:
+        stderr = verbose_log(table, sql, size)
+    cmd = 'nohup psql -d %s -c %s 2>%s &' % (shell_quote(job_dsn(job_app_name)), shell_quote(sql), shell_quote(stderr))
+    if pgoptions != '':
+        cmd = 'PGOPTIONS=%s %s' % (shell_quote(pgoptions), cmd)
+    printit ("      Async %s" % cmd, level=job_event_level(), table=table, action=sql.split(' ')[0], phase=action_name, size=size, reason='async')
+    run_actions.append((datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), table, sql.split(' ')[0], None, 'dispatched', 'async'))
+    return execute_cmd(cmd)
+
+def retry_locked_tables(conn, cur):
+    # retry requeued tables, backing off between attempts, so one locked table never stalls the rest of the run
+    global lock_requeue, lock_requeue_set
+    attempt = 0
+    while len(lock_requeue) > 0 and attempt < lock_max_retries:
+        wait = lock_backoff * (2 ** attempt)
+        attempt = attempt + 1
+        printit ("Retrying %d locked tables in %d seconds (attempt %d of %d)..." % (len(lock_requeue), wait, attempt, lock_max_retries))
+        time.sleep(wait)
+        pending = lock_requeue
+        lock_requeue = []
+        lock_requeue_set = set()
+        table_is_locked(conn, cur, '', force=True)
+        # the deferred autovacuum list has been processed by now, so a retry is never deferred again
+        for sql, table, mode, pgoptions, size in pending:
+            if mode == 'async':
+                rc = run_async(conn, cur, sql, table, pgoptions, size=size, avdefer=False)
+            else:
+                rc = run_sync(conn, cur, sql, table, size=size, avdefer=False, pgoptions=pgoptions)
+            if rc != LOCKED:
+                printit ("Retried %s: %s" % (mode, sql))
+    if len(lock_requeue) > 0:
+        printit ("NOTICE: %d tables still locked after %d retries.  Skipped: %s" % (len(lock_requeue), lock_max_retries, ', '.join([job_key(r[0], r[1]) for r in lock_requeue])))
+
+def get_db_counters(conn, cur):
+    # tuples modified database-wide and the last stats reset, used to invalidate cached catalog snapshots
+    sql = "SELECT tup_inserted + tup_updated + tup_deleted, coalesce(stats_reset::text, '') FROM pg_stat_database WHERE datname = current_database()"
+    cur.execute(sql)
+    row = cur.fetchone()
+    return (int(row[0]), row[1])
+
+def get_system_identifier(conn, cur):
+    if version < 90600:
+        return '%s_%d' % (file_host(), dbport)
+    cur.execute("SELECT system_identifier FROM pg_control_system()")
+    return str(cur.fetchone()[0])
+
+def cache_encode(value):
+    # catalog row values JSON has no type for, tagged so cache_decode can restore them
+    import decimal
+    if isinstance(value, decimal.Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.isoformat()}
+    if isinstance(value, datetime.date):
+        return {'date': value.isoformat()}
+    raise TypeError("%r cannot be cached" % (value,))
+
+def cache_decode(obj):
+    import decimal
+    if 'decimal' in obj:
+        return decimal.Decimal(obj['decimal'])
+    if 'date' in obj:
+        return datetime.datetime.strptime(obj['date'], '%Y-%m-%d').date()
+    if 'datetime' in obj:
+        # fromisoformat (3.7+) keeps the UTC offset, older pythons get the string back
+        if hasattr(datetime.datetime, 'fromisoformat'):
+            return datetime.datetime.fromisoformat(obj['datetime'])
+        return obj['datetime']
+    return obj
+
+def load_catalog_cache(conn, cur):
+    # The cache is valid for catalog_cache_ttl seconds, as long as stats were not reset and fewer tuples were modified in the whole
+    # database than the dead tuple threshold, so no table can have crossed it since the snapshot.  It is plain JSON, so a file
+    # someone else put in the workdir can at worst feed a dry run wrong numbers.
+    global catalog_cache
+    try:
+        counters = get_db_counters(conn, cur)
+        cachefile = os.path.join(workdir, 'catalog_%s_%s.json' % (dbname, get_system_identifier(conn, cur)))
+    except Exception as error:
+        printit("Catalog cache disabled: %s *** %s" % (type(error), error))
+        catalog_cache = {'file': None, 'queries': {}}
+        return
+    catalog_cache = {'file': cachefile, 'created': time.time(), 'counters': counters, 'queries': {}, 'dirty': False}
+    try:
+        with open(cachefile, 'r') as f:
+            cached = json.load(f, object_hook=cache_decode)
+        # rows come back as lists
+        cached['queries'] = dict([(key, [tuple(row) for row in rows]) for key, rows in cached['queries'].items()])
+    except Exception:
+        return
+    age = time.time() - cached['created']
+    if age > catalog_cache_ttl:
+        printit ("Catalog cache expired (%d secs old).  Refreshing it." % age)
+    elif cached['counters'][1] != counters[1] or counters[0] - cached['counters'][0] > threshold_dead_tups:
+        printit ("Catalog cache invalidated: %d tuples modified since it was taken." % (counters[0] - cached['counters'][0]))
+    else:
+        printit ("Using catalog cache taken %d secs ago." % age)
+        catalog_cache = cached
+        catalog_cache['file'] = cachefile
+        catalog_cache['dirty'] = False
+
+def save_catalog_cache():
+    if catalog_cache is None or catalog_cache['file'] is None or not catalog_cache.get('dirty'):
+        return
+    try:
+        if not os.path.isdir(workdir):
+            os.makedirs(workdir)
+        tmpfile = catalog_cache['file'] + '.tmp'
+        # table names and sizes are nobody else's business
+        with os.fdopen(os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump(catalog_cache, f, default=cache_encode)
+        os.rename(tmpfile, catalog_cache['file'])
+    except Exception as error:
+        printit("Unable to save catalog cache: %s *** %s" % (type(error), error))
+
+def catalog_query(conn, cur, sql):
+    # catalog queries go through here so dry runs can reuse a recent snapshot instead of rescanning the catalog
+    if not dryrun or catalog_cache_ttl <= 0:
+        cur.execute(sql)
+        return cur.fetchall()
+    import hashlib
+    if catalog_cache is None:
+        load_catalog_cache(conn, cur)
+    key = hashlib.sha1(sql.encode('utf-8')).hexdigest()
+    if key in catalog_cache['queries']:
+        return catalog_cache['queries'][key]
+    cur.execute(sql)
+    rows = cur.fetchall()
+    catalog_cache['queries'][key] = rows
+    catalog_cache['dirty'] = True
+    return rows
+
+def catalog_sql(tablefilter):
+    return "SELECT n.nspname || '.\"' || c.relname || '\"' as table, pg_size_pretty(pg_total_relation_size(c.oid)) as size_pretty, pg_total_relation_size(c.oid) as size, " \
+          "age(c.relfrozenxid) as xid_age, c.reltuples::bigint AS n_tup, u.n_live_tup::bigint as n_live_tup, u.n_dead_tup::bigint AS dead_tup, " \
+          "coalesce(to_char(u.last_vacuum, 'YYYY-MM-DD'),'') as last_vacuum, coalesce(to_char(u.last_autovacuum, 'YYYY-MM-DD'),'') as last_autovacuum, " \
+          "coalesce(to_char(u.last_analyze,'YYYY-MM-DD'),'') as last_analyze, coalesce(to_char(u.last_autoanalyze,'YYYY-MM-DD'),'') as last_autoanalyze " \
+          "FROM pg_stat_user_tables u JOIN pg_class c ON c.oid = u.relid JOIN pg_namespace n ON n.oid = c.relnamespace " \
+          "WHERE c.relkind in ('r','p') AND %s ORDER BY 1" % tablefilter
+
+def get_catalog(conn, cur, refresh=False):
+    # one query for every user table, kept in memory (and in the dry run catalog cache) for reports
+    global catalog
+    if catalog is not None and not refresh:
+        return catalog
+    if schema == "":
+        schemafilter = "n.nspname not in ('information_schema','pg_catalog')"
+    else:
+        schemafilter = "n.nspname = '%s'" % schema
+    sql = catalog_sql(schemafilter)
+    if refresh:
+        cur.execute(sql)
+        rows = cur.fetchall()
+    else:
+        rows = catalog_query(conn, cur, sql)
+    catalog = [CatalogRow(*row) for row in rows]
+    return catalog
+
+def refresh_catalog(conn, cur, tables):
+    # After a real run only the tables it acted on have new stats, so only their rows are fetched again.  The rest of the
+    # snapshot taken at the start is reused.
+    global catalog
+    if catalog is None:
+        return get_catalog(conn, cur, refresh=True)
+    if len(tables) == 0:
+        return catalog
+    cur.execute(catalog_sql("n.nspname || '.\"' || c.relname || '\"' = ANY(%s)"), (sorted(tables),))
+    fresh = dict([(row[0], CatalogRow(*row)) for row in cur.fetchall()])
+    catalog = [fresh.get(row.table, row) for row in catalog]
+    return catalog
+
+class ReportLines(object):
+    # file-like target for the csv writer
+    def __init__(self):
+        self.lines = []
+    def write(self, text):
+        self.lines.append(text.rstrip('\r\n'))
+
+def inquiry_report(rows):
+    # 'found' limits the report to tables processed (or evaluated in a dry run) by this run
+    if inquiry == 'found':
+        rows = [row for row in rows if row.table in tablist]
+    sortkeys = {'size': lambda row: row.size, 'dead': lambda row: row.dead_tup, 'xid': lambda row: row.xid_age}
+    if inquiry_sort in sortkeys:
+        if inquiry_top > 0:
+            rows = heapq.nlargest(inquiry_top, rows, key=sortkeys[inquiry_sort])
+        else:
+            rows = sorted(rows, key=sortkeys[inquiry_sort], reverse=True)
+    elif inquiry_top > 0:
+        rows = rows[:inquiry_top]
+
+    if len(rows) == 0:
+        printit ("Not able to retrieve inquiry results.")
+        return
+    printit ("Inquiry Results Follow...")
+
+    columns = list(CatalogRow._fields)
+    if inquiry_format == 'text' and inquiry_out == '':
+        printit("%55s %14s %14s %14s %12s %10s %10s %11s %12s %12s %16s" % ('table', 'sizep', 'size', 'xid_age', 'n_tup', 'n_live_tup', 'dead_tup', 'last_vacuum', 'last_autovac', 'last_analyze', 'last_autoanalyze'))
+        printit("%55s %14s %14s %14s %12s %10s %10s %11s %12s %12s %16s" % ('-----', '-----', '----', '-------', '-----', '----------', '--------', '-----------', '------------', '------------', '----------------'))
+        for row in rows:
+            printit("%55s %14s %14d %14d %12d %10d %10d %11s %12s %12s %16s" % tuple(row))
+        return
+
+    if inquiry_format == 'csv':
+        import csv
+        out = ReportLines()
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+        lines = out.lines
+    elif inquiry_format == 'json':
+        lines = [json.dumps([dict(zip(columns, row)) for row in rows], default=str)]
+    elif inquiry_format == 'markdown':
+        lines = ['| ' + ' | '.join(columns) + ' |', '|' + '---|' * len(columns)]
+        lines.extend(['| ' + ' | '.join([str(v) for v in row]) + ' |' for row in rows])
+    else:
+        lines = ["%55s %14s %14d %14d %12d %10d %10d %11s %12s %12s %16s" % tuple(row) for row in rows]
+
+    if inquiry_out != '':
+        with open(inquiry_out, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        printit ("Inquiry report (%d tables, %s) written to %s" % (len(rows), inquiry_format, inquiry_out))
+    else:
+        printraw('\n'.join(lines), kind='inquiry')
+
+def export_file(kind, ext):
+    # hive style partitions so readers can prune by date and database, one file per run so runs only ever add files
+    path = os.path.join(export_dir, kind, 'date=%s' % datetime.date.today().isoformat(), 'db=%s' % dbname)
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return os.path.join(path, '%s_%s_%d.%s' % (run_id, file_host(), dbport, ext))
+
+def export_run(rows):
+    fmt = export_format
+    if fmt != 'csv':
+        try:
+            import pyarrow, pyarrow.parquet, pyarrow.ipc
+        except ImportError:
+            printit ("%s export needs pyarrow (pip install pyarrow).  Exporting CSV instead." % fmt, level='WARNING')
+            fmt = 'csv'
+    keycols = ['run_id', 'exported_at', 'host', 'port', 'dbname']
+    keys    = [run_id, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), hostname, dbport, dbname]
+    exports = [('catalog', list(CatalogRow._fields), rows), ('actions', ['ran_at', 'table', 'command', 'duration', 'outcome', 'strategy'], run_actions)]
+    for kind, columns, kindrows in exports:
+        if len(kindrows) == 0:
+            continue
+        columns  = keycols + columns
+        kindrows = [keys + list(row) for row in kindrows]
+        filename = export_file(kind, fmt)
+        # written under a temporary name, so a reader scanning the partitions never sees a partial file
+        tmpfile  = filename + '.tmp'
+        try:
+            if fmt == 'csv':
+                import csv
+                with open(tmpfile, 'w') as f:
+                    writer = csv.writer(f)
+                    writer.writerow(columns)
+                    writer.writerows(kindrows)
+            else:
+                table = pyarrow.Table.from_arrays([pyarrow.array([row[i] for row in kindrows]) for i in range(len(columns))], names=columns)
+                if fmt == 'parquet':
+                    pyarrow.parquet.write_table(table, tmpfile)
+                else:
+                    sink = pyarrow.OSFile(tmpfile, 'wb')
+                    writer = pyarrow.ipc.new_file(sink, table.schema)
+                    writer.write_table(table)
+                    writer.close()
+                    sink.close()
+            os.rename(tmpfile, filename)
+            printit ("Exported %d %s rows to %s" % (len(kindrows), kind, filename))
+        except Exception as error:
+            printit("Unable to export %s: %s *** %s" % (kind, type(error), error))
+
+def av_threshold_expr():
+    # autovacuum vacuum threshold for pg_class c, honoring per-table reloptions
+    return "(coalesce(substring(array_to_string(c.reloptions, ' ') FROM 'autovacuum_vacuum_threshold=([0-9]+)')::bigint, current_setting('autovacuum_vacuum_threshold')::bigint) + " \
+           "coalesce(substring(array_to_string(c.reloptions, ' ') FROM 'autovacuum_vacuum_scale_factor=([0-9.]+)')::numeric, current_setting('autovacuum_vacuum_scale_factor')::numeric) * c.reltuples)"
+
+def freeze_max_age_expr():
+    # per-table autovacuum_freeze_max_age can only lower the server setting
+    return "least(coalesce(substring(array_to_string(c.reloptions, ' ') FROM 'autovacuum_freeze_max_age=([0-9]+)')::bigint, current_setting('autovacuum_freeze_max_age')::bigint), " \
+           "current_setting('autovacuum_freeze_max_age')::bigint)"
+
+def history_file():
+    return os.path.join(workdir, 'history_%s_%d_%s.sqlite' % (file_host(), dbport, dbname))
+
+def open_history():
+    import sqlite3
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    hist = sqlite3.connect(history_file())
+    hist.execute("CREATE TABLE IF NOT EXISTS samples (sampled_at REAL, tablename TEXT, n_dead_tup INTEGER, n_tup_upd INTEGER, n_tup_del INTEGER, xid_age INTEGER, size INTEGER, reltuples INTEGER)")
+    hist.execute("CREATE INDEX IF NOT EXISTS samples_table ON samples (tablename, sampled_at)")
+    # v4.4: inserts are sampled too
+    if 'n_tup_ins' not in [col[1] for col in hist.execute("PRAGMA table_info(samples)")]:
+        hist.execute("ALTER TABLE samples ADD COLUMN n_tup_ins INTEGER")
+    # v5.0: and sync jobs are recorded
+    hist.execute("CREATE TABLE IF NOT EXISTS jobs (ran_at REAL, tablename TEXT, command TEXT, duration REAL, outcome TEXT, strategy TEXT)")
+    hist.execute("CREATE INDEX IF NOT EXISTS jobs_table ON jobs (tablename, command)")
+    # v5.7: with the heap and index sizes of vacuumed tables for the cost model
+    for col in ['heap_bytes', 'index_bytes']:
+        if col not in [c[1] for c in hist.execute("PRAGMA table_info(jobs)")]:
+            hist.execute("ALTER TABLE jobs ADD COLUMN %s INTEGER" % col)
+    # v5.6: and what their VACUUM VERBOSE output said
+    hist.execute("CREATE TABLE IF NOT EXISTS vacuum_stats (ran_at REAL, tablename TEXT, pages_total INTEGER, pages_scanned INTEGER, tuples_removed INTEGER, " \
+                 "dead_not_removable INTEGER, index_scans INTEGER, buffer_hits INTEGER, buffer_misses INTEGER, buffer_dirtied INTEGER, wal_bytes INTEGER, elapsed REAL)")
+    return hist
+
+def get_job_history():
+    # opened on first use and kept for the run, False once it turned out to be unusable
+    global job_history
+    if job_history is None:
+        try:
+            job_history = open_history()
+        except Exception as error:
+            printit("Job history disabled: %s *** %s" % (type(error), error))
+            job_history = False
+    return job_history
+
+def record_job(table, sql, duration, outcome, strategy='', heap_bytes=None, index_bytes=None):
+    global cost_new_jobs
+    run_actions.append((datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'), table, sql.split(' ')[0], round(duration, 3), outcome, strategy))
+    hist = get_job_history()
+    if not hist:
+        return
+    try:
+        hist.execute("INSERT INTO jobs (ran_at, tablename, command, duration, outcome, strategy, heap_bytes, index_bytes) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                     (time.time(), table, sql.split(' ')[0], round(duration, 3), outcome, strategy, heap_bytes, index_bytes))
+        hist.commit()
+        if heap_bytes is not None:
+            cost_new_jobs = cost_new_jobs + 1
+    except Exception as error:
+        printit("Unable to record job: %s *** %s" % (type(error), error))
+
+def get_relation_sizes(conn, cur):
+    # heap (TOAST included) and index bytes of every table, for the cost model
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"', pg_table_size(c.oid), pg_indexes_size(c.oid) FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace " \
+          "WHERE c.relkind in ('r','m') AND n.nspname not in ('pg_catalog', 'information_schema', 'pg_toast')"
+    return dict([(row[0], (row[1], row[2])) for row in catalog_query(conn, cur, sql)])
+
+def table_sizes(conn, cur, table):
+    # (heap bytes, index bytes) of a table just vacuumed, (None, None) if they cannot be had
+    try:
+        cur.execute("SELECT pg_table_size(%s::regclass), pg_indexes_size(%s::regclass)", (table, table))
+        return tuple(cur.fetchone())
+    except Exception:
+        return (None, None)
+
+def solve_linear(a, b):
+    # Gauss-Jordan elimination with partial pivoting, None if the system is singular
+    n = len(b)
+    m = [list(a[i]) + [b[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda i: abs(m[i][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for i in range(n):
+            if i != col:
+                factor = m[i][col] / m[col][col]
+                m[i] = [x - factor * y for x, y in zip(m[i], m[col])]
+    return [m[i][n] / m[i][i] for i in range(n)]
+
+def fit_cost_model():
+    # Least squares over the latest successful vacuums: seconds = base + heap GB * secs per heap GB + index GB * secs per index GB.
+    # When heap and index sizes are too correlated for two rates to come out positive, one rate for heap and indexes together is fitted.
+    hist = get_job_history()
+    if not hist:
+        return None
+    jobs = hist.execute("SELECT heap_bytes, index_bytes, duration FROM jobs WHERE command = 'VACUUM' AND outcome = 'ok' AND heap_bytes IS NOT NULL " \
+                        "ORDER BY ran_at DESC LIMIT ?", (cost_max_jobs,)).fetchall()
+    if len(jobs) < cost_min_jobs:
+        return None
+    gb = float(1024 ** 3)
+    for features in [lambda h, i: [1.0, h / gb, i / gb], lambda h, i: [1.0, (h + i) / gb]]:
+        xs = [features(h, i or 0) for h, i, d in jobs]
+        ys = [d for h, i, d in jobs]
+        k = len(xs[0])
+        xtx = [[sum([x[r] * x[c] for x in xs]) for c in range(k)] for r in range(k)]
+        xty = [sum([x[r] * y for x, y in zip(xs, ys)]) for r in range(k)]
+        coef = solve_linear(xtx, xty)
+        if coef is not None and min(coef[1:]) > 0:
+            if k == 2:
+                coef = coef + [coef[1]]
+            return {'base': coef[0], 'heap': coef[1], 'index': coef[2], 'jobs': len(jobs)}
+    return None
+
+def current_cost_model():
+    # refitted when vacuums were recorded since the last fit
+    global cost_model, cost_new_jobs
+    if cost_model is None or cost_new_jobs > 0:
+        cost_new_jobs = 0
+        cost_model = fit_cost_model()
+    return cost_model
+
+def predict_secs(model, heap, index):
+    gb = float(1024 ** 3)
+    return max(0.0, model['base'] + model['heap'] * heap / gb + model['index'] * (index or 0) / gb)
+
+def cost_report():
+    model = fit_cost_model()
+    if model is None:
+        printit ("Not enough vacuums with sizes in the history for a cost model: %d needed." % cost_min_jobs)
+        return
+    printit ("Cost model from %d vacuums: %.1f secs + %.1f secs per heap GB + %.1f secs per index GB.  Sync up to %d secs, async up to %d secs, deferred beyond." \
+             % (model['jobs'], model['base'], model['heap'], model['index'], cost_sync_secs, cost_async_secs))
+    jobs = get_job_history().execute("SELECT ran_at, tablename, heap_bytes, index_bytes, duration, strategy FROM jobs WHERE command = 'VACUUM' AND outcome = 'ok' " \
+                                      "AND heap_bytes IS NOT NULL ORDER BY ran_at DESC LIMIT 20").fetchall()
+    printit ("%19s %-57s %10s %10s %10s %10s %8s" % ('ran_at', 'table', 'heap', 'indexes', 'predicted', 'actual', 'error'))
+    errors = []
+    for ran_at, table, heap, index, duration, strategy in jobs:
+        predicted = predict_secs(model, heap, index)
+        error = 100.0 * (predicted - duration) / duration if duration > 0 else 0.0
+        errors.append(abs(error))
+        printit ("%19s %-57s %10s %10s %10.1f %10.1f %7.0f%%" % (datetime.datetime.fromtimestamp(ran_at).strftime('%Y-%m-%d %H:%M:%S'), table,
+                 pretty_bytes(heap), pretty_bytes(index or 0), predicted, duration, error))
+    errors.sort()
+    printit ("Median absolute error of the last %d vacuums: %.0f%%" % (len(errors), errors[len(errors) // 2]))
+
+def parse_vacuum_verbose(text):
+    # Sums the VACUUM VERBOSE reports of a table and its TOAST table.  PG15+ reports a relation in one message, older versions
+    # over several.  Metrics a version does not report stay None, and None is returned when there is no report at all.
+    metrics = dict([(name, None) for name in metric_names])
+    def add(name, value):
+        metrics[name] = (metrics[name] or 0) + value
+    for m in re.finditer(r'pages: \d+ removed, (\d+) remain, (\d+) scanned', text):
+        add('pages_total', int(m.group(1)))
+        add('pages_scanned', int(m.group(2)))
+    for m in re.finditer(r'nonremovable row versions in (\d+) out of (\d+) pages', text):
+        add('pages_scanned', int(m.group(1)))
+        add('pages_total', int(m.group(2)))
+    if metrics['pages_total'] is None:
+        return None
+    for m in re.finditer(r'tuples: (\d+) removed|found (\d+) removable', text):
+        add('tuples_removed', int(m.group(1) or m.group(2)))
+    for m in re.finditer(r'(\d+) are dead but not yet removable|(\d+) dead row versions cannot be removed yet', text):
+        add('dead_not_removable', int(m.group(1) or m.group(2)))
+    for m in re.finditer(r'index scans: (\d+)', text):
+        add('index_scans', int(m.group(1)))
+    if metrics['index_scans'] is None:
+        # before PG15 each round of index vacuuming is followed by a heap pass reporting what it removed
+        metrics['index_scans'] = len(re.findall(r'removed \d+ row versions in \d+ pages', text))
+    for m in re.finditer(r'buffer usage: (\d+) hits, (\d+) (?:misses|reads), (\d+) dirtied', text):
+        add('buffer_hits', int(m.group(1)))
+        add('buffer_misses', int(m.group(2)))
+        add('buffer_dirtied', int(m.group(3)))
+    for m in re.finditer(r'WAL usage: \d+ records, \d+ full page images, (\d+) bytes', text):
+        add('wal_bytes', int(m.group(1)))
+    for m in re.finditer(r'system usage: CPU: .*?elapsed: ([\d.]+) s', text):
+        add('elapsed', float(m.group(1)))
+    if metrics['elapsed'] is None:
+        # older versions print CPU lines per index too, the one of the whole vacuum is the longest
+        elapsed = [float(e) for e in re.findall(r'elapsed: ([\d.]+) s', text)]
+        if len(elapsed) > 0:
+            metrics['elapsed'] = max(elapsed)
+    return metrics
+
+def record_vacuum_metrics(table, metrics):
+    vacuum_metrics.append((table, metrics))
+    hist = get_job_history()
+    if not hist:
+        return
+    try:
+        hist.execute("INSERT INTO vacuum_stats VALUES (?, ?, %s)" % ', '.join(['?'] * len(metric_names)), [time.time(), table] + [metrics[name] for name in metric_names])
+        hist.commit()
+    except Exception as error:
+        printit("Unable to record vacuum metrics: %s *** %s" % (type(error), error))
+
+def verbose_log(table, sql, size):
+    # stderr of an async job, where psql writes the VERBOSE output and the error of a job cancelled by its budget
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    logfile = os.path.join(workdir, 'verbose_%s_%d.log' % (run_id, len(verbose_logs)))
+    verbose_logs.append([logfile, table, sql, size, time.time()])
+    return logfile
+
+def collect_verbose_logs(conn, cur):
+    # Logs of jobs still running are left in the workdir.  Logs of jobs that ended without a report (skipped by SKIP_LOCKED,
+    # failed or cancelled) are removed, and so are logs of earlier runs older than verbose_log_hours.
+    try:
+        running = [row[1] for row in owned_jobs(cur)]
+    except Exception as error:
+        printit("Unable to check running jobs, keeping unparsed VERBOSE logs: %s *** %s" % (type(error), error))
+        running = None
+    for entry in list(verbose_logs):
+        logfile, table, sql, size, started = entry
+        try:
+            with open(logfile, 'r') as f:
+                text = f.read()
+            metrics = parse_vacuum_verbose(text)
+        except Exception:
+            text, metrics = '', None
+        # an async job cut off by its budget: recorded and retried the cheaper way, like a sync one (see run_sync)
+        if 'canceling statement due to statement timeout' in text and not shutting_down:
+            verbose_logs.remove(entry)
+            elapsed = os.path.getmtime(logfile) - started
+            remove_file(logfile)
+            printit ("NOTICE: async %s ran out of its budget after %d secs." % (sql, elapsed), level='WARNING',
+                     table=table, action=sql.split(' ')[0], phase=action_name, size=size, reason='budget', duration=round(elapsed, 3))
+            record_job(table, sql, elapsed, 'timeout', 'async')
+            run_fallback(conn, cur, sql, table, size)
+            continue
+        if metrics is None:
+            if running is not None and len([q for q in running if table in q]) == 0:
+                verbose_logs.remove(entry)
+                remove_file(logfile)
+            continue
+        record_vacuum_metrics(table, metrics)
+        # v5.7: async vacuums only report their duration here
+        if metrics['elapsed'] is not None:
+            heap_bytes, index_bytes = table_sizes(conn, cur, table)
+            record_job(table, 'VACUUM', metrics['elapsed'], 'ok', 'async', heap_bytes, index_bytes)
+        verbose_logs.remove(entry)
+        remove_file(logfile)
+    if len(verbose_logs) > 0:
+        printit ("VACUUM VERBOSE logs of running jobs left in %s: %d" % (workdir, len(verbose_logs)))
+    try:
+        names = os.listdir(workdir)
+    except Exception:
+        names = []
+    for name in names:
+        logfile = os.path.join(workdir, name)
+        if name.startswith('verbose_') and name.endswith('.log') and not name.startswith('verbose_%s_' % run_id):
+            try:
+                if os.path.getmtime(logfile) < time.time() - (verbose_log_hours * 3600):
+                    os.remove(logfile)
+            except OSError:
+                pass
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def vacuum_efficiency_report():
+    # vacuums that removed the fewest dead tuples for the pages they scanned
+    rows = [(table, m) for table, m in vacuum_metrics if m['pages_scanned']]
+    if len(rows) == 0:
+        return
+    rows = sorted(rows, key=lambda row: float(row[1]['tuples_removed'] or 0) / row[1]['pages_scanned'])[:10]
+    printit ("Least efficient vacuums of this run (dead tuples removed per page scanned):")
+    for table, m in rows:
+        printit ("  %-57s scanned: %9d of %9d pages  removed: %10d  not removable: %9d  index scans: %2d  misses: %9s  dirtied: %9s  WAL: %10s  %s secs" \
+                 % (table, m['pages_scanned'], m['pages_total'], m['tuples_removed'] or 0, m['dead_not_removable'] or 0, m['index_scans'],
+                    '-' if m['buffer_misses'] is None else m['buffer_misses'], '-' if m['buffer_dirtied'] is None else m['buffer_dirtied'],
+                    '-' if m['wal_bytes'] is None else pretty_bytes(m['wal_bytes']), '-' if m['elapsed'] is None else '%.2f' % m['elapsed']))
+
+def job_budget_for(table, sql):
+    # A REINDEX CONCURRENTLY cancelled by its budget would only leave an invalid index behind, and an anti-wraparound freeze
+    # cancelled part-way throws away its work, so neither gets a budget.
+    if sql.startswith('REINDEX') or (emergency and 'FREEZE' in sql.rsplit(table, 1)[0]):
+        return 0
+    budget = policy_rule(table).get('budget', job_budget)
+    if budget <= 0:
+        return 0
+    hist = get_job_history()
+    if hist:
+        try:
+            longest = hist.execute("SELECT max(duration) FROM jobs WHERE tablename = ? AND command = ? AND outcome = 'ok'", (table, sql.split(' ')[0])).fetchone()[0]
+        except Exception:
+            longest = None
+        if longest is not None:
+            budget = min(budget, max(int(longest * budget_factor), budget_min))
+    return budget
+
+def load_history(hist):
+    # table --> [(sampled_at, updates + deletes, xid age, inserts), ...] oldest first
+    history = {}
+    for sample in hist.execute("SELECT tablename, sampled_at, n_tup_upd + n_tup_del, xid_age, coalesce(n_tup_ins, 0) FROM samples ORDER BY tablename, sampled_at"):
+        history.setdefault(sample[0], []).append(sample[1:])
+    return history
+
+def record_samples(conn, cur):
+    # one sample per table per run.  Autovacuum thresholds honor per-table reloptions.
+    global sampled_rows
+    if sampled_rows is not None:
+        return open_history(), sampled_rows
+    if version > 100000:
+        partexpr = "c.relispartition"
+    else:
+        partexpr = "CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False'::boolean ELSE 'True'::boolean END"
+    if schema == "":
+        schemafilter = "u.schemaname not in ('pg_catalog', 'pg_toast', 'information_schema')"
+    else:
+        schemafilter = "u.schemaname = '%s'" % schema
+    sql = "SELECT u.schemaname || '.\"' || u.relname || '\"' as table, u.n_dead_tup::bigint, u.n_tup_upd::bigint, u.n_tup_del::bigint, age(c.relfrozenxid) as xid_age, " \
+          "pg_total_relation_size(c.oid) as size, c.reltuples::bigint, %s as av_threshold, %s as freeze_max_age, pg_size_pretty(pg_total_relation_size(c.oid)), %s as partitioned, u.n_tup_ins::bigint " \
+          "FROM pg_stat_user_tables u JOIN pg_class c ON u.relid = c.oid WHERE c.relkind = 'r' AND %s" % (av_threshold_expr(), freeze_max_age_expr(), partexpr, schemafilter)
+    cur.execute(sql)
+    rows = cur.fetchall()
+    now = time.time()
+    hist = open_history()
+    hist.executemany("INSERT INTO samples (sampled_at, tablename, n_dead_tup, n_tup_upd, n_tup_del, xid_age, size, reltuples, n_tup_ins) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                     [(now, row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[11]) for row in rows])
+    hist.execute("DELETE FROM samples WHERE sampled_at < ?", (now - history_keep_days * 86400,))
+    hist.commit()
+    sampled_rows = rows
+    return hist, rows
+
+def current_segment(points):
+    # samples since the value last went down (vacuum, stats reset), oldest first
+    start = len(points) - 1
+    while start > 0 and points[start - 1][1] <= points[start][1]:
+        start = start - 1
+    return points[start:]
+
+def fit_rate(points):
+    # least squares slope of [(time, value), ...] in units per second
+    n = float(len(points))
+    meant = sum([p[0] for p in points]) / n
+    meanv = sum([p[1] for p in points]) / n
+    var = sum([(p[0] - meant) ** 2 for p in points])
+    if var == 0:
+        return 0.0
+    return sum([(p[0] - meant) * (p[1] - meanv) for p in points]) / var
+
+def forecast_maintenance(conn, cur):
+    # Dead tuples grow at about the rate of updates + deletes, and relfrozenxid ages at the rate xids are consumed.
+    # Tables whose fitted rate takes them over their autovacuum or wraparound threshold within forecast_hours are returned, soonest first.
+    try:
+        hist, rows = record_samples(conn, cur)
+        history = load_history(hist)
+        hist.close()
+    except Exception as error:
+        printit("Unable to update history samples: %s *** %s" % (type(error), error))
+        return []
+
+    horizon = forecast_hours * 3600
+    candidates = []
+    for row in rows:
+        table, dead, xidage, size, tups, avthreshold, freezemaxage, sizep, part = row[0], row[1], row[4], row[5], row[6], float(row[7]), row[8], row[9], row[10]
+        samples = history.get(table, [])
+        if len(samples) < history_min_samples:
+            continue
+        ages = current_segment([(s[0], s[2]) for s in samples])
+        rate = fit_rate(ages) if len(ages) >= history_min_samples else 0
+        if rate > 0 and xidage < freezemaxage and (freezemaxage - xidage) / rate < horizon:
+            candidates.append((table, 'VACUUM FREEZE', (freezemaxage - xidage) / rate, tups, sizep, size, part, xidage))
+            continue
+        mods = current_segment([(s[0], s[1]) for s in samples])
+        rate = fit_rate(mods) if len(mods) >= history_min_samples else 0
+        if rate > 0 and dead < avthreshold and (avthreshold - dead) / rate < horizon:
+            candidates.append((table, 'VACUUM', (avthreshold - dead) / rate, tups, sizep, size, part, xidage))
+    return sorted(candidates, key=lambda c: c[2])
+
+def fitted_rate(samples, col):
+    # growth rate per second of a sampled counter since it last went down, 0 if there are too few samples to trust
+    points = current_segment([(s[0], s[col]) for s in samples])
+    if len(points) < history_min_samples:
+        return 0
+    return fit_rate(points)
+
+def avtune_recommend(conn, cur):
+    # returns ALTER TABLE statements for tables whose fitted dead tuple (or insert) rate means autovacuum visits them too rarely
+    if version >= 130000:
+        insexpr = "coalesce(substring(array_to_string(c.reloptions, ' ') FROM 'autovacuum_vacuum_insert_threshold=([0-9]+)')::bigint, current_setting('autovacuum_vacuum_insert_threshold')::bigint) + " \
+                  "coalesce(substring(array_to_string(c.reloptions, ' ') FROM 'autovacuum_vacuum_insert_scale_factor=([0-9.]+)')::numeric, current_setting('autovacuum_vacuum_insert_scale_factor')::numeric) * c.reltuples"
+    else:
+        insexpr = "0"
+    sql = "SELECT n.nspname || '.\"' || c.relname || '\"', c.reltuples::bigint, %s, c.reloptions, pg_total_relation_size(c.oid), current_setting('autovacuum_freeze_max_age')::bigint, %s " \
+          "FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind = 'r' AND n.nspname not in ('pg_catalog', 'pg_toast', 'information_schema')" % (av_threshold_expr(), insexpr)
+    if schema != "":
+        sql = sql + " AND n.nspname = '%s'" % schema
+    try:
+        hist, rows = record_samples(conn, cur)
+        history = load_history(hist)
+        hist.close()
+        cur.execute(sql)
+        tables = cur.fetchall()
+    except Exception as error:
+        printit("Unable to compute autovacuum tuning: %s *** %s" % (type(error), error))
+        return []
+
+    target = avtune_target_hours * 3600
+    stmts = []
+    for table, reltuples, avthreshold, reloptions, size, freezemaxage, insthreshold in tables:
+        samples = history.get(table, [])
+        if len(samples) < history_min_samples:
+            continue
+        reltuples = max(float(reltuples), 1)
+        opts = dict([opt.split('=', 1) for opt in (reloptions or [])])
+        new = {}
+        deadrate = fitted_rate(samples, 1)
+        if deadrate > 0 and float(avthreshold) / deadrate > 2 * target:
+            wanted = deadrate * target
+            new['autovacuum_vacuum_scale_factor'] = '%.4f' % min(max(wanted * 0.9 / reltuples, 0.0001), 0.2)
+            new['autovacuum_vacuum_threshold'] = '%d' % max(int(wanted * 0.1), 50)
+        insrate = fitted_rate(samples, 3)
+        if version >= 130000 and insrate > deadrate and float(insthreshold) / insrate > 2 * target:
+            wanted = insrate * target
+            new['autovacuum_vacuum_insert_scale_factor'] = '%.4f' % min(max(wanted * 0.9 / reltuples, 0.0001), 0.2)
+            new['autovacuum_vacuum_insert_threshold'] = '%d' % max(int(wanted * 0.1), 1000)
+        if len(new) > 0 and size > avtune_big_table:
+            # big tables need a bigger cost budget to finish a vacuum between visits
+            new['autovacuum_vacuum_cost_limit'] = '2000' if size > 10 * avtune_big_table else '1000'
+        if size > threshold_max_sync and fitted_rate(samples, 2) > 0:
+            # start anti-wraparound vacuums of huge tables earlier, so they are not all due at once
+            wantedage = max(int(freezemaxage / 2), 100000000)
+            if int(opts.get('autovacuum_freeze_max_age', freezemaxage)) > wantedage:
+                new['autovacuum_freeze_max_age'] = '%d' % wantedage
+        for opt in list(new.keys()):
+            if opts.get(opt) == new[opt]:
+                del new[opt]
+        if len(new) > 0:
+            stmts.append("ALTER TABLE %s SET (%s)" % (table, ', '.join(['%s = %s' % (opt, new[opt]) for opt in sorted(new.keys())])))
+    return stmts
+
+def autovacuum_tune(conn, cur):
+    stmts = avtune_recommend(conn, cur)
+    printit ("Autovacuum tuning: %d tables need new autovacuum settings." % len(stmts))
+    if len(stmts) == 0:
+        return
+    if avtune == 'print' or dryrun:
+        printraw('\n'.join([stmt + ';' for stmt in stmts]), kind='avtune')
+        return
+    # a multi-statement query runs as one implicit transaction, so each batch is applied all or nothing
+    for i in range(0, len(stmts), avtune_batch):
+        batch = stmts[i:i + avtune_batch]
+        try:
+            cur.execute('; '.join(batch))
+            printit ("Applied autovacuum settings to %d tables (%d of %d)." % (len(batch), i + len(batch), len(stmts)))
+        except Exception as error:
+            printit("Autovacuum settings batch failed: %s *** %s" % (type(error), error), level='ERROR')
+
+def get_index_candidates(conn, cur):
+    # every btree index with its table, validity, size and the older identical index it duplicates, if any
+    if schema == "":
+        schemafilter = "n.nspname not in ('pg_catalog', 'pg_toast', 'information_schema')"
+    else:
+        schemafilter = "n.nspname = '%s'" % schema
+    sql = "SELECT n.nspname || '.\"' || ic.relname || '\"' as index, n.nspname || '.\"' || tc.relname || '\"' as table, i.indisvalid, " \
+          "pg_relation_size(ic.oid) as size, pg_size_pretty(pg_relation_size(ic.oid)), " \
+          "(SELECT min(dc.relname) FROM pg_index d JOIN pg_class dc ON dc.oid = d.indexrelid WHERE d.indrelid = i.indrelid AND d.indexrelid != i.indexrelid " \
+          "AND d.indkey::text = i.indkey::text AND d.indclass::text = i.indclass::text AND d.indisvalid " \
+          "AND coalesce(pg_get_expr(d.indexprs, d.indrelid), '') = coalesce(pg_get_expr(i.indexprs, i.indrelid), '') " \
+          "AND coalesce(pg_get_expr(d.indpred, d.indrelid), '') = coalesce(pg_get_expr(i.indpred, i.indrelid), '') " \
+          "AND (d.indisunique AND NOT i.indisunique OR d.indisunique = i.indisunique AND d.indexrelid < i.indexrelid)) as duplicate_of " \
+          "FROM pg_index i JOIN pg_class ic ON ic.oid = i.indexrelid JOIN pg_class tc ON tc.oid = i.indrelid JOIN pg_namespace n ON n.oid = tc.relnamespace " \
+          "JOIN pg_am am ON am.oid = ic.relam WHERE am.amname = 'btree' AND ic.relkind = 'i' AND %s ORDER BY 4 DESC" % schemafilter
+    return catalog_query(conn, cur, sql)
+
+def analyze_is_stale(table):
+    # with --analyzemods, tables with no modifications since their last analyze are not worth re-analyzing
+    if threshold_analyze_mods == -1 or table not in analyze_mods:
+        return True
+    return analyze_mods[table] > 0
+
+
 ####################
 # MAIN ENTRY POINT #
 ####################
@@ -204,32 +2556,24 @@ def wait_for_processes(conn,cur):
 # Register the signal handler for CNTRL-C logic
 signal.signal(signal.SIGINT, signal_handler)
 signal.siginterrupt(signal.SIGINT, False)        
+# v4.7: SIGTERM drains and cancels jobs too, and queries wait in select() so the handler runs even during a long sync job
+signal.signal(signal.SIGTERM, signal_handler)
+signal.siginterrupt(signal.SIGTERM, False)
+startup_mark('imports and setup')
 # test interrupt
 #while True:
 #    print('Waiting...')
 #    time.sleep(5)
 
-# Delay if high load encountered, give up after 30 minutes.
-cnt = 0
-while True:
-    if highload():
-        printit("Deferring program start for another 5 minutes while high load encountered.")
-        cnt = cnt + 1
-        time.sleep(300)
-        if cnt > 5:
-            printit("Aborting program due to high load.")
-            sys.exit(1)
-    else:
-        break
-
 total_freezes = 0
 total_vacuums_analyzes = 0
 total_vacuums  = 0
 total_analyzes = 0
+total_reindexes = 0
 tables_skipped = 0
 partitioned_tables_skipped = 0
 asyncjobs = 0
-tablist = []
+tablist = set()
 
 # Setup up the argument parser
 # parser = OptionParser("PostgreSQL Vacumming Tool", add_help_option=False)
@@ -263,24 +2607,61 @@ parser.add_argument("-z", "--pctfreeze",dest="pctfreeze",      help="max pct unt
 parser.add_argument("-t", "--mindeadtups",dest="mindeadtups",  help="min dead tups",  type=int, default=10000,metavar="MINDEADTUPS")
 parser.add_argument("-q", "--inquiry", dest="inquiry",         help="inquiry requested", choices=['all', 'found', ''], type=str, default="", metavar="INQUIRY")
 parser.add_argument("-i", "--ignoreparts", dest="ignoreparts", help="ignore partition tables", default=False, action="store_true")
-parser.add_argument("-a", "--async", dest="async",             help="run async jobs", default=False, action="store_true")
+parser.add_argument("-a", "--async", dest="runasync",          help="run async jobs", default=False, action="store_true")
+parser.add_argument("-n", "--analyzemods", dest="analyzemods", help="pct of rows modified since last analyze", type=int, default=-1, metavar="ANALYZEMODS")
+parser.add_argument("-b", "--bloatorder", dest="bloatorder", help="order vacuums by estimated bloat", default=False, action="store_true")
+parser.add_argument("-w", "--workdir", dest="workdir",         help="directory for caches and run artifacts", type=str, default="", metavar="WORKDIR")
+parser.add_argument("-e", "--emergency", dest="emergency",   help="wraparound emergency mode", default=False, action="store_true")
+parser.add_argument("-l", "--locktimeout", dest="locktimeout", help="seconds to wait on a locked table", type=int, default=5, metavar="LOCKTIMEOUT")
+parser.add_argument("-g", "--maxlag", dest="maxlag",           help="replication lag ceiling in seconds", type=int, default=-1, metavar="MAXLAG")
+parser.add_argument("-k", "--cachettl", dest="cachettl",       help="seconds dry runs reuse cached catalog results", type=int, default=600, metavar="CACHETTL")
+parser.add_argument("-o", "--logformat", dest="logformat",     help="log output format", choices=['text', 'json'], type=str, default="text", metavar="LOGFORMAT")
+parser.add_argument("-v", "--loglevel", dest="loglevel",       help="minimum log level", choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], type=str, default="INFO", metavar="LOGLEVEL")
+parser.add_argument("--inquirysort", dest="inquirysort",       help="inquiry sort order", choices=['name', 'size', 'dead', 'xid'], type=str, default="name", metavar="INQUIRYSORT")
+parser.add_argument("--inquirytop", dest="inquirytop",         help="only report the top N tables", type=int, default=0, metavar="INQUIRYTOP")
+parser.add_argument("--inquiryformat", dest="inquiryformat",   help="inquiry output format", choices=['text', 'csv', 'json', 'markdown'], type=str, default="text", metavar="INQUIRYFORMAT")
+parser.add_argument("--inquiryout", dest="inquiryout",         help="write the inquiry report to this file", type=str, default="", metavar="INQUIRYOUT")
+parser.add_argument("--forecasthours", dest="forecasthours", help="hours until the next run, for forecast vacuums", type=int, default=-1, metavar="FORECASTHOURS")
+parser.add_argument("--avaware", dest="avaware",               help="skip or defer tables autovacuum is handling", default=False, action="store_true")
+parser.add_argument("--avtune", dest="avtune",                 help="print or apply per-table autovacuum settings", choices=['print', 'apply', ''], type=str, default="", metavar="AVTUNE")
+parser.add_argument("--distributed", dest="distributed",       help="split tables with other pg_vacuum workers through leases", default=False, action="store_true")
+parser.add_argument("--leasesecs", dest="leasesecs",           help="seconds a table lease is held", type=int, default=7200, metavar="LEASESECS")
+parser.add_argument("--resume", dest="resume",                 help="resume the last interrupted run", default=False, action="store_true")
+parser.add_argument("--shutdowngrace", dest="shutdowngrace",   help="seconds to drain jobs on SIGINT/SIGTERM before cancelling them", type=int, default=60, metavar="SHUTDOWNGRACE")
+parser.add_argument("--reindexpct", dest="reindexpct",         help="reindex indexes with this pct of estimated bloat", type=int, default=-1, metavar="REINDEXPCT")
+parser.add_argument("--policy", dest="policy",                 help="policy file with per-schema/table rules (json, toml or yaml)", type=str, default="", metavar="POLICY")
+parser.add_argument("--jobbudget", dest="jobbudget",           help="max seconds per job, 0 means no limit", type=int, default=0, metavar="JOBBUDGET")
+parser.add_argument("--dsn", dest="dsn",                       help="libpq connection string or URI, overrides -H -d -p -U", type=str, default="", metavar="DSN")
+parser.add_argument("--service", dest="service",               help="service name from pg_service.conf", type=str, default="", metavar="SERVICE")
+parser.add_argument("--export", dest="export",                 help="directory to export the catalog snapshot and job outcomes to", type=str, default="", metavar="EXPORT")
+parser.add_argument("--exportformat", dest="exportformat",     help="export file format", choices=['parquet', 'arrow', 'csv'], type=str, default="parquet", metavar="EXPORTFORMAT")
+parser.add_argument("--benchclassify", dest="benchclassify",   help="time scalar vs numpy classification of this many synthetic rows and exit", type=int, default=0, metavar="BENCHCLASSIFY")
+parser.add_argument("--costmodel", dest="costmodel",           help="place vacuums in sync, async or deferred by their duration predicted from the history", action="store_true")
+parser.add_argument("--costsync", dest="costsync",             help="max predicted secs for a sync vacuum with --costmodel", type=int, default=600, metavar="COSTSYNC")
+parser.add_argument("--costasync", dest="costasync",           help="max predicted secs for an async vacuum with --costmodel, longer ones are deferred", type=int, default=21600, metavar="COSTASYNC")
+parser.add_argument("--costreport", dest="costreport",         help="show the cost model and its predicted vs actual durations, then exit", action="store_true")
+parser.add_argument("--inquiryonly", dest="inquiryonly",       help="only run the inquiry report: no load check, locks or maintenance", action="store_true")
+parser.add_argument("--benchstartup", dest="benchstartup",     help="print the time taken by each startup step and exit before any work", action="store_true")
+parser.add_argument("-c", "--hotcolumns", dest="hotcolumns",   help="only analyze these columns: schema.table:col1,col2", type=str, action="append", default=[], metavar="HOTCOLUMNS")
 
 args = parser.parse_args()
+log_format = args.logformat
+log_level  = args.loglevel
 
 dryrun      = False
 freeze      = False
 ignoreparts = False
-async       = False
+runasync    = False
 if args.dryrun:
     dryrun = True
 if args.freeze:
     freeze = True;
 if args.ignoreparts:
     ignoreparts = True;    
-if args.async:
-    async = True;        
-if args.dbname == "":
-    printit("DB Name must be provided.")
+if args.runasync:
+    runasync = True;        
+if args.dbname == "" and args.dsn == "" and args.service == "" and args.benchclassify == 0:
+    printit("DB Name, DSN or service must be provided.")
     sys.exit(1)
 
 # if args.maxsize != -1:
@@ -307,15 +2688,93 @@ if pctfreeze > 99 or pctfreeze < 10:
 if min_dead_tups > 100:
     threshold_dead_tups = min_dead_tups
 
+if args.analyzemods != -1 and (args.analyzemods < 1 or args.analyzemods > 100):
+    printit("analyzemods must range between 1 and 100.")
+    sys.exit(1)
+threshold_analyze_mods = args.analyzemods
+hot_columns = parse_hot_columns(args.hotcolumns)
+bloatorder  = args.bloatorder
+emergency   = args.emergency
+lock_timeout = args.locktimeout
+replica_max_lag = args.maxlag
+catalog_cache_ttl = args.cachettl
+forecast_hours = args.forecasthours
+avaware = args.avaware
+avtune  = args.avtune
+distributed = args.distributed
+lease_secs  = args.leasesecs
+resume      = args.resume
+shutdown_grace = args.shutdowngrace
+if args.reindexpct != -1 and (args.reindexpct < 1 or args.reindexpct > 100):
+    printit("reindexpct must range between 1 and 100.")
+    sys.exit(1)
+reindex_pct = args.reindexpct
+job_budget  = args.jobbudget
+if args.costsync >= args.costasync:
+    printit("costsync must be less than costasync.")
+    sys.exit(1)
+cost_model_on   = args.costmodel
+cost_sync_secs  = args.costsync
+cost_async_secs = args.costasync
+if args.policy != "":
+    try:
+        policy_rules   = load_policy(args.policy)
+        policy_matcher = compile_policy(policy_rules)
+    except Exception as error:
+        printit("Invalid policy file %s: %s *** %s" % (args.policy, type(error), error))
+        sys.exit(1)
+base_max_processes = threshold_max_processes
+if args.workdir != "":
+    workdir = args.workdir
+
 inquiry = args.inquiry
+inquiry_sort   = args.inquirysort
+inquiry_top    = args.inquirytop
+inquiry_format = args.inquiryformat
+inquiry_out    = args.inquiryout
+export_dir     = args.export
+export_format  = args.exportformat
 if inquiry == 'all' or inquiry == 'found' or inquiry == '':
     pass
 else:
     printit("Inquiry parameter invalid.  Must be 'all' or 'found'")
     sys.exit(1)
+inquiry_only = args.inquiryonly
+if inquiry_only:
+    if inquiry == 'found':
+        printit("Inquiry 'found' needs a run to report on, it cannot be used with --inquiryonly.")
+        sys.exit(1)
+    inquiry = 'all'
+startup_mark('arguments')
+
+printit ("version: *** %s ***  Parms: dryrun(%r) inquiry(%s) freeze(%r) ignoreparts(%r) host:%s dbname=%s schema=%s dbuser=%s dbport=%d  Analyze max days:%d  Vacuumm max days:%d  min dead tups: %d  max table size: %d  pct freeze: %d  analyze mods: %d" \
+        % (version, dryrun, inquiry, freeze, ignoreparts, hostname, dbname, schema, dbuser, dbport, threshold_max_days_analyze, threshold_max_days_vacuum, threshold_dead_tups, threshold_max_size, pctfreeze, threshold_analyze_mods))
+
+# v5.3 feature: classification benchmark, no database needed
+if args.benchclassify > 0:
+    try:
+        import numpy
+    except ImportError:
+        printit ("numpy is not installed (pip install numpy), only the scalar path is available.")
+        sys.exit(1)
+    bench_classify(args.benchclassify)
+    sys.exit(0)
 
-printit ("version: *** %s ***  Parms: dryrun(%r) inquiry(%s) freeze(%r) ignoreparts(%r) host:%s dbname=%s schema=%s dbuser=%s dbport=%d  Analyze max days:%d  Vacuumm max days:%d  min dead tups: %d  max table size: %d  pct freeze: %d" \
-        % (version, dryrun, inquiry, freeze, ignoreparts, hostname, dbname, schema, dbuser, dbport, threshold_max_days_analyze, threshold_max_days_vacuum, threshold_dead_tups, threshold_max_size, pctfreeze))
+# Delay if high load encountered, give up after 30 minutes.
+# v5.8: report-only modes add no load worth deferring
+if not inquiry_only and not args.costreport:
+    cnt = 0
+    while True:
+        if highload():
+            printit("Deferring program start for another 5 minutes while high load encountered.")
+            cnt = cnt + 1
+            time.sleep(300)
+            if cnt > 5:
+                printit("Aborting program due to high load.")
+                sys.exit(1)
+        else:
+            break
+    startup_mark('load check')
 
 # printit ("Exiting program prematurely for debug purposes.")
 # sys.exit(0)
@@ -323,57 +2782,221 @@ printit ("version: *** %s ***  Parms: dryrun(%r) inquiry(%s) freeze(%r) ignorepa
 # Connect
 # conn = psycopg2.connect("dbname=testing user=postgres host=locahost password=postgrespass")
 # connstr = "dbname=%s port=%d user=%s host=%s password=postgrespass" % (dbname, dbport, dbuser, hostname )
-connstr = "dbname=%s port=%d user=%s host=%s application_name=%s" % (dbname, dbport, dbuser, hostname, 'pg_vacuum' )
+# v5.1: a DSN or service is passed to libpq as is, so sslmode, passfile, multiple hosts etc. work.  Keep passwords in a passfile, not the DSN.
+if args.dsn != "":
+    connstr = args.dsn
+elif args.service != "":
+    connstr = "service=%s" % args.service
+else:
+    connstr = "dbname=%s port=%d user=%s host=%s" % (dbname, dbport, dbuser, hostname)
+load_driver()
+startup_mark('driver import')
 try:
-    conn = psycopg2.connect(connstr)
+    conn = Session('pg_vacuum')
 except Exception as error:
     printit("Database Connection Error: %s *** %s" % (type(error), error))
     sys.exit (1)
         
 printit("connected to database successfully.")
+startup_mark('connect')
 
-# to run vacuum through the psycopg2 driver, the isolation level must be changed.
+# to run vacuum through the psycopg2 driver, the isolation level must be changed (done at connect time).
 old_isolation_level = conn.isolation_level
-conn.set_isolation_level(0)
 
 # Open a cursor to perform database operation
 cur = conn.cursor()
 
+# v5.1: with a DSN or service, take the names used for the cache, history and journal files from the session
+if dbname == "":
+    cur.execute("SELECT current_database(), coalesce(inet_server_port(), %s)", (dbport,))
+    dbname, dbport = cur.fetchone()
+    try:
+        # a socket directory here is mapped to 'local' in file names by file_host()
+        hostname = conn.get_dsn_parameters().get('host', hostname).split(',')[0]
+    except AttributeError:
+        pass
+
+# get version since 9.6 and earlier do not have a relispartition column in pg_class table
+# it will look something like this or this: 90618 or 100013, so anything greater than 100000 would be 10+ versions.
+# also it looks like we are not currently using the relispartition column anyway, so just remove it for now
+# substitute this case statement for c.relispartition wherever it is used.
+# CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False' ELSE 'True' END as partitioned 
+
+# v5.8: libpq already has it from the connection startup, the query is only for drivers too old to expose it
+try:
+    version = conn.server_version
+except AttributeError:
+    sql = "show server_version_num"
+    try:
+        cur.execute(sql)
+    except Exception as error:
+        printit ("Unable to get server version number: %s" % (error))
+        conn.close()
+        sys.exit (1)
+
+    rows = cur.fetchone()
+    version = int(rows[0])
+startup_mark('server version')
+
+# v5.8 feature: an inquiry on its own only reads the catalog, so it takes no locks and starts no run
+if inquiry_only:
+    try:
+        inquiry_report(get_catalog(conn, cur, refresh=True))
+    except Exception as error:
+        printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
+        conn.close()
+        sys.exit (1)
+    conn.close()
+    if args.benchstartup:
+        startup_mark('inquiry report')
+        startup_report()
+    printit ("End of Inquiry report.  Closing the connection and exiting normally.")
+    sys.exit(0)
+
 # Abort if a pg_vacuum instance is already running against this database.
-sql = "select count(*) from pg_stat_activity where application_name = 'pg_vacuum'"
+# v4.5: held as a session advisory lock, exclusive for a normal run and shared between distributed workers.
+if distributed:
+    sql = "select pg_try_advisory_lock_shared(hashtext('pg_vacuum'))"
+else:
+    sql = "select pg_try_advisory_lock(hashtext('pg_vacuum'))"
 try:
     cur.execute(sql)
 except Exception as error:
-    printit ("Unable to check for multiple pg_vacuum instances: %s" % (e))
+    printit ("Unable to check for multiple pg_vacuum instances: %s" % (error))
     conn.close()
     sys.exit (1)
 
 rows = cur.fetchone()
-instances = int(rows[0])
-if instances > 1:
-    printit ("pg_vacuum instance(s) already running (%d). This instance will close now." % (instances))
+if not rows[0]:
+    if distributed:
+        printit ("A non-distributed pg_vacuum instance is already running. This instance will close now.")
+    else:
+        printit ("pg_vacuum instance(s) already running. This instance will close now.")
     conn.close()
     sys.exit (1)
+conn.remember(sql, required=True)
 
-# get version since 9.6 and earlier do not have a relispartition column in pg_class table
-# it will look something like this or this: 90618 or 100013, so anything greater than 100000 would be 10+ versions.
-# also it looks like we are not currently using the relispartition column anyway, so just remove it for now
-# substitute this case statement for c.relispartition wherever it is used.
-# CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False' ELSE 'True' END as partitioned 
-
-sql = "show server_version_num"
+# v4.7: lock our run id so other runs can tell our jobs are not orphans, and remember our backend for shutdown
 try:
-    cur.execute(sql)
+    cur.execute("SELECT pg_backend_pid(), pg_try_advisory_lock(hashtext(%s))", (run_id,))
+    main_pid = cur.fetchone()[0]
 except Exception as error:
-    printit ("Unable to get server version number: %s" % (e))
+    printit ("Unable to lock the run id: %s" % (error))
     conn.close()
     sys.exit (1)
+conn.remember("SELECT pg_try_advisory_lock(hashtext(%s))", (run_id,), required=True)
+startup_mark('locks')
 
-rows = cur.fetchone()
-version = int(rows[0])
+# v5.8 feature: the startup benchmark stops before any work is done
+if args.benchstartup:
+    startup_report()
+    conn.close()
+    sys.exit(0)
 
 active_processes = 0
 
+# v3.8 feature: remember where WAL was at the start to report WAL generated by the run
+try:
+    wal_start = get_wal_lsn(conn, cur)
+except Exception as error:
+    printit ("Unable to get current WAL position: %s *** %s" % (type(error), error))
+
+# v4.1 feature: take the catalog snapshot used by the inquiry report up front
+# real runs take it too, so the report at the end only fetches the tables the run acted on again
+if inquiry != '' or export_dir != '':
+    try:
+        get_catalog(conn, cur)
+    except Exception as error:
+        printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
+        conn.close()
+        sys.exit (1)
+
+# v4.5 feature: distributed workers split the tables through leases
+if distributed:
+    if version < 90500:
+        printit ("Distributed mode requires PG 9.5+ (INSERT ... ON CONFLICT).")
+        conn.close()
+        sys.exit (1)
+    try:
+        setup_leases(conn, cur)
+    except Exception as error:
+        printit("Unable to set up the lease table %s: %s *** %s" % (lease_table, type(error), error), level='ERROR')
+        conn.close()
+        sys.exit (1)
+    printit ("Distributed mode: worker %s, leases in %s held for %d secs." % (worker_id, lease_table, lease_secs))
+
+# v3.7 feature: never wait forever on a table someone else has locked
+if lock_timeout > 0 and version >= 90300:
+    cur.execute("SET lock_timeout = '%ds'" % lock_timeout)
+
+# v3.5 feature: estimate reclaimable space so vacuums can be ordered by it
+if bloatorder or reindex_pct != -1:
+    bloat = estimate_bloat(conn, cur)
+    heapbloat  = sum([b[0] for b in bloat.values()])
+    indexbloat = sum([b[1] for b in bloat.values()])
+    printit ("Estimated reclaimable space: tables=%s  indexes=%s" % (pretty_bytes(heapbloat), pretty_bytes(indexbloat)))
+
+# v4.2 feature: sample the tables before acting on them and forecast which ones cross a threshold before the next run
+if forecast_hours > 0 and not emergency and not freeze:
+    forecast = forecast_maintenance(conn, cur)
+    printit ("Forecast: %d tables expected to cross their autovacuum or wraparound threshold within %d hours." % (len(forecast), forecast_hours))
+
+# v4.4 feature: autovacuum tuning is a mode of its own
+if avtune != '':
+    autovacuum_tune(conn, cur)
+    conn.close()
+    printit ("End of Autovacuum tuning action.  Closing the connection and exiting normally.")
+    sys.exit(0)
+
+# v5.7 feature: the cost model report is a mode of its own
+if args.costreport:
+    cost_report()
+    conn.close()
+    printit ("End of Cost model report.  Closing the connection and exiting normally.")
+    sys.exit(0)
+
+# v5.7 feature: place vacuums by their predicted duration.  Until the history has enough vacuums, the thresholds apply.
+if cost_model_on:
+    try:
+        relation_sizes = get_relation_sizes(conn, cur)
+    except Exception as error:
+        printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
+        conn.close()
+        sys.exit (1)
+    model = current_cost_model()
+    if model is None:
+        printit ("Cost model: not enough vacuums in the history yet (%d needed).  Using the size and rows thresholds." % cost_min_jobs)
+    else:
+        printit ("Cost model from %d vacuums: %.1f secs + %.1f secs per heap GB + %.1f secs per index GB" % (model['jobs'], model['base'], model['heap'], model['index']))
+
+# v5.5 feature: freezes cannot get past the oldest xmin still needed, so say what holds it back before doing any
+check_horizon(conn, cur, report=True)
+
+# v3.6 feature: in a wraparound emergency only freezing matters, so do it as fast as possible and exit.
+if emergency:
+    emergency_freeze(conn, cur)
+    if not dryrun:
+        wait_for_processes(conn,cur)
+    collect_verbose_logs(conn, cur)
+    vacuum_efficiency_report()
+    conn.close()
+    printit ("End of Emergency action.  Freezes: %d  Async Jobs: %d.  Closing the connection and exiting normally." % (total_freezes, asyncjobs))
+    sys.exit(0)
+
+# v4.6 feature: journal this run, and finish an interrupted one first if asked to
+if resume:
+    resumed = resume_run(conn, cur)
+    asyncjobs = asyncjobs + resumed
+    active_processes = active_processes + resumed
+elif not dryrun:
+    open_journal(set())
+
+# v4.7 feature: take over jobs a previous run left running
+try:
+    active_processes = active_processes + adopt_orphans(conn, cur)
+except Exception as error:
+    printit ("Unable to check for orphaned pg_vacuum jobs: %s *** %s" % (type(error), error))
+
 #################################
 # 1. Freeze Tables              #
 #################################
@@ -388,39 +3011,15 @@ SELECT n.nspname || '.' || c.relname as table, c.reltuples::bigint as rows, age(
 CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint as howclose,
 pg_size_pretty(pg_total_relation_size(c.oid)) as table_size_pretty, pg_total_relation_size(c.oid) as table_size, c.relispartition FROM pg_class c, pg_namespace n WHERE n.nspname = 'public' and n.oid = c.relnamespace and c.relkind not in ('i','v','S','c') AND CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint > 1::bigint and  CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint < 25000000 ORDER BY age(c.relfrozenxid) DESC LIMIT 60;
 '''
-if version > 100000:
-    if schema == "":
-       sql = "SELECT n.nspname || '.\"' || c.relname || '\"' as table, c.reltuples::bigint as rows, age(c.relfrozenxid) as xid_age, CAST(current_setting('autovacuum_freeze_max_age') AS bigint) as freeze_max_age, " \
-      "CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint as howclose, pg_size_pretty(pg_total_relation_size(c.oid)) as table_size_pretty,  " \
-      "pg_total_relation_size(c.oid) as table_size, c.relispartition FROM pg_class c, pg_namespace n WHERE n.nspname not in ('pg_catalog', 'pg_toast', 'information_schema') and n.oid = c.relnamespace and c.relkind not in ('i','v','S','c') AND CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - " \
-      "age(c.relfrozenxid)::bigint > 1::bigint and  CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint < %d ORDER BY age(c.relfrozenxid) DESC LIMIT 60" % (threshold_freeze)
-    else:
-       sql = "SELECT n.nspname || '.\"' || c.relname || '\"' as table, c.reltuples::bigint as rows, age(c.relfrozenxid) as xid_age, CAST(current_setting('autovacuum_freeze_max_age') AS bigint) as freeze_max_age, " \
-      "CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint as howclose, pg_size_pretty(pg_total_relation_size(c.oid)) as table_size_pretty,  " \
-      "pg_total_relation_size(c.oid) as table_size, c.relispartition FROM pg_class c, pg_namespace n WHERE n.nspname = '%s' and n.oid = c.relnamespace and c.relkind not in ('i','v','S','c') AND CAST(current_setting('autovacuum_freeze_max_age') " \
-      "AS bigint) - age(c.relfrozenxid)::bigint > 1::bigint and  CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint < %d ORDER BY age(c.relfrozenxid) DESC LIMIT 60" % (schema, threshold_freeze)
-else:
-# put version 9.x compatible query here
-# CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False' ELSE 'True' END as partitioned 
-    if schema == "":
-       sql = "SELECT n.nspname || '.\"' || c.relname || '\"' as table, c.reltuples::bigint as rows, age(c.relfrozenxid) as xid_age, CAST(current_setting('autovacuum_freeze_max_age') AS bigint) as freeze_max_age, " \
-      "CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint as howclose, pg_size_pretty(pg_total_relation_size(c.oid)) as table_size_pretty,  " \
-      "pg_total_relation_size(c.oid) as table_size, CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False'::boolean ELSE 'True'::boolean END as partitioned FROM pg_class c, pg_namespace n WHERE n.nspname not in ('pg_catalog', 'pg_toast', 'information_schema') and n.oid = c.relnamespace and c.relkind not in ('i','v','S','c') AND CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - " \
-      "age(c.relfrozenxid)::bigint > 1::bigint and  CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint < %d ORDER BY age(c.relfrozenxid) DESC LIMIT 60" % (threshold_freeze)
-    else:
-       sql = "SELECT n.nspname || '.\"' || c.relname || '\"' as table, c.reltuples::bigint as rows, age(c.relfrozenxid) as xid_age, CAST(current_setting('autovacuum_freeze_max_age') AS bigint) as freeze_max_age, " \
-      "CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint as howclose, pg_size_pretty(pg_total_relation_size(c.oid)) as table_size_pretty,  " \
-      "pg_total_relation_size(c.oid) as table_size, CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False'::boolean ELSE 'True'::boolean END as partitioned FROM pg_class c, pg_namespace n WHERE n.nspname = '%s' and n.oid = c.relnamespace and c.relkind not in ('i','v','S','c') AND CAST(current_setting('autovacuum_freeze_max_age') " \
-      "AS bigint) - age(c.relfrozenxid)::bigint > 1::bigint and  CAST(current_setting('autovacuum_freeze_max_age') AS bigint) - age(c.relfrozenxid)::bigint < %d ORDER BY age(c.relfrozenxid) DESC LIMIT 60" % (schema, threshold_freeze)
-      
+# v5.4: heap, TOAST and multixact headroom together, the nearest limit decides
+sql = freeze_candidates_sql()
 try:
-     cur.execute(sql)
+     rows = order_by_policy(catalog_query(conn, cur, sql))
 except Exception as error:
     printit("Freeze Tables Exception: %s *** %s" % (type(error), error))
     conn.close()
     sys.exit (1)     
 
-rows = cur.fetchall()
 if len(rows) == 0:
     printit ("No FREEZEs need to be done.")
 else:
@@ -432,7 +3031,7 @@ action_name = 'VACUUM FREEZE'
 if not dryrun and len(rows) > 0 and not freeze:
     printit ('Bypassing VACUUM FREEZE action for %d tables. Otherwise specify "--freeze" to do them.' % len(rows))
 
-for row in rows:
+for row, bucket in zip(rows, classify(rows, 6, 1, (2, 3))):
     if not freeze and not dryrun:
         continue
     if active_processes > threshold_max_processes:
@@ -455,28 +3054,43 @@ for row in rows:
     sizep    = row[5]
     size     = row[6]
     part     = row[7]
+    nearest  = row[8]
+    toast    = row[9]
+    toast_headroom = row[10]
+    xid_headroom   = row[11]
 
     if part and ignoreparts:
         partcnt = partcnt + 1    
         #print ("ignoring partitioned table: %s" % table)
         continue
 
+    # v4.9: policy exclusions (its per-table thresholds are applied by classify)
+    if policy_excludes(table):
+        continue
+
     # also bypass tables that are less than 15% of max age
     pctmax = float(xidage) / float(maxage)
     # print("maxage=%10f  xidage=%10f  pctmax=%4f  pctfreeze=%4f" % (maxage, xidage, pctmax, pctfreeze))
-    if (100 * pctmax) < float(pctfreeze):
+    sql, setting = freeze_cmd(table, nearest, toast, toast_headroom, xid_headroom)
+    if nearest != 'xid' and bucket != HOLD:
+        printit ("      %s is nearest its %s limit: %s" % (table, 'TOAST xid' if nearest == 'toast' else 'multixact', sql))
+    # v5.5: multixacts have no visible horizon, xid freezes wait while a blocker keeps them from gaining anything
+    if nearest != 'mxid' and bucket != HOLD and freeze_blocked(conn, cur, table, xidage):
+        tables_skipped = tables_skipped + 1
+        continue
+    if bucket == HOLD:
        printit ("Async %13s  %03d %-57s rows: %11d  size: %10s :%13d freeze_max: %10d  xid_age: %10d  how close: %10d  pct: %d: Defer" \
                % (action_name, cnt, table, tups, sizep, size, maxage, xidage, howclose, 100 * pctmax))
        tables_skipped = tables_skipped + 1
        continue
 
-       if size > threshold_max_size:
+       if bucket == DEFER:
           # defer action
           printit ("Async %13s  %03d %-57s rows: %11d size: %10s :%13d freeze_max: %10d  xid_age: %10d  how close: %10d NOTICE: Skipping large table.  Do manually." \
                   % (action_name, cnt, table, tups, sizep, size, maxage, xidage, howclose))
           tables_skipped = tables_skipped + 1
           continue
-    elif tups > threshold_async_rows or size > threshold_max_sync:
+    elif bucket == ASYNC:
     #elif (tups > threshold_async_rows or size > threshold_max_sync) and async:
         if dryrun:
             if active_processes > threshold_max_processes:
@@ -485,25 +3099,24 @@ for row in rows:
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d freeze_max: %10d  xid_age: %10d  how close: %10d  pct: %d" % (action_name, cnt, table, tups, sizep, size, maxage, xidage, howclose, (100 * pctmax)))
             total_freezes = total_freezes + 1
-            tablist.append(table)
+            tablist.add(table)
             active_processes = active_processes + 1
         else:
             if active_processes > threshold_max_processes:
                 printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %s.  Size=%s.  Do manually." % (action_name, table, sizep))
                 tables_skipped = tables_skipped + 1
                 continue
-            # v3.1 change to include application name
-            connparms = "dbname=%s port=%d user=%s host=%s application_name=%s" % (dbname, dbport, dbuser, hostname, 'pg_vacuum' )
-            # cmd = 'nohup psql -h %s -d %s -p %s -U %s -c "VACUUM (FREEZE, VERBOSE) %s" 2>/dev/null &' % (hostname, dbname, dbport, dbuser, table)
-            cmd = 'nohup psql -d "%s" -c "VACUUM (FREEZE, VERBOSE) %s" 2>/dev/null &' % (connparms, table)
-            print(cmd)
             time.sleep(0.5)
-            asyncjobs = asyncjobs + 1
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d freeze_max: %10d  xid_age: %10d  how close: %10d  pct: %d" % (action_name, cnt, table, tups, sizep, size, maxage, xidage, howclose, (100 * pctmax)))
-            rc = execute_cmd(cmd)
-            total_freezes = total_freezes + 1
-            tablist.append(table)
-            active_processes = active_processes + 1
+            if setting != '':
+                rc = run_async(conn, cur, sql, table, '-c %s' % setting, size=size, avdefer=False)
+            else:
+                rc = run_async(conn, cur, sql, table, size=size, avdefer=False)
+            if rc == OK:
+                asyncjobs = asyncjobs + 1
+                total_freezes = total_freezes + 1
+                tablist.add(table)
+                active_processes = active_processes + 1
 
     else:
         if dryrun:
@@ -511,15 +3124,15 @@ for row in rows:
             total_freezes = total_freezes + 1
         else:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d freeze_max: %10d  xid_age: %10d  how close: %10d  pct: %d" % (action_name, cnt, table, tups, sizep, size, maxage, xidage, howclose, (100 * pctmax)))
-            sql = "VACUUM (FREEZE, VERBOSE) %s" % table
             time.sleep(0.5)
-            try:
-                cur.execute(sql)
-            except Exception as error:
-                printit("Exception: %s *** %s" % (type(error), error))
+            if setting != '':
+                rc = run_sync(conn, cur, sql, table, size=size, avdefer=False, pgoptions='-c %s' % setting)
+            else:
+                rc = run_sync(conn, cur, sql, table, size=size, avdefer=False)
+            if rc != OK:
                 continue
             total_freezes = total_freezes + 1
-            tablist.append(table)            
+            tablist.add(table)            
 
 if ignoreparts:
     printit ("Partitioned table vacuum freezes bypassed=%d" % partcnt)
@@ -527,7 +3140,16 @@ if ignoreparts:
 
 # if action is freeze just exit at this point gracefully
 if freeze:
+   save_catalog_cache()
+   close_journal()
+   # async freezes write their VERBOSE logs as they finish, and reading them needs the connection for table sizes
+   if not dryrun:
+       wait_for_processes(conn,cur)
+   collect_verbose_logs(conn, cur)
    conn.close()
+   if freezes_suspended > 0:
+       printit ("Freezes suspended by the xmin horizon: %d" % freezes_suspended)
+   vacuum_efficiency_report()
    printit ("End of Freeze action.  Closing the connection and exiting normally.")
    sys.exit(0)
 
@@ -608,13 +3230,14 @@ else:
 
       
 try:
-     cur.execute(sql)
+     rows = order_by_policy(catalog_query(conn, cur, sql))
 except Exception as error:
-    printit("Exception: %s *** %s" % (type(error), error))
+    printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
     conn.close()
     sys.exit (1)
 
-rows = cur.fetchall()
+if bloatorder:
+    rows = order_by_bloat(rows)
 if len(rows) == 0:
     printit ("No vacuum/analyze pairs to be done.")
 else:
@@ -623,7 +3246,7 @@ else:
 cnt = 0
 partcnt = 0
 action_name = 'VAC/ANALYZE'
-for row in rows:
+for row, bucket in zip(rows, classify(rows, 2, 3)):
     if active_processes > threshold_max_processes:
         # see how many are currently running and update the active processes again
         # rc = get_process_cnt()
@@ -653,61 +3276,53 @@ for row in rows:
     if skip_table(table, tablist):
         continue
 
-    if size > threshold_max_size:
+    if bucket == DEFER:
         # defer action
         if dryrun:
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, dead))
-            tablist.append(table)
+            tablist.add(table)
             tables_skipped = tables_skipped + 1
         continue
-    elif tups > threshold_async_rows or size > threshold_max_sync:
+    elif bucket == ASYNC:
     #elif (tups > threshold_async_rows or size > threshold_max_sync) and async:
         if dryrun:
             if active_processes > threshold_max_processes:
                 printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %s.  Size=%s.  Do manually." % (action_name, table, sizep))
                 tables_skipped = tables_skipped + 1
-                tablist.append(table)
+                tablist.add(table)
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             total_vacuums_analyzes = total_vacuums_analyzes + 1
-            tablist.append(table)
+            tablist.add(table)
             active_processes = active_processes + 1
         else:
             if active_processes > threshold_max_processes:
                 printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %s.  Size=%s.  Do manually." % (action_name, table, sizep))
-                tablist.append(table)
+                tablist.add(table)
                 tables_skipped = tables_skipped + 1
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            asyncjobs = asyncjobs + 1
-            
-            # v3.1 change to include application name
-            connparms = "dbname=%s port=%d user=%s host=%s application_name=%s" % (dbname, dbport, dbuser, hostname, 'pg_vacuum' )
-            # cmd = 'nohup psql -h %s -d %s -p %s -U %s -c "VACUUM (ANALYZE, VERBOSE) %s" 2>/dev/null &' % (hostname, dbname, dbport, dbuser, table)
-            cmd = 'nohup psql -d "%s" -c "VACUUM (ANALYZE, VERBOSE) %s" 2>/dev/null &' % (connparms, table)            
-
             time.sleep(0.5)
-            rc = execute_cmd(cmd)
-            total_vacuums_analyzes = total_vacuums_analyzes + 1
-            tablist.append(table)
-            active_processes = active_processes + 1
+            rc = run_async(conn, cur, "VACUUM (ANALYZE, VERBOSE) %s" % table, table, size=size)
+            if rc == OK:
+                asyncjobs = asyncjobs + 1
+                total_vacuums_analyzes = total_vacuums_analyzes + 1
+                tablist.add(table)
+                active_processes = active_processes + 1
 
     else:
         if dryrun:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             total_vacuums_analyzes = total_vacuums_analyzes + 1
-            tablist.append(table)
+            tablist.add(table)
         else:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             sql = "VACUUM (ANALYZE, VERBOSE) %s" % table
             time.sleep(0.5)
-            try:
-                cur.execute(sql)
-            except Exception as error:
-                printit("Exception: %s *** %s" % (type(error), error))
-                continue            
+            if run_sync(conn, cur, sql, table, size=size) != OK:
+                continue
             total_vacuums_analyzes = total_vacuums_analyzes + 1
-            tablist.append(table)
+            tablist.add(table)
 
 if ignoreparts:
     printit ("Partitioned table vacuum/analyzes bypassed=%d" % partcnt)
@@ -772,13 +3387,14 @@ else:
       "FROM pg_stat_user_tables psut JOIN pg_class on psut.relid = pg_class.oid  where psut.schemaname = '%s' and (psut.n_dead_tup > %d OR (last_vacuum is null and last_autovacuum is null)) ORDER BY 5 desc, 1;" % (schema, threshold_dead_tups)
       
 try:
-     cur.execute(sql)
+     rows = order_by_policy(catalog_query(conn, cur, sql))
 except Exception as error:
-    printit("Exception: %s *** %s" % (type(error), error))
+    printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
     conn.close()
     sys.exit (1)
     
-rows = cur.fetchall()
+if bloatorder:
+    rows = order_by_bloat(rows)
 if len(rows) == 0:
     printit ("No vacuums to be done.")
 else:
@@ -787,7 +3403,7 @@ else:
 cnt = 0
 partcnt = 0
 action_name = 'VACUUM'
-for row in rows:
+for row, bucket in zip(rows, classify(rows, 6, 3)):
     if active_processes > threshold_max_processes:
         # see how many are currently running and update the active processes again
         # rc = get_process_cnt()
@@ -818,13 +3434,13 @@ for row in rows:
     #else:
         #printit("table = %s will NOT be skipped." % table)
 
-    if size > threshold_max_size:
+    if bucket == DEFER:
         # defer action
         printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, dead))
         tables_skipped = tables_skipped + 1
-        tablist.append(table)
+        tablist.add(table)
         continue
-    elif tups > threshold_async_rows or size > threshold_max_sync:
+    elif bucket == ASYNC:
     #elif (tups > threshold_async_rows or size > threshold_max_sync) and async:
         if dryrun:
             if active_processes > threshold_max_processes:
@@ -832,7 +3448,7 @@ for row in rows:
                 tables_skipped = tables_skipped + 1
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            tablist.append(table)
+            tablist.add(table)
             total_vacuums  = total_vacuums + 1
             active_processes = active_processes + 1
         else:
@@ -841,40 +3457,216 @@ for row in rows:
                 tables_skipped = tables_skipped + 1
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            asyncjobs = asyncjobs + 1
-            
-            # v3.1 change to include application name
-            connparms = "dbname=%s port=%d user=%s host=%s application_name=%s" % (dbname, dbport, dbuser, hostname, 'pg_vacuum' )
-            # cmd = 'nohup psql -h %s -d %s -p %s -U %s -c "VACUUM VERBOSE %s" 2>/dev/null &' % (hostname, dbname, dbport, dbuser, table)
-            cmd = 'nohup psql -d "%s" -c "VACUUM VERBOSE %s" 2>/dev/null &' % (connparms, table)                        
-
             time.sleep(0.5)
-            rc = execute_cmd(cmd)
-            total_vacuums  = total_vacuums + 1
-            active_processes = active_processes + 1
-            tablist.append(table)
+            rc = run_async(conn, cur, "VACUUM VERBOSE %s" % table, table, size=size)
+            if rc == OK:
+                asyncjobs = asyncjobs + 1
+                total_vacuums  = total_vacuums + 1
+                active_processes = active_processes + 1
+                tablist.add(table)
 
     else:
         if dryrun:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             total_vacuums  = total_vacuums + 1
-            tablist.append(table)
+            tablist.add(table)
         else:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" %  (action_name, cnt, table, tups, sizep, size, dead))
             sql = "VACUUM VERBOSE %s" % table
             time.sleep(0.5)
-            try:
-                cur.execute(sql)
-            except Exception as error:
-                printit("Exception: %s *** %s" % (type(error), error))
+            if run_sync(conn, cur, sql, table, size=size) != OK:
                 continue
             total_vacuums  = total_vacuums + 1
-            tablist.append(table)
+            tablist.add(table)
 
 if ignoreparts:
     printit ("Partitioned table vacuums bypassed=%d" % partcnt)
     partitioned_tables_skipped = partitioned_tables_skipped + partcnt
     
+#################################
+# 3a. Analyze on Modified Tables#
+#################################
+# V3.4: Introduced. Uses n_mod_since_analyze (9.4+) instead of days since the last analyze.
+'''
+SELECT u.schemaname || '.' || u.relname as table, c.reltuples::bigint, u.n_live_tup::bigint, u.n_dead_tup::bigint, pg_size_pretty(pg_total_relation_size(c.oid)), pg_total_relation_size(c.oid) as size, c.relispartition,
+u.n_mod_since_analyze, CASE WHEN c.reltuples > 0 THEN round((u.n_mod_since_analyze / c.reltuples)::numeric * 100, 2) ELSE 100 END as modpct
+FROM pg_stat_user_tables u JOIN pg_class c ON u.relid = c.oid WHERE u.schemaname not in ('pg_catalog', 'pg_toast', 'information_schema') ORDER BY 9 DESC, 1;
+'''
+if threshold_analyze_mods != -1 and version < 90400:
+    printit ("Analyze modifications threshold ignored since n_mod_since_analyze requires PG 9.4+")
+    threshold_analyze_mods = -1
+
+if threshold_analyze_mods != -1:
+    if version > 100000:
+        partexpr = "c.relispartition"
+    else:
+        partexpr = "CASE WHEN (SELECT c.relname AS child FROM pg_inherits i JOIN pg_class p ON (i.inhparent=p.oid) where i.inhrelid=c.oid) IS NULL THEN 'False'::boolean ELSE 'True'::boolean END"
+    if schema == "":
+        schemafilter = "u.schemaname not in ('pg_catalog', 'pg_toast', 'information_schema')"
+    else:
+        schemafilter = "u.schemaname = '%s'" % schema
+    sql = "SELECT u.schemaname || '.\"' || u.relname || '\"' as table, c.reltuples::bigint, u.n_live_tup::bigint, u.n_dead_tup::bigint, pg_size_pretty(pg_total_relation_size(c.oid)), " \
+          "pg_total_relation_size(c.oid) as size, %s as partitioned, u.n_mod_since_analyze, " \
+          "CASE WHEN c.reltuples > 0 THEN round((u.n_mod_since_analyze / c.reltuples)::numeric * 100, 2) ELSE 100 END as modpct " \
+          "FROM pg_stat_user_tables u JOIN pg_class c ON u.relid = c.oid WHERE %s ORDER BY 9 DESC, 1" % (partexpr, schemafilter)
+    try:
+        rows = order_by_policy(catalog_query(conn, cur, sql))
+    except Exception as error:
+        printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
+        conn.close()
+        sys.exit (1)
+
+    # remember modifications for all tables so the day-based analyze phases can bypass unchanged ones
+    for row in rows:
+        analyze_mods[row[0]] = int(row[7])
+    rows = [row for row in rows if row[7] > 0 and row[8] >= threshold_analyze_mods]
+    if len(rows) == 0:
+        printit ("No modified tables require analyzes to be done.")
+    else:
+        printit ("Modified table analyzes to be evaluated=%d" % len(rows) )
+
+    cnt = 0
+    partcnt = 0
+    action_name = 'ANALYZE(MOD)'
+    for row, bucket in zip(rows, classify(rows, 5, 1)):
+        cnt = cnt + 1
+        table  = row[0]
+        tups   = row[1]
+        dead   = row[3]
+        sizep  = row[4]
+        size   = row[5]
+        part   = row[6]
+        modpct = row[8]
+
+        if part and ignoreparts:
+            partcnt = partcnt + 1
+            continue
+
+        # check if we already processed this table
+        if skip_table(table, tablist):
+            continue
+
+        if active_processes > threshold_max_processes:
+            # see how many are currently running and update the active processes again
+            rc = get_query_cnt(conn, cur)
+            if rc > threshold_max_processes:
+                printit ("Current process cnt(%d) is still higher than threshold (%d). Sleeping for 5 minutes..." % (rc, threshold_max_processes))
+                time.sleep(300)
+            else:
+                printit ("Current process cnt(%d) is less than threshold (%d).  Processing will continue..." % (rc, threshold_max_processes))
+            active_processes = rc
+
+        if bucket == DEFER:
+            printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d modpct: %6.2f NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, modpct))
+            tables_skipped = tables_skipped + 1
+            continue
+        elif bucket == ASYNC:
+            if active_processes > threshold_max_processes:
+                printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %s.  Size=%s.  Do manually." % (action_name, table, sizep))
+                tables_skipped = tables_skipped + 1
+                continue
+            printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d modpct: %6.2f" % (action_name, cnt, table, tups, sizep, size, modpct))
+            if not dryrun:
+                time.sleep(0.5)
+                if run_async(conn, cur, analyze_cmd(conn, cur, table), table, size=size) != OK:
+                    continue
+                asyncjobs = asyncjobs + 1
+            tablist.add(table)
+            active_processes = active_processes + 1
+            total_analyzes  = total_analyzes + 1
+        else:
+            printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d modpct: %6.2f" % (action_name, cnt, table, tups, sizep, size, modpct))
+            tablist.add(table)
+            if not dryrun:
+                sql = analyze_cmd(conn, cur, table)
+                time.sleep(0.5)
+                if run_sync(conn, cur, sql, table, size=size) != OK:
+                    continue
+            total_analyzes  = total_analyzes + 1
+
+    if ignoreparts:
+        printit ("Modified partitioned table analyzes bypassed=%d" % partcnt)
+        partitioned_tables_skipped = partitioned_tables_skipped + partcnt
+
+#################################
+# 3b. Forecast Vacuums          #
+#################################
+# V4.2: Introduced. Tables the history says will cross their autovacuum or wraparound threshold before the next run.
+if forecast_hours > 0:
+    if len(forecast) == 0:
+        printit ("No forecast vacuums to be done.")
+    else:
+        printit ("Forecast vacuums to be evaluated=%d" % len(forecast) )
+
+    cnt = 0
+    partcnt = 0
+    # forecast rows are (table, action, eta, tups, sizep, size, ...), both actions are vacuums for the cost model
+    action_name = 'VACUUM(F)'
+    for row, bucket in zip(forecast, classify(forecast, 5, 3)):
+        cnt = cnt + 1
+        table, action, eta, tups, sizep, size, part, xidage = row
+        action_name = action + '(F)'
+
+        if part and ignoreparts:
+            partcnt = partcnt + 1
+            continue
+
+        # check if we already processed this table
+        if skip_table(table, tablist):
+            continue
+        # v5.5: a freeze the xmin horizon keeps from gaining anything waits, as in phase 1
+        if action == 'VACUUM FREEZE' and freeze_blocked(conn, cur, table, xidage):
+            tables_skipped = tables_skipped + 1
+            continue
+        # the parenthesized form, so SKIP_LOCKED, policy and fallback options can be added to it
+        if action == 'VACUUM FREEZE':
+            sql = "VACUUM (FREEZE, VERBOSE) %s" % table
+        else:
+            sql = "VACUUM VERBOSE %s" % table
+
+        if active_processes > threshold_max_processes:
+            # see how many are currently running and update the active processes again
+            rc = get_query_cnt(conn, cur)
+            if rc > threshold_max_processes:
+                printit ("Current process cnt(%d) is still higher than threshold (%d). Sleeping for 5 minutes..." % (rc, threshold_max_processes))
+                time.sleep(300)
+            else:
+                printit ("Current process cnt(%d) is less than threshold (%d).  Processing will continue..." % (rc, threshold_max_processes))
+            active_processes = rc
+
+        if bucket == DEFER:
+            printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d eta: %7.1f hrs NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, eta / 3600))
+            tables_skipped = tables_skipped + 1
+            continue
+        elif bucket == ASYNC:
+            if active_processes > threshold_max_processes:
+                printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %s.  Size=%s.  Do manually." % (action_name, table, sizep))
+                tables_skipped = tables_skipped + 1
+                continue
+            printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d eta: %7.1f hrs" % (action_name, cnt, table, tups, sizep, size, eta / 3600))
+            if not dryrun:
+                time.sleep(0.5)
+                if run_async(conn, cur, sql, table, size=size) != OK:
+                    continue
+                asyncjobs = asyncjobs + 1
+            tablist.add(table)
+            active_processes = active_processes + 1
+        else:
+            printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d eta: %7.1f hrs" % (action_name, cnt, table, tups, sizep, size, eta / 3600))
+            tablist.add(table)
+            if not dryrun:
+                time.sleep(0.5)
+                if run_sync(conn, cur, sql, table, size=size) != OK:
+                    continue
+        if action == 'VACUUM FREEZE':
+            total_freezes = total_freezes + 1
+        else:
+            total_vacuums = total_vacuums + 1
+
+    if ignoreparts:
+        printit ("Forecast partitioned table vacuums bypassed=%d" % partcnt)
+        partitioned_tables_skipped = partitioned_tables_skipped + partcnt
+
 #################################
 # 4. Analyze on Small Tables    #
 #################################
@@ -918,13 +3710,12 @@ else:
       "and pg_total_relation_size(quote_ident(n.nspname) || '.' || quote_ident(c.relname)) <= %d order by 1,2" % (schema, threshold_max_days_analyze, threshold_min_size)
 
 try:
-    cur.execute(sql)
+    rows = order_by_policy(catalog_query(conn, cur, sql))
 except Exception as error:
-    printit("Exception: %s *** %s" % (type(error), error))
+    printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
     conn.close()
     sys.exit (1)    
       
-rows = cur.fetchall()
 if len(rows) == 0:
     printit ("No small tables require analyzes to be done.")
 else:
@@ -933,7 +3724,7 @@ else:
 cnt = 0
 partcnt = 0
 action_name = 'ANALYZE'
-for row in rows:
+for row, bucket in zip(rows, classify(rows, 5)):
     cnt = cnt + 1
     table= row[0]
     tups = row[1]
@@ -951,20 +3742,41 @@ for row in rows:
     if skip_table(table, tablist):
         continue
 
-    if dryrun:
+    # v3.4: bypass tables not modified since their last analyze
+    if not analyze_is_stale(table):
+        continue
+
+    # small tables only leave the sync bucket under policy thresholds below the min size
+    if bucket == DEFER:
+        printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, dead))
+        tables_skipped = tables_skipped + 1
+        continue
+    elif bucket == ASYNC:
+        if active_processes > threshold_max_processes:
+            printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %-57s.  Size=%s.  Do manually." % (action_name, table, sizep))
+            tables_skipped = tables_skipped + 1
+            continue
+        printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
+        if not dryrun:
+            time.sleep(0.5)
+            if run_async(conn, cur, analyze_cmd(conn, cur, table), table, size=size) != OK:
+                continue
+            asyncjobs = asyncjobs + 1
+        tablist.add(table)
+        active_processes = active_processes + 1
+        total_analyzes  = total_analyzes + 1
+    elif dryrun:
         printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
         total_analyzes  = total_analyzes + 1
-        tablist.append(table)
+        tablist.add(table)
     else:
         printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-        sql = "ANALYZE VERBOSE %s" % table
+        tablist.add(table)
+        sql = analyze_cmd(conn, cur, table)
         time.sleep(0.5)
+        if run_sync(conn, cur, sql, table, size=size) != OK:
+            continue
         total_analyzes  = total_analyzes + 1
-        tablist.append(table)
-        try:
-            cur.execute(sql)
-        except Exception as error:
-            printit("Exception: %s *** %s" % (type(error), error))
 
 if ignoreparts:
     printit ("Small partitioned table analyzes bypassed=%d" % partcnt)
@@ -1022,13 +3834,12 @@ else:
       "now()::date - last_autoanalyze::date > %d)) and pg_total_relation_size(quote_ident(n.nspname) || '.' || quote_ident(c.relname)) > %d order by 1,2;" % (schema, threshold_max_days_analyze,threshold_max_days_analyze, threshold_min_size)
 
 try:
-    cur.execute(sql)
+    rows = order_by_policy(catalog_query(conn, cur, sql))
 except Exception as error:
-    printit("Exception: %s *** %s" % (type(error), error))
+    printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
     conn.close()
     sys.exit (1)
 
-rows = cur.fetchall()
 if len(rows) == 0:
     printit ("No stale tables require analyzes to be done.")
 else:
@@ -1037,7 +3848,7 @@ else:
 cnt = 0
 partcnt = 0
 action_name = 'ANALYZE'
-for row in rows:
+for row, bucket in zip(rows, classify(rows, 5)):
     cnt = cnt + 1
     table= row[0]
     tups = row[1]
@@ -1055,6 +3866,10 @@ for row in rows:
     if skip_table(table, tablist):
         continue
 
+    # v3.4: bypass tables not modified since their last analyze
+    if not analyze_is_stale(table):
+        continue
+
     # skip tables that are too large
     if active_processes > threshold_max_processes:
         # see how many are currently running and update the active processes again
@@ -1067,7 +3882,7 @@ for row in rows:
             printit ("Current process cnt(%d) is less than threshold (%d).  Processing will continue..." % (rc, threshold_max_processes))
         active_processes = rc
 
-    if size > threshold_max_size:
+    if bucket == DEFER:
         if dryrun:
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, dead))
             tables_skipped = tables_skipped + 1
@@ -1075,7 +3890,7 @@ for row in rows:
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, dead))
             tables_skipped = tables_skipped + 1
         continue
-    elif size > threshold_max_sync:
+    elif bucket == ASYNC:
         if dryrun:
             if active_processes > threshold_max_processes:
                 printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %-57s.  Size=%s.  Do manually." % (action_name, table, sizep))
@@ -1084,39 +3899,31 @@ for row in rows:
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             active_processes = active_processes + 1
             total_analyzes  = total_analyzes + 1
-            tablist.append(table)
+            tablist.add(table)
         else:
             if active_processes > threshold_max_processes:
                 printit ("%13s: Max processes reached. Skipping further Async activity for very large table, %-57s.  Size=%s.  Do manually." % (action_name, table, sizep))
                 tables_skipped = tables_skipped + 1
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            tablist.append(table)
-            asyncjobs = asyncjobs + 1
-            
-            # v3.1 change to include application name
-            connparms = "dbname=%s port=%d user=%s host=%s application_name=%s" % (dbname, dbport, dbuser, hostname, 'pg_vacuum' )
-            # cmd = 'nohup psql -h %s -d %s -p %s -U %s -c "ANALYZE VERBOSE %s" 2>/dev/null &' % (hostname, dbname, dbport, dbuser, table)
-            cmd = 'nohup psql -d "%s" -c "ANALYZE VERBOSE %s" 2>/dev/null &' % (connparms, table)                                    
-            
             time.sleep(0.5)
-            rc = execute_cmd(cmd)
-            active_processes = active_processes + 1
-            total_analyzes  = total_analyzes + 1
+            rc = run_async(conn, cur, analyze_cmd(conn, cur, table), table, size=size)
+            if rc == OK:
+                tablist.add(table)
+                asyncjobs = asyncjobs + 1
+                active_processes = active_processes + 1
+                total_analyzes  = total_analyzes + 1
     else:
         if dryrun:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             total_analyzes  = total_analyzes + 1
-            tablist.append(table)
+            tablist.add(table)
         else:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            tablist.append(table)
-            sql = "ANALYZE VERBOSE %s" % table
+            tablist.add(table)
+            sql = analyze_cmd(conn, cur, table)
             time.sleep(0.5)
-            try:
-                cur.execute(sql)
-            except Exception as error:
-                printit("Exception: %s *** %s" % (type(error), error))
+            if run_sync(conn, cur, sql, table, size=size) != OK:
                 continue
             total_analyzes  = total_analyzes + 1
 if ignoreparts:
@@ -1171,13 +3978,12 @@ else:
       "and t.tablename = c.relname and c.relname = u.relname and u.schemaname = n.nspname  AND  " \
       "now()::date - GREATEST(last_analyze, last_autoanalyze)::date > 30  order by 4,1" % (schema)
 try:
-    cur.execute(sql)
+    rows = order_by_policy(catalog_query(conn, cur, sql))
 except Exception as error:
-    printit("Exception: %s *** %s" % (type(error), error))
+    printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
     conn.close()
     sys.exit (1)
 
-rows = cur.fetchall()
 if len(rows) == 0:
     printit ("No very old analyzes to be done.")
 else:
@@ -1186,7 +3992,7 @@ else:
 cnt = 0
 partcnt = 0
 action_name = 'ANALYZE(2)'
-for row in rows:
+for row, bucket in zip(rows, classify(rows, 2, 3)):
     if active_processes > threshold_max_processes:
         # see how many are currently running and update the active processes again
         # rc = get_process_cnt()
@@ -1216,13 +4022,17 @@ for row in rows:
     if skip_table(table, tablist):
         continue
 
-    if size > threshold_max_size:
+    # v3.4: bypass tables not modified since their last analyze
+    if not analyze_is_stale(table):
+        continue
+
+    if bucket == DEFER:
         # defer action
         if dryrun:
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, sizep, size, dead))
             tables_skipped = tables_skipped + 1
         continue
-    elif tups > threshold_async_rows or size > threshold_max_sync:
+    elif bucket == ASYNC:
     #elif (tups > threshold_async_rows or size > threshold_max_sync) and async:
         if dryrun:
             if active_processes > threshold_max_processes:
@@ -1231,7 +4041,7 @@ for row in rows:
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             total_analyzes = total_analyzes + 1
-            tablist.append(table)
+            tablist.add(table)
             active_processes = active_processes + 1
         else:
             if active_processes > threshold_max_processes:
@@ -1239,34 +4049,26 @@ for row in rows:
                 tables_skipped = tables_skipped + 1
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            asyncjobs = asyncjobs + 1
-            
-            # v3.1 change to include application name
-            connparms = "dbname=%s port=%d user=%s host=%s application_name=%s" % (dbname, dbport, dbuser, hostname, 'pg_vacuum' )
-            # cmd = 'nohup psql -h %s -d %s -p %s -U %s -c "ANALYZE VERBOSE %s" 2>/dev/null &' % (hostname, dbname, dbport, dbuser, table)
-            cmd = 'nohup psql -d "%s" -c "ANALYZE VERBOSE %s" 2>/dev/null &' % (connparms, table)                                                
-            
             time.sleep(0.5)
-            rc = execute_cmd(cmd)
-            total_analyzes = total_analyzes + 1
-            tablist.append(table)
-            active_processes = active_processes + 1
+            rc = run_async(conn, cur, analyze_cmd(conn, cur, table), table, size=size)
+            if rc == OK:
+                asyncjobs = asyncjobs + 1
+                total_analyzes = total_analyzes + 1
+                tablist.add(table)
+                active_processes = active_processes + 1
 
     else:
         if dryrun:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            tablist.append(table)
+            tablist.add(table)
         else:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            sql = "ANALYZE VERBOSE %s" % table
+            sql = analyze_cmd(conn, cur, table)
             time.sleep(0.5)
-            try:
-                cur.execute(sql)
-            except Exception as error:
-                printit("Exception: %s *** %s" % (type(error), error))
+            if run_sync(conn, cur, sql, table, size=size) != OK:
                 continue
             total_analyzes = total_analyzes + 1
-            tablist.append(table)
+            tablist.add(table)
 
 if ignoreparts:
     printit ("Very old partitioned table analyzes bypassed=%d" % partcnt)
@@ -1328,13 +4130,14 @@ else:
       "and t.tablename = c.relname and c.relname = u.relname and u.schemaname = n.nspname  AND  now()::date - GREATEST(last_vacuum, last_autovacuum)::date > %d  order by 4,1" % (schema, threshold_max_days_vacuum)
       
 try:
-     cur.execute(sql)
+     rows = order_by_policy(catalog_query(conn, cur, sql))
 except Exception as error:
-    printit("Exception: %s *** %s" % (type(error), error))
+    printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
     conn.close()
     sys.exit (1)
 
-rows = cur.fetchall()
+if bloatorder:
+    rows = order_by_bloat(rows)
 if len(rows) == 0:
     printit ("No very old vacuums to be done.")
 else:
@@ -1343,7 +4146,7 @@ else:
 cnt = 0
 partcnt = 0
 action_name = 'VACUUM(2)'
-for row in rows:
+for row, bucket in zip(rows, classify(rows, 2, 3)):
     if active_processes > threshold_max_processes:
         # see how many are currently running and update the active processes again
         # rc = get_process_cnt()
@@ -1373,13 +4176,13 @@ for row in rows:
     if skip_table(table, tablist):
         continue
 
-    if size > threshold_max_size:
+    if bucket == DEFER:
         # defer action
         if dryrun:
             printit ("Async %13s: %03d %-57s rows: %11d  dead: %8d  size: %10s :%13d NOTICE: Skipping large table.  Do manually." % (action_name, cnt, table, tups, dead, sizep, size))
             tables_skipped = tables_skipped + 1
         continue
-    elif tups > threshold_async_rows or size > threshold_max_sync:
+    elif bucket == ASYNC:
     #elif (tups > threshold_async_rows or size > threshold_max_sync) and async:
         if dryrun:
             if active_processes > threshold_max_processes:
@@ -1388,7 +4191,7 @@ for row in rows:
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             total_vacuums = total_vacuums + 1
-            tablist.append(table)
+            tablist.add(table)
             active_processes = active_processes + 1
         else:
             if active_processes > threshold_max_processes:
@@ -1396,49 +4199,146 @@ for row in rows:
                 tables_skipped = tables_skipped + 1
                 continue
             printit ("Async %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            asyncjobs = asyncjobs + 1
-            
-            # v3.1 change to include application name
-            connparms = "dbname=%s port=%d user=%s host=%s application_name=%s" % (dbname, dbport, dbuser, hostname, 'pg_vacuum' )
-            # cmd = 'nohup psql -h %s -d %s -p %s -U %s -c "VACUUM VERBOSE %s" 2>/dev/null &' % (hostname, dbname, dbport, dbuser, table)
-            cmd = 'nohup psql -d "%s" -c "VACUUM VERBOSE %s" 2>/dev/null &' % (connparms, table)                                                            
-            
             time.sleep(0.5)
-            rc = execute_cmd(cmd)
-            total_vacuums = total_vacuums + 1
-            tablist.append(table)
-            active_processes = active_processes + 1
+            rc = run_async(conn, cur, "VACUUM VERBOSE %s" % table, table, size=size)
+            if rc == OK:
+                asyncjobs = asyncjobs + 1
+                total_vacuums = total_vacuums + 1
+                tablist.add(table)
+                active_processes = active_processes + 1
 
     else:
         if dryrun:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
-            tablist.append(table)
+            tablist.add(table)
         else:
             printit ("Sync  %13s: %03d %-57s rows: %11d size: %10s :%13d dead: %8d" % (action_name, cnt, table, tups, sizep, size, dead))
             sql = "VACUUM VERBOSE %s" % table
             time.sleep(0.5)
-            try:
-                cur.execute(sql)
-            except Exception as error:
-                printit("Exception: %s *** %s" % (type(error), error))
+            if run_sync(conn, cur, sql, table, size=size) != OK:
                 continue
 
             total_vacuums = total_vacuums + 1
-            tablist.append(table)
+            tablist.add(table)
 
 if ignoreparts:
     printit ("Very old partitioned table vacuums bypassed=%d" % partcnt)
     partitioned_tables_skipped = partitioned_tables_skipped + partcnt    
 
+#################################
+# 8. Reindex                    #
+#################################
+# V4.8: Introduced. Invalid indexes and indexes with reindex_pct or more estimated bloat, rebuilt with REINDEX CONCURRENTLY.
+if reindex_pct != -1:
+    try:
+        rows = get_index_candidates(conn, cur)
+    except Exception as error:
+        printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
+        rows = []
+
+    candidates = []
+    for row in rows:
+        index, table, valid, size, sizep, dup = row
+        if not valid and re.search(r'_cc(new|old)[0-9]*"$', index):
+            printit ("NOTICE: %s is left over from a failed concurrent reindex.  Drop it manually." % index, level='WARNING')
+        elif dup is not None:
+            printit ("NOTICE: %s duplicates %s on %s.  Consider dropping it." % (index, dup, table), level='WARNING')
+        elif not valid:
+            candidates.append((index, table, size, sizep, 'invalid'))
+        elif size > 0 and index_bloat.get(index, 0) * 100.0 / size >= reindex_pct and index_bloat.get(index, 0) >= threshold_min_size:
+            candidates.append((index, table, size, sizep, 'bloat %d%%' % int(index_bloat[index] * 100.0 / size)))
+    if len(candidates) == 0:
+        printit ("No reindexes to be done.")
+    else:
+        printit ("reindexes to be evaluated=%d" % len(candidates) )
+    if version < 120000 and len(candidates) > 0:
+        printit ("NOTICE: REINDEX CONCURRENTLY requires PG 12+.  Bypassing %d reindexes, do them manually." % len(candidates))
+        candidates = []
+
+    cnt = 0
+    action_name = 'REINDEX'
+    # an index goes by the limits of its table
+    buckets = classify([(table, size) for index, table, size, sizep, reason in candidates], 1)
+    for (index, table, size, sizep, reason), bucket in zip(candidates, buckets):
+        cnt = cnt + 1
+        if active_processes > threshold_max_processes:
+            # see how many are currently running and update the active processes again
+            rc = get_query_cnt(conn, cur)
+            if rc > threshold_max_processes:
+                printit ("Current process cnt(%d) is still higher than threshold (%d). Sleeping for 5 minutes..." % (rc, threshold_max_processes))
+                time.sleep(300)
+            else:
+                printit ("Current process cnt(%d) is less than threshold (%d).  Processing will continue..." % (rc, threshold_max_processes))
+            active_processes = rc
+
+        # indexes in tablist were reindexed by the run being resumed
+        if policy_excludes(table) or index in tablist:
+            continue
+        sql = "REINDEX INDEX CONCURRENTLY %s" % index
+        if bucket == DEFER:
+            printit ("Async %13s: %03d %-57s size: %10s :%13d %s NOTICE: Skipping large index.  Do manually." % (action_name, cnt, index, sizep, size, reason))
+            tables_skipped = tables_skipped + 1
+            continue
+        elif bucket == ASYNC:
+            if active_processes > threshold_max_processes:
+                printit ("%13s: Max processes reached. Skipping further Async activity for very large index, %s.  Size=%s.  Do manually." % (action_name, index, sizep))
+                tables_skipped = tables_skipped + 1
+                continue
+            printit ("Async %13s: %03d %-57s size: %10s :%13d %s" % (action_name, cnt, index, sizep, size, reason))
+            if not dryrun:
+                time.sleep(0.5)
+                if run_async(conn, cur, sql, table, size=size) != OK:
+                    continue
+                asyncjobs = asyncjobs + 1
+            active_processes = active_processes + 1
+            total_reindexes = total_reindexes + 1
+        else:
+            printit ("Sync  %13s: %03d %-57s size: %10s :%13d %s" % (action_name, cnt, index, sizep, size, reason))
+            if not dryrun:
+                time.sleep(0.5)
+                if run_sync(conn, cur, sql, table, size=size) != OK:
+                    continue
+            total_reindexes = total_reindexes + 1
+
+# v4.3 feature: vacuum deferred tables autovacuum has not reached
+if not dryrun:
+    run_av_deferred(conn, cur)
+
+# v3.7 feature: retry tables that were locked when their turn came
+if not dryrun:
+    retry_locked_tables(conn, cur)
+
 # wait for up to 2 hours for ongoing vacuums/analyzes to finish.
 if not dryrun:
     wait_for_processes(conn,cur)
+close_journal()
+collect_verbose_logs(conn, cur)
 
 printit ("Vacuum Freeze: %d  Vacuum Analyze: %d  Total Vacuums: %d  Total Analyzes: %d  Skipped Partitioned Tables: %d  Total Skipped Tables: %d  Total Async Jobs: %d " \
          % (total_freezes, total_vacuums_analyzes, total_vacuums, total_analyzes, partitioned_tables_skipped, tables_skipped + partitioned_tables_skipped, asyncjobs))
+if avaware:
+    printit ("Vacuums left to autovacuum: %d" % av_skipped)
+if freezes_suspended > 0:
+    printit ("Freezes suspended by the xmin horizon: %d" % freezes_suspended)
+if reindex_pct != -1:
+    printit ("Total Reindexes: %d" % total_reindexes)
+if distributed:
+    printit ("Leases taken: %d  Tables left to other workers: %d" % (leases_held, leases_lost))
 rc = get_query_cnt(conn, cur)
 if rc > 0:
-    printit ("NOTE: Current vacuums/analyzes still in progress: %d" % (rc))
+    printit ("NOTE: Current vacuums/analyzes/reindexes still in progress: %d" % (rc))
+
+# v3.8 feature: WAL generated by the run, and the sync jobs that generated the most of it
+if not dryrun and wal_start is not None:
+    try:
+        printit ("WAL generated by this run (all sessions, async jobs included): %s" % pretty_bytes(get_wal_bytes(conn, cur, wal_start)))
+    except Exception as error:
+        printit ("Unable to compute WAL generated: %s *** %s" % (type(error), error))
+    for table, command, walbytes in sorted(wal_jobs, key=lambda j: j[2], reverse=True)[:10]:
+        printit ("  WAL %-8s %-57s %12s" % (command, table, pretty_bytes(walbytes)))
+
+# v5.6 feature: what the vacuums got for what they cost
+vacuum_efficiency_report()
 
 # v3.1 feature: show async jobs running
 #ps -ef | grep 'psql -h '| grep -v '\--color'
@@ -1448,71 +4348,29 @@ psjobs = "ps -ef | grep 'psql -h %s'| grep -v '\--color'" % hostname
 
 # v 2.7 feature: if inquiry, then show results of 2 queries
 # print ("tables evaluated=%s" % tablist)
-if inquiry != '':
-   if schema == "":
-      sql = "SELECT u.schemaname || '.\"' || u.relname || '\"' as table, pg_size_pretty(pg_total_relation_size(quote_ident(u.schemaname) || '.' || quote_ident(u.relname))::bigint) as size_pretty, " \
-         "pg_total_relation_size(quote_ident(u.schemaname) || '.' || quote_ident(u.relname)) as size, age(c.relfrozenxid) as xid_age,c.reltuples::bigint AS n_tup, u.n_live_tup::bigint as n_live_tup, " \
-         "u.n_dead_tup::bigint AS dead_tup, coalesce(to_char(u.last_vacuum, 'YYYY-MM-DD'),'') as last_vacuum, coalesce(to_char(u.last_autovacuum, 'YYYY-MM-DD'),'') as last_autovacuum, " \
-         "coalesce(to_char(u.last_analyze,'YYYY-MM-DD'),'') as last_analyze, coalesce(to_char(u.last_autoanalyze,'YYYY-MM-DD'),'') as last_autoanalyze " \
-         "FROM pg_namespace n, pg_class c, pg_tables t, pg_stat_user_tables u where c.relnamespace = n.oid and t.schemaname = n.nspname and t.tablename = c.relname and c.relname = u.relname " \
-         "and u.schemaname = n.nspname and n.nspname not in ('information_schema','pg_catalog') order by 1"
-   else:
-      sql = "SELECT u.schemaname || '.\"' || u.relname || '\"' as table, pg_size_pretty(pg_total_relation_size(quote_ident(u.schemaname) || '.' || quote_ident(u.relname))::bigint) as size_pretty, " \
-         "pg_total_relation_size(quote_ident(u.schemaname) || '.' || quote_ident(u.relname)) as size, age(c.relfrozenxid) as xid_age,c.reltuples::bigint AS n_tup, u.n_live_tup::bigint as n_live_tup, " \
-         "u.n_dead_tup::bigint AS dead_tup, coalesce(to_char(u.last_vacuum, 'YYYY-MM-DD'),'') as last_vacuum, coalesce(to_char(u.last_autovacuum, 'YYYY-MM-DD'),'') as last_autovacuum, " \
-         "coalesce(to_char(u.last_analyze,'YYYY-MM-DD'),'') as last_analyze, coalesce(to_char(u.last_autoanalyze,'YYYY-MM-DD'),'') as last_autoanalyze " \
-         "FROM pg_namespace n, pg_class c, pg_tables t, pg_stat_user_tables u where c.relnamespace = n.oid and t.schemaname = '%s' and t.schemaname = n.nspname and t.tablename = c.relname and c.relname = u.relname " \
-         "and u.schemaname = n.nspname order by 1" % schema
+if inquiry != '' or export_dir != '':
+   # v4.1: dry runs report from the snapshot taken at the start, real runs refresh the rows of the tables their actions changed.
    try:
-       cur.execute(sql)
+       if dryrun:
+           rows = get_catalog(conn, cur)
+       else:
+           rows = refresh_catalog(conn, cur, tablist)
    except Exception as error:
-       printit("Exception: %s *** %s" % (type(error), error))
+       printit("Exception: %s *** %s" % (type(error), error), level='ERROR')
        conn.close()
        sys.exit (1)
-
-   rows = cur.fetchall()
-   if len(rows) == 0:
-       printit ("Not able to retrieve inquiry results.")
-   else:
-       printit ("Inquiry Results Follow...")
-
-   # v2.8 fix: indented following section else if was not part of the inquiry if section for cases that did not specify inquiry action.
-   cnt = 0
-   for row in rows:
-      cnt = cnt + 1
-      table            = row[0]
-      sizep            = row[1]
-      size             = row[2]
-      xid_age          = row[3]
-      n_tup            = row[4]
-      n_live_tup       = row[5]
-      dead_tup         = row[6]
-      last_vacuum      = str(row[7])
-      last_autovacuum  = str(row[8])
-      last_analyze     = str(row[9])
-      last_autoanalyze = str(row[10])
-
-      if cnt == 1:
-          printit("%55s %14s %14s %14s %12s %10s %10s %11s %12s %12s %16s" % ('table', 'sizep', 'size', 'xid_age', 'n_tup', 'n_live_tup', 'dead_tup', 'last_vacuum', 'last_autovac', 'last_analyze', 'last_autoanalyze'))
-          printit("%55s %14s %14s %14s %12s %10s %10s %11s %12s %12s %16s" % ('-----', '-----', '----', '-------', '-----', '----------', '--------', '-----------', '------------', '------------', '----------------'))
-
-      #print ("table = %s  len=%d" % (table, len(table)))
-
-      #pretty_size_span = 14     
-      #reduce = len(table) - 50
-      #if reduce > 0 and reduce < 8:
-      #    pretty_size_span = pretty_size_span - reduce
-
-      if inquiry == 'all':
-          printit("%55s %14s %14d %14d %12d %10d %10d %11s %12s %12s %16s" % (table, sizep, size, xid_age, n_tup, n_live_tup, dead_tup, last_vacuum, last_autovacuum, last_analyze, last_autoanalyze))      
-          #printit("%55s %d%s %14d %14d %12d %10d %10d %11s %12s %12s %16s" % (table, pretty_size_span, sizep, size, xid_age, n_tup, n_live_tup, dead_tup, last_vacuum, last_autovacuum, last_analyze, last_autoanalyze))                
-      else:    
-          if skip_table(table, tablist):      
-              printit("%55s %14s %14d %14d %12d %10d %10d %11s %12s %12s %16s" % (table, sizep, size, xid_age, n_tup, n_live_tup, dead_tup, last_vacuum, last_autovacuum, last_analyze, last_autoanalyze))
-              #printit("%55s %d%s %14d %14d %12d %10d %10d %11s %12s %12s %16s" % (table, pretty_size_span, sizep, size, xid_age, n_tup, n_live_tup, dead_tup, last_vacuum, last_autovacuum, last_analyze, last_autoanalyze))              
+   if inquiry != '':
+       inquiry_report(rows)
 
 # end of inquiry section
 
+# v5.2 feature: export the same snapshot and this run's job outcomes for offline analytics
+if export_dir != '':
+   export_run(rows)
+
+# v3.9 feature: keep this dry run's catalog results for the next one
+save_catalog_cache()
+
 # Close communication with the database
 conn.close()
 printit ("Closed the connection and exiting normally.")